@@ -1,226 +1,640 @@
 # This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
 
-from .tcmlib.ngs2 import TMCParser, NodeLayParser
-from .databin import DatabinParser, decompress
-
+from .tcmlib import serialize_container, reserialize, same_chunks, offset_table_of, Gather
+from .tcmlib.ngs2 import TMCParser, Hierarchy
+from .databin import DatabinParser, ReadAhead, decompress, decompress_into, mmap_open, with_overlay
+from . import metrics
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+from contextlib import nullcontext
+from typing import NamedTuple
 import os.path
 import sys
-import mmap
-from itertools import accumulate
+import argparse
 import struct
-
-def main():
-    db = 'databin'
-    e_nin_c_cut_dds = r'e_nin_c_05.dds'
-    with mmap_open(db) as db, DatabinParser(db) as db, mmap_open(e_nin_c_cut_dds) as e_nin_c_cut_dds:
-        ### Humans and red blood Fiends
-
-        # e_you_c has middle sized gibs, a vivid red cut surface texture.
-        e_you_c = parse_tmc(db, 1359)
-        def inject_gibs_(n, **kwargs):
-            y = inject_gibs(e_you_c, parse_tmc(db, n),
-                            src_gib_first_index = 0x23,
-                            src_gib_tex = e_you_c.ttdm.sub_container.chunks[1],
-                            src_gib_normal_tex = e_you_c.ttdm.sub_container.chunks[0],
-                            src_metal_tex = e_you_c.ttdm.sub_container.chunks[2],
-                            **kwargs)
-            save_(n, *y)
-
+import hashlib
+import json
+import warnings
+
+def _ratio(s):
+    x = float(s)
+    if not 0 < x <= 1:
+        raise argparse.ArgumentTypeError(f'{s} is not in (0, 1]')
+    return x
+
+def _positive(s):
+    x = int(s)
+    if x <= 0:
+        raise argparse.ArgumentTypeError(f'{s} is not a positive integer')
+    return x
+
+def _distance(s):
+    x = float(s)
+    if not x >= 0:
+        raise argparse.ArgumentTypeError(f'{s} is not a distance >= 0')
+    return x
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog='gibinjector')
+    parser.add_argument('--compact-vertices', metavar='TOLERANCE', type=float,
+                        help='re-encode injected vertex buffers with smaller types '
+                        'whose error is within TOLERANCE (requires NumPy)')
+    parser.add_argument('--simplify', metavar='RATIO', type=_ratio,
+                        help='simplify injected gib meshes to RATIO of their triangles (requires NumPy)')
+    parser.add_argument('--simplify-error', metavar='DISTANCE', type=_distance,
+                        help='simplify injected gib meshes as long as the error is within DISTANCE')
+    parser.add_argument('--pack-buffers', action='store_true',
+                        help='share vertex/index buffers among injected objects with the same vertex format '
+                        '(requires NumPy)')
+    parser.add_argument('--dedup-textures', action='store_true',
+                        help='store identical textures in TTDL only once')
+    parser.add_argument('--max-texture-size', metavar='PIXELS', type=_positive,
+                        help='drop the top mip levels of textures larger than PIXELS')
+    parser.add_argument('--max-texture-mips', metavar='N', type=_positive,
+                        help='drop the mip levels of textures beyond the first N')
+    parser.add_argument('--engine', choices=('serial', 'thread', 'process', 'stream'), default='serial',
+                        help='how targets are processed (default: serial)')
+    parser.add_argument('--memory-budget', metavar='MiB', type=_positive,
+                        help='hard memory limit of the stream engine (only with --engine stream)')
+    parser.add_argument('-j', '--jobs', type=int, help='number of workers of the engine')
+    parser.add_argument('--overlay', metavar='DIR',
+                        help='read the chunks in DIR (e.g. mods/01090.dat) from there instead of databin')
+    parser.add_argument('--progress', action='store_true',
+                        help='show progress, throughput and ETA on stderr')
+    parser.add_argument('--metrics', metavar='FILE', help='write a summary of the run as JSON')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='write a summary of the run in the Prometheus textfile format')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    p = commands.add_parser('verify', help='check the directory and every chunk of databin')
+    p.add_argument('--databin', default='databin')
+    p.add_argument('--deep', action='store_true', help='also check the container headers in chunks')
+    p.add_argument('--progress', action='store_true',
+                   help='show progress, throughput and ETA on stderr')
+    p.add_argument('-j', '--jobs', type=int, help='number of threads')
+
+    p = commands.add_parser('validate', help='check cross references of TMC/TMCL outputs')
+    p.add_argument('files', nargs='*', metavar='TMC',
+                   help='TMC files; each TMCL is the next numbered file (default: TMC files in mods)')
+    p.add_argument('-j', '--jobs', type=int, help='number of worker processes')
+
+    p = commands.add_parser('export', help='export meshes of a TMC to glTF (.glb) or OBJ')
+    p.add_argument('tmc', metavar='TMC', help='databin chunk number or TMC file')
+    p.add_argument('output', help='output file (.glb or .obj)')
+    p.add_argument('--objects', metavar='START:STOP', type=parse_slice, default=slice(None),
+                   help='range of object indices to export')
+    p.add_argument('--databin', default='databin')
+
+    p = commands.add_parser('diff', help='show the sections and bytes that differ between two TMCs')
+    p.add_argument('a', metavar='TMC', help='databin chunk number or TMC file')
+    p.add_argument('b', metavar='TMC', help='databin chunk number or TMC file')
+    p.add_argument('--databin', default='databin')
+
+    p = commands.add_parser('inspect', help='summarize the structure of TMCs in databin')
+    p.add_argument('tmcs', nargs='+', metavar='TMC',
+                   help='chunk number, range (1090-1100) or name pattern (e_nin_*)')
+    p.add_argument('--json', action='store_true', help='print JSON lines instead of a table')
+    p.add_argument('--databin', default='databin')
+    p.add_argument('-j', '--jobs', type=int, help='number of worker processes')
+
+    p = commands.add_parser('roundtrip', help='check that every container of TMCs in databin serializes back to the same bytes')
+    p.add_argument('tmcs', nargs='+', metavar='TMC',
+                   help='chunk number, range (1090-1100) or name pattern (e_nin_*)')
+    p.add_argument('--databin', default='databin')
+    p.add_argument('-j', '--jobs', type=int, help='number of worker processes')
+
+    p = commands.add_parser('extract', help='extract textures and vertex/index buffers of TMCs to files named by their digests')
+    p.add_argument('tmcs', nargs='+', metavar='TMC',
+                   help='chunk number, range (1090-1100) or name pattern (e_nin_*)')
+    p.add_argument('-o', '--output', default='extracted')
+    p.add_argument('--sections', nargs='+', choices=('ttdl', 'vtxlay', 'idxlay'),
+                   default=['ttdl', 'vtxlay', 'idxlay'])
+    p.add_argument('--databin', default='databin')
+    p.add_argument('-j', '--jobs', type=int, help='number of worker processes')
+
+    p = commands.add_parser('catalog', help='build an SQLite catalog of every TMC in databin')
+    p.add_argument('output', nargs='?', default='catalog.sqlite')
+    p.add_argument('--databin', default='databin')
+    p.add_argument('-j', '--jobs', type=int, help='number of worker processes')
+
+    p = commands.add_parser('serve', help='keep databin and source models warm and take jobs on a Unix socket')
+    p.add_argument('--socket', default='gibinjector.sock')
+    p.add_argument('--databin', default='databin')
+
+    p = commands.add_parser('client', help='send a JSON request to a running serve')
+    p.add_argument('message', nargs='?', default='{"op": "ping"}',
+                   help='e.g. \'{"target": 1090, "kwargs": {"dst_gib_tex_index": 6}}\'')
+    p.add_argument('--socket', default='gibinjector.sock')
+
+    args = parser.parse_args(argv)
+    if args.memory_budget is not None and args.engine != 'stream':
+        parser.error('--memory-budget is only enforced by --engine stream')
+    match args.command:
+        case 'serve':
+            from .daemon import serve
+            serve(args.socket, args.databin, 'e_nin_c_05.dds', GROUPS, inject_target, args.overlay)
+        case 'client':
+            from .daemon import request
+            response = request(args.socket, json.loads(args.message))
+            print(json.dumps(response))
+            return 0 if response.get('ok') else 1
+        case 'catalog':
+            from .catalog import build_catalog
+            count, skipped = build_catalog(args.databin, args.output, args.jobs, overlay = args.overlay)
+            for n, error in skipped:
+                print(f'{n:05}: {error}')
+            print(f'{count} models, {len(skipped)} skipped')
+            return 0 if not skipped else 1
+        case 'diff':
+            from .diff import diff_tmc, format_change
+            with ( load_tmc(args.a, args.databin, args.overlay) as a,
+                   load_tmc(args.b, args.databin, args.overlay) as b ):
+                changes = diff_tmc(a, b)
+            for x in changes:
+                print(format_change(x))
+            return 1 if changes else 0
+        case 'extract':
+            from .extract import extract
+            written = chunks = nbytes = 0
+            ok = True
+            for x in extract(args.databin, args.tmcs, args.output, args.sections, args.jobs, args.overlay):
+                if 'error' in x:
+                    ok = False
+                    print(f'{x["chunk"]:05}: {x["error"]}')
+                    continue
+                chunks += 1
+                written += x['written']
+                nbytes += x['written'] and x['nbytes']
+            print(f'{chunks} chunks, {written} files written ({nbytes/(1<<20):.1f} MiB), '
+                  f'{chunks-written} duplicates')
+            return 0 if ok else 1
+        case 'roundtrip':
+            from .roundtrip import check_databin
+            ok = True
+            for n, results, error in check_databin(args.databin, args.tmcs, args.jobs, args.overlay):
+                ok &= not results and not error
+                print(f'{n:05}: {error or results and "NG" or "OK"}')
+                for x in results:
+                    print(f'  {x.path}: {x.layout}')
+            return 0 if ok else 1
+        case 'inspect':
+            from .summary import summarize, format_table
+            summaries = summarize(args.databin, args.tmcs, args.jobs, args.overlay)
+            for x in args.json and ( json.dumps(x) for x in summaries ) or format_table(summaries):
+                print(x)
+        case 'export':
+            from .export import export_glb, export_obj
+            export = args.output.lower().endswith('.obj') and export_obj or export_glb
+            with load_tmc(args.tmc, args.databin, args.overlay) as tmc, open(args.output, 'wb') as f:
+                export(tmc, f, args.objects)
+        case 'verify':
+            from .verify import verify
+            ok = True
+            for n, problems in verify(args.databin, args.deep, args.jobs, args.progress and sys.stderr or None):
+                ok = False
+                for p in problems:
+                    print(n is None and p or f'{n:05}: {p}')
+            s = metrics.current.summary()
+            print(f'{s["targets"]} chunks, {s["counters"].get("compressed_bytes_read", 0)/(1<<20):.1f} MiB '
+                  f'in {s["seconds"]:.1f} s: {ok and "OK" or "NG"}')
+            return 0 if ok else 1
+        case 'validate':
+            from .validate import validate_files, find_tmc_files
+            ok = True
+            for path, problems in validate_files(args.files or tuple(find_tmc_files('mods')), args.jobs):
+                ok &= not problems
+                print(f'{path}: {problems and "NG" or "OK"}')
+                for p in problems:
+                    print(f'  {p}')
+            return 0 if ok else 1
+        case _:
+            run = metrics.start(sum( len(g.targets) for g in GROUPS ), args.progress and sys.stderr or None)
+            report = inject_all(engine = args.engine, jobs = args.jobs, overlay = args.overlay,
+                                memory_budget = args.memory_budget and args.memory_budget<<20,
+                                vertex_tolerance = args.compact_vertices,
+                                simplify_ratio = args.simplify,
+                                simplify_error = args.simplify_error,
+                                pack_buffers = args.pack_buffers,
+                                dedup_textures = args.dedup_textures,
+                                max_texture_size = args.max_texture_size,
+                                max_texture_mips = args.max_texture_mips)
+            run.finish()
+            if args.max_texture_size is not None or args.max_texture_mips is not None:
+                print(f'textures: {run.counters["texture_bytes_saved"]/(1<<20):.1f} MiB smaller TMCLs, '
+                      f'{run.counters["texture_vram_saved"]/(1<<20):.1f} MiB less VRAM')
+            if args.simplify is not None or args.simplify_error is not None:
+                print(f'meshes: {run.counters["triangles_before"]} triangles simplified to '
+                      f'{run.counters["triangles_after"]}')
+            if args.metrics:
+                run.write_json(args.metrics)
+            if args.prometheus:
+                run.write_prometheus(args.prometheus)
+            if args.engine == 'stream':
+                for n, peak, error in report:
+                    print(f'{n:05}: peak {peak/(1<<20):.1f} MiB{error and " (out of memory)" or ""}')
+                print(f'peak {max(( x[1] for x in report ), default=0)/(1<<20):.1f} MiB')
+                return 1 if any( x[2] for x in report ) else 0
+
+# kwargs are passed to inject_gibs. If dst_e_nin_c_cut_index is given,
+# e_nin_c_05.dds is put there.
+class Target(NamedTuple):
+    n: int
+    kwargs: dict
+
+# Each group injects the gibs of src into its targets. The gib textures are
+# taken from the TTDL of tex_src.
+class Group(NamedTuple):
+    src: int
+    src_gib_first_index: int
+    tex_src: int
+    gib_tex: int
+    gib_normal_tex: int
+    metal_tex: int
+    targets: tuple[Target]
+
+GROUPS = (
+    ### Humans and red blood Fiends
+
+    # e_you_c has middle sized gibs, a vivid red cut surface texture.
+    Group(1359, 0x23, 1359, 1, 0, 2, (
         # e_jgm_a: no gibs, has surface, has metal.
-        inject_gibs_(1090, dst_gib_insert_index = 0x16, dst_mtrcol_index = 4,
-                     dst_gib_tex_index = 5, dst_gib_normal_tex_index = 0,
-                     dst_metal_tex_index = 13)
+        Target(1090, dict(dst_gib_insert_index = 0x16, dst_mtrcol_index = 4,
+                          dst_gib_tex_index = 5, dst_gib_normal_tex_index = 0,
+                          dst_metal_tex_index = 13)),
 
         # e_nin_a: no gibs, has surface, has metal.
-        inject_gibs_(1094, dst_gib_insert_index = 0xf, dst_mtrcol_index = 6,
-                     dst_gib_tex_index = 5, dst_gib_normal_tex_index = 0,
-                     dst_metal_tex_index = 16)
+        Target(1094, dict(dst_gib_insert_index = 0xf, dst_mtrcol_index = 6,
+                          dst_gib_tex_index = 5, dst_gib_normal_tex_index = 0,
+                          dst_metal_tex_index = 16)),
 
         # e_wlf_a: has gibs.
-        inject_gibs_(1112, dst_gib_insert_index = None, dst_mtrcol_index = 1,
-                     dst_gib_tex_index = 11, dst_gib_normal_tex_index = 0,
-                     dst_metal_tex_index = 15)
+        Target(1112, dict(dst_gib_insert_index = None, dst_mtrcol_index = 1,
+                          dst_gib_tex_index = 11, dst_gib_normal_tex_index = 0,
+                          dst_metal_tex_index = 15)),
 
         # e_gaj_b: no gibs, has surface, has metal.
-        inject_gibs_(1167, dst_gib_insert_index = 0x20, dst_mtrcol_index = 3,
-                     dst_gib_tex_index = 4, dst_gib_normal_tex_index = 5,
-                     dst_metal_tex_index = 13)
+        Target(1167, dict(dst_gib_insert_index = 0x20, dst_mtrcol_index = 3,
+                          dst_gib_tex_index = 4, dst_gib_normal_tex_index = 5,
+                          dst_metal_tex_index = 13)),
 
         # e_you_a: has gibs.
-        inject_gibs_(1235, dst_gib_insert_index = None, dst_mtrcol_index = 3,
-                     dst_gib_tex_index = 12, dst_gib_normal_tex_index = 4,
-                     dst_metal_tex_index = 21)
+        Target(1235, dict(dst_gib_insert_index = None, dst_mtrcol_index = 3,
+                          dst_gib_tex_index = 12, dst_gib_normal_tex_index = 4,
+                          dst_metal_tex_index = 21)),
 
         # e_nin_c: has gibs.
-        inject_gibs_(1262, dst_gib_insert_index = None, dst_mtrcol_index = 2,
-                     dst_gib_tex_index = 7, dst_gib_normal_tex_index = 0,
-                     dst_metal_tex_index = 17, e_nin_c_cut_tex = e_nin_c_cut_dds,
-                     dst_e_nin_c_cut_index = 5)
+        Target(1262, dict(dst_gib_insert_index = None, dst_mtrcol_index = 2,
+                          dst_gib_tex_index = 7, dst_gib_normal_tex_index = 0,
+                          dst_metal_tex_index = 17, dst_e_nin_c_cut_index = 5)),
 
         # e_bni_a: has gibs.
-        inject_gibs_(1311, dst_gib_insert_index = None, dst_mtrcol_index = 9,
-                     dst_gib_tex_index = 37, dst_gib_normal_tex_index = 0,
-                     dst_metal_tex_index = 38)
+        Target(1311, dict(dst_gib_insert_index = None, dst_mtrcol_index = 9,
+                          dst_gib_tex_index = 37, dst_gib_normal_tex_index = 0,
+                          dst_metal_tex_index = 38)),
 
         # e_jgm_c: no gibs, no surface, has metal.
-        inject_gibs_(1333, dst_gib_insert_index = 0xf, dst_mtrcol_index = 1,
-                     dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                     dst_metal_tex_index = 14, e_nin_c_cut_tex = e_nin_c_cut_dds,
-                     dst_e_nin_c_cut_index = 5)
+        Target(1333, dict(dst_gib_insert_index = 0xf, dst_mtrcol_index = 1,
+                          dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                          dst_metal_tex_index = 14, dst_e_nin_c_cut_index = 5)),
 
         # e_wlf_b: has gibs.
-        inject_gibs_(1364, dst_gib_insert_index = None, dst_mtrcol_index = 1,
-                     dst_gib_tex_index = 11, dst_gib_normal_tex_index = 0,
-                     dst_metal_tex_index = 15)
+        Target(1364, dict(dst_gib_insert_index = None, dst_mtrcol_index = 1,
+                          dst_gib_tex_index = 11, dst_gib_normal_tex_index = 0,
+                          dst_metal_tex_index = 15)),
 
         # e_you_d: has gibs.
-        inject_gibs_(1366, dst_gib_insert_index = None, dst_mtrcol_index = 3,
-                     dst_gib_tex_index = 12, dst_gib_normal_tex_index = 4,
-                     dst_metal_tex_index = 21)
+        Target(1366, dict(dst_gib_insert_index = None, dst_mtrcol_index = 3,
+                          dst_gib_tex_index = 12, dst_gib_normal_tex_index = 4,
+                          dst_metal_tex_index = 21)),
 
         # e_gja_c: has gibs, has surface, has metal.
-        inject_gibs_(1376, dst_gib_insert_index = 0x20, dst_mtrcol_index = 1,
-                     dst_gib_tex_index = 4, dst_gib_normal_tex_index = 5,
-                     dst_metal_tex_index = 13)
+        Target(1376, dict(dst_gib_insert_index = 0x20, dst_mtrcol_index = 1,
+                          dst_gib_tex_index = 4, dst_gib_normal_tex_index = 5,
+                          dst_metal_tex_index = 13)),
 
         # e_nin_d: no gibs, has surface, has metal.
-        inject_gibs_(1383, dst_gib_insert_index = 0xf, dst_mtrcol_index = 6,
-                     dst_gib_tex_index = 5, dst_gib_normal_tex_index = 0,
-                     dst_metal_tex_index = 15)
+        Target(1383, dict(dst_gib_insert_index = 0xf, dst_mtrcol_index = 6,
+                          dst_gib_tex_index = 5, dst_gib_normal_tex_index = 0,
+                          dst_metal_tex_index = 15)),
 
         # e_jgm_d: no gibs, has surface, has metal.
-        inject_gibs_(1817, dst_gib_insert_index = 0xf, dst_mtrcol_index = 4,
-                     dst_gib_tex_index = 5, dst_gib_normal_tex_index = 0,
-                     dst_metal_tex_index = 14)
-
-        ### Green large gibs
-
-        # e_chg_a has large sized gibs and a green cut surface texture.
-        e_chg_a = parse_tmc(db, 1116)
-        def inject_gibs_(n, **kwargs):
-            y = inject_gibs(e_chg_a, parse_tmc(db, n),
-                            src_gib_first_index = 0x14,
-                            src_gib_tex = e_chg_a.ttdm.sub_container.chunks[13],
-                            src_gib_normal_tex = e_chg_a.ttdm.sub_container.chunks[5],
-                            src_metal_tex = e_chg_a.ttdm.sub_container.chunks[21],
-                            **kwargs)
-            save_(n, *y)
+        Target(1817, dict(dst_gib_insert_index = 0xf, dst_mtrcol_index = 4,
+                          dst_gib_tex_index = 5, dst_gib_normal_tex_index = 0,
+                          dst_metal_tex_index = 14)),
+    )),
 
+    ### Green large gibs
 
+    # e_chg_a has large sized gibs and a green cut surface texture.
+    Group(1116, 0x14, 1116, 13, 5, 21, (
         # e_van_a: no gibs, has metal.
-        inject_gibs_(1107, dst_gib_insert_index = 0x14, dst_mtrcol_index = 1,
-                     dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                     dst_metal_tex_index = 11)
+        Target(1107, dict(dst_gib_insert_index = 0x14, dst_mtrcol_index = 1,
+                          dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                          dst_metal_tex_index = 11)),
 
         # e_van_b: no gibs, no surface, has metal.
-        inject_gibs_(1342, dst_gib_insert_index = 0x1e, dst_mtrcol_index = 1,
-                     dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                     dst_metal_tex_index = 11)
+        Target(1342, dict(dst_gib_insert_index = 0x1e, dst_mtrcol_index = 1,
+                          dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                          dst_metal_tex_index = 11)),
 
         # e_van_c: no gibs, no surface, has metal.
-        inject_gibs_(1361, dst_gib_insert_index = 0x1e, dst_mtrcol_index = 1,
-                     dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                     dst_metal_tex_index = 11)
-
-        ### Green blood fiends whose has Mid-sized gibs
-        def inject_gibs_(n, **kwargs):
-            y = inject_gibs(e_you_c, parse_tmc(db, n),
-                            src_gib_first_index = 0x23,
-                            src_gib_tex = e_chg_a.ttdm.sub_container.chunks[13],
-                            src_gib_normal_tex = e_chg_a.ttdm.sub_container.chunks[5],
-                            src_metal_tex = e_chg_a.ttdm.sub_container.chunks[21],
-                            **kwargs)
-            save_(n, *y)
+        Target(1361, dict(dst_gib_insert_index = 0x1e, dst_mtrcol_index = 1,
+                          dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                          dst_metal_tex_index = 11)),
+    )),
 
+    ### Green blood fiends whose has Mid-sized gibs
+    Group(1359, 0x23, 1116, 13, 5, 21, (
         # kage: no gibs, no surface
-        inject_gibs_(1138, dst_gib_insert_index = 0x10, dst_mtrcol_index = 2,
-                     dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                     dst_metal_tex_index = 16)
+        Target(1138, dict(dst_gib_insert_index = 0x10, dst_mtrcol_index = 2,
+                          dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                          dst_metal_tex_index = 16)),
 
         # e_kag_b: no gibs, no surface
-        inject_gibs_(1148, dst_gib_insert_index = 0x10, dst_mtrcol_index = 2,
-                     dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                     dst_metal_tex_index = 7)
-
-        ### Small sized red blood Fiends
-
-        # e_okm_a has mid-sized gibs and a vivid surface texture.
-        e_okm_a = parse_tmc(db, 1098)
-        def inject_gibs_(n, **kwargs):
-            y = inject_gibs(e_okm_a, parse_tmc(db, n),
-                            src_gib_first_index = 0x18,
-                            src_gib_tex = e_okm_a.ttdm.sub_container.chunks[5],
-                            src_gib_normal_tex = e_okm_a.ttdm.sub_container.chunks[2],
-                            src_metal_tex = e_okm_a.ttdm.sub_container.chunks[11],
-                            **kwargs)
-            save_(n, *y)
+        Target(1148, dict(dst_gib_insert_index = 0x10, dst_mtrcol_index = 2,
+                          dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                          dst_metal_tex_index = 7)),
+    )),
+
+    ### Small sized red blood Fiends
 
+    # e_okm_a has mid-sized gibs and a vivid surface texture.
+    Group(1098, 0x18, 1098, 5, 2, 11, (
         # bat: no gibs, no surface.
-        #inject_gibs_(1085, dst_gib_insert_index = 0x7, dst_mtrcol_index = 0,
-                      #dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                      #dst_metal_tex_index = 2)
+        #Target(1085, dict(dst_gib_insert_index = 0x7, dst_mtrcol_index = 0,
+                           #dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                           #dst_metal_tex_index = 2)),
 
         # e_bat_b: no gibs.
-        inject_gibs_(1353, dst_gib_insert_index = 0x16, dst_mtrcol_index = 1,
-                     dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                     dst_metal_tex_index = 4)
-
-        ### Machines
-
-        # e_ciw_a has robot parts.
-        e_ciw_a = parse_tmc(db, 1280)
-        def inject_gibs_(n, **kwargs):
-            y = inject_gibs(e_ciw_a, parse_tmc(db, n),
-                            src_gib_first_index = 0x3,
-                            src_gib_tex = e_ciw_a.ttdm.sub_container.chunks[8],
-                            src_gib_normal_tex = e_ciw_a.ttdm.sub_container.chunks[0],
-                            src_metal_tex = e_ciw_a.ttdm.sub_container.chunks[9],
-                            **kwargs)
-            save_(n, *y)
+        Target(1353, dict(dst_gib_insert_index = 0x16, dst_mtrcol_index = 1,
+                          dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                          dst_metal_tex_index = 4)),
+    )),
 
+    ### Machines
+
+    # e_ciw_a has robot parts.
+    Group(1280, 0x3, 1280, 8, 0, 9, (
         # e_mac_a: no gibs, no surface.
-        inject_gibs_(1178, dst_gib_insert_index = 0x1D, dst_mtrcol_index = 2,
-                     dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
-                     dst_metal_tex_index = 17)
+        Target(1178, dict(dst_gib_insert_index = 0x1D, dst_mtrcol_index = 2,
+                          dst_gib_tex_index = None, dst_gib_normal_tex_index = None,
+                          dst_metal_tex_index = 17)),
+    )),
+)
+
+def inject_all(*, databin = 'databin', e_nin_c_cut_dds = 'e_nin_c_05.dds',
+               engine = 'serial', jobs = None, memory_budget = None, overlay = None, **options):
+    # With overlay (a directory), the chunks in it are read from there (see
+    # databin.OverlayParser), e.g. to inject again into outputs.
+    if memory_budget is not None and engine != 'stream':
+        raise ValueError(f'memory_budget is only enforced by the stream engine, not {engine}')
+    if engine == 'process':
+        return inject_all_processes(databin, e_nin_c_cut_dds, jobs, overlay, options)
+    if engine == 'stream':
+        return inject_all_stream(databin, e_nin_c_cut_dds, memory_budget, overlay, options)
+
+    # Sources are parsed once and shared read-only by all jobs; they're closed
+    # only after every job is done. Chunks are read in databin order.
+    with ( mmap_open(databin) as db, DatabinParser(db) as db, with_overlay(db, overlay) as db,
+           mmap_open(e_nin_c_cut_dds) as e_nin_c_cut_dds ):
+        ra = ReadAhead(db)
+        sources = {}
+        for n in ra.schedule(source_chunks(), lambda n: (n, n+1)):
+            sources[n] = parse_tmc(db, n)
+            metrics.current.count(source_cache_misses=1)
+            ra.done(n, n+1)
+        J = ra.schedule([ (g, t) for g in GROUPS for t in g.targets ],
+                        lambda x: (x[1].n, x[1].n+1))
+
+        def job(g, t):
+            inject_target(db, sources, e_nin_c_cut_dds, g, t, options)
+            ra.done(t.n, t.n+1)
+
+        try:
+            match engine:
+                case 'serial':
+                    for g, t in J:
+                        job(g, t)
+                case 'thread':
+                    with ThreadPoolExecutor(jobs) as ex:
+                        for f in [ ex.submit(job, g, t) for g, t in J ]:
+                            f.result()
+        finally:
+            for x in sources.values():
+                x.close()
+
+def source_chunks():
+    return list(dict.fromkeys( n for g in GROUPS for n in (g.src, g.tex_src) ))
+
+def inject_target(db, sources, e_nin_c_cut_dds, g, t, options, stream = False):
+    kwargs = dict(t.kwargs)
+    if 'dst_e_nin_c_cut_index' in kwargs:
+        kwargs.update(e_nin_c_cut_tex = e_nin_c_cut_dds)
+    T = sources[g.tex_src].ttdm.textures
+    tmp = output_path(t.n+1) + '.tmp'
+    try:
+        with ( parse_tmc(db, t.n) as dsttmc,
+               stream and open(tmp, 'wb') or nullcontext() as f ):
+            y = inject_gibs(sources[g.src], dsttmc,
+                            src_gib_first_index = g.src_gib_first_index,
+                            src_gib_tex = T[g.gib_tex],
+                            src_gib_normal_tex = T[g.gib_normal_tex],
+                            src_metal_tex = T[g.metal_tex],
+                            ldata_file = f, **options, **kwargs)
+            if not stream:
+                save_(t.n, *y)
+            else:
+                save(output_path(t.n), y[0])
+        if stream:
+            os.replace(tmp, output_path(t.n+1))
+    except BaseException:
+        # A half written TMCL isn't left in mods.
+        if stream and os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    metrics.current.target_done(t.n, sum( os.path.getsize(output_path(n)) for n in (t.n, t.n+1) ))
+
+def inject_all_stream(databin, e_nin_c_cut_dds, memory_budget, overlay, options):
+    # Targets are processed one at a time, and only the sources of the current
+    # group are kept. Each TMCL is written section by section, and everything
+    # of a target is released once its files are written. memory_budget (in
+    # bytes) is a hard limit of the data segment of the process (RLIMIT_DATA,
+    # which doesn't count the mapping of databin); a target going over it
+    # fails with MemoryError and the rest go on.
+    #
+    # Returns [(target, peak bytes traced by tracemalloc, error or None)].
+    import tracemalloc
+    report = []
+    limit = None
+    if memory_budget is not None:
+        try:
+            import resource
+            limit = resource.getrlimit(resource.RLIMIT_DATA)
+            resource.setrlimit(resource.RLIMIT_DATA, (memory_budget, limit[1]))
+        except (ImportError, AttributeError, ValueError, OSError) as e:
+            limit = None
+            warnings.warn(f'The memory budget is not enforced: {e}')
+    tracemalloc.start()
+    try:
+        with ( mmap_open(databin) as db, DatabinParser(db) as db, with_overlay(db, overlay) as db,
+               mmap_open(e_nin_c_cut_dds) as e_nin_c_cut_dds ):
+            ra = ReadAhead(db)
+            sources = {}
+            for g in GROUPS:
+                for n in set(sources) - {g.src, g.tex_src}:
+                    sources.pop(n).close()
+                # A source kept from the group before is a hit.
+                for n in dict.fromkeys((g.src, g.tex_src)):
+                    if n not in sources:
+                        sources[n] = parse_tmc(db, n)
+                        metrics.current.count(source_cache_misses=1)
+                    else:
+                        metrics.current.count(source_cache_hits=1)
+                for t in ra.schedule(g.targets, lambda t: (t.n, t.n+1)):
+                    tracemalloc.reset_peak()
+                    try:
+                        inject_target(db, sources, e_nin_c_cut_dds, g, t, options, stream = True)
+                        error = None
+                    except MemoryError as e:
+                        error = e
+                    ra.done(t.n, t.n+1)
+                    report.append((t.n, tracemalloc.get_traced_memory()[1], error))
+            for x in sources.values():
+                x.close()
+    finally:
+        tracemalloc.stop()
+        if limit is not None:
+            resource.setrlimit(resource.RLIMIT_DATA, limit)
+    return report
+
+def inject_all_processes(databin, e_nin_c_cut_dds, jobs, overlay, options):
+    # The parent inflates each source TMC/TMCL once into shared memory. Workers
+    # attach to the segments and parse them in place, so inflating sources
+    # costs the same and their pages are resident once however many workers
+    # run. Segments are unlinked by the parent only.
+    segments = []
+    try:
+        with mmap_open(databin) as db, DatabinParser(db) as db, with_overlay(db, overlay) as db:
+            ra = ReadAhead(db)
+            names = {}
+            for n in ra.schedule(source_chunks(), lambda n: (n, n+1)):
+                names[n] = []
+                for c in db.chunks[n:n+2]:
+                    x = SharedMemory(create=True, size=max(1, c.decompressed_size))
+                    segments.append(x)
+                    names[n].append((x.name, decompress_into(c, x.buf)))
+                    metrics.current.count(compressed_bytes_read=c.compressed_size,
+                                          decompressed_bytes_read=c.decompressed_size)
+                metrics.current.count(source_cache_misses=1)
+                ra.done(n, n+1)
+            # Workers take targets in databin order.
+            J = sorted(( (g, t) for g in GROUPS for t in g.targets ),
+                       key=lambda x: db.chunks[x[1].n].offset)
+        with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                 initargs=(databin, e_nin_c_cut_dds, names, overlay, options)) as ex:
+            for f in as_completed([ ex.submit(_inject_target, g, t) for g, t in J ]):
+                metrics.current.merge(*f.result())
+    finally:
+        for x in segments:
+            x.close()
+            x.unlink()
+
+_worker = None
+
+def _init_worker(databin, e_nin_c_cut_dds, names, overlay, options):
+    # Everything is kept until the worker exits, as the parsers hold views
+    # of the segments.
+    global _worker
+    # Counters inherited by fork are the parent's.
+    metrics.start()
+    db = with_overlay(DatabinParser(mmap_open(databin)), overlay)
+    sources = {}
+    segments = []
+    for n, ((a, i), (b, j)) in names.items():
+        a = SharedMemory(a, track=False)
+        b = SharedMemory(b, track=False)
+        segments += a, b
+        sources[n] = TMCParser(a.buf[:i], b.buf[:j])
+    _worker = (db, sources, mmap_open(e_nin_c_cut_dds), options, segments)
+
+def _inject_target(g, t):
+    # Returns the metrics of the target for the parent to merge.
+    db, sources, e_nin_c_cut_dds, options, _ = _worker
+    inject_target(db, sources, e_nin_c_cut_dds, g, t, options)
+    return metrics.current.take()
 
 def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_normal_tex,
                 src_metal_tex, dst_gib_insert_index = None, dst_gib_tex_index = None,
                 dst_gib_normal_tex_index = None, dst_metal_tex_index = None, dst_mtrcol_index =None,
-                e_nin_c_cut_tex = None, dst_e_nin_c_cut_index = None):
+                e_nin_c_cut_tex = None, dst_e_nin_c_cut_index = None, vertex_tolerance = None,
+                simplify_ratio = None, simplify_error = None, pack_buffers = False, dedup_textures = False, max_texture_size = None, max_texture_mips = None,
+                ldata_file = None):
+    # Returns the TMC and the sink its TMCL is written to section by section:
+    # ldata_file (anything with write) if given, or else a new Gather (see
+    # save).
+    #
+    # With max_texture_size or max_texture_mips, every texture slot is
+    # reduced by dds.reduce_dds.
+    #
+    # With simplify_ratio or simplify_error, the injected meshes are
+    # simplified by simplify.simplify_objects before vertex_tolerance. With
+    # pack_buffers, the injected objects share their buffers (see pack).
+    L = Gather() if ldata_file is None else ldata_file
     dsttmc_chunks = list(dsttmc._chunks)
-    ttdl_chunks = list(dsttmc.ttdm.sub_container._chunks)
-    if dst_gib_tex_index is None:
-        dst_gib_tex_index = len(ttdl_chunks)
-        ttdl_chunks.append(src_gib_tex)
-    else:
+    # Texture slots as TTDH resolves them.
+    ttdl_chunks = list(dsttmc.ttdm.textures)
+    if dst_gib_tex_index is not None:
         ttdl_chunks[dst_gib_tex_index] = src_gib_tex
 
-    if dst_gib_normal_tex_index is None:
-        dst_gib_normal_tex_index = len(ttdl_chunks)
-        ttdl_chunks.append(src_gib_normal_tex)
-    else:
+    if dst_gib_normal_tex_index is not None:
         ttdl_chunks[dst_gib_normal_tex_index] = src_gib_normal_tex
 
-    if dst_metal_tex_index is None:
-        dst_metal_tex_index = len(ttdl_chunks)
-        ttdl_chunks.append(src_metal_tex)
-
     if e_nin_c_cut_tex:
         ttdl_chunks[dst_e_nin_c_cut_index] = e_nin_c_cut_tex
-    ttdl, ttdl_ldata = serialize_container(b'TTDL', ttdl_chunks, separating_body = True, aligned = 0x40)
-    ttdh = serialize_container(
-            b'TTDH', ( struct.pack('< IIqqq', 1, i, 0, 0, 0) for i in range(len(ttdl_chunks)) ),
-            (0x1).to_bytes(4, 'little')
-    )
-    dsttmc_chunks[dsttmc_chunks.index(dsttmc.ttdm._data)] = serialize_container(b'TTDM', (), ttdh, ttdl)
+
+    D = { chunk_digest(c): i for i, c in reversed(tuple(enumerate(ttdl_chunks))) } if dedup_textures else None
+    n = len(ttdl_chunks)
+    if dst_gib_tex_index is None:
+        dst_gib_tex_index = index_or_append(ttdl_chunks, src_gib_tex, D)
+
+    if dst_gib_normal_tex_index is None:
+        dst_gib_normal_tex_index = index_or_append(ttdl_chunks, src_gib_normal_tex, D)
+
+    if dst_metal_tex_index is None:
+        dst_metal_tex_index = index_or_append(ttdl_chunks, src_metal_tex, D)
+
+    metrics.current.count(textures_inserted=len(ttdl_chunks)-n)
+    S = ()
+    if max_texture_size is not None or max_texture_mips is not None:
+        ttdl_chunks, S = reduce_textures(ttdl_chunks, max_texture_size, max_texture_mips)
+    if same_chunks(ttdl_chunks, dsttmc.ttdm.textures) and not (dedup_textures and len(D) < len(ttdl_chunks)):
+        # The texture slots are as they were, so TTDM is passed through.
+        ttdl_ldata = dsttmc.lheader.ttdl
+    else:
+        ttdh_table = range(len(ttdl_chunks))
+        if dedup_textures:
+            ttdl_chunks, ttdh_table = deduplicate(ttdl_chunks)
+        # Every slot is loaded, but only the chunks stored are in the TMCL.
+        metrics.current.count(texture_vram_saved=sum(S),
+                              texture_bytes_saved=sum(dict(zip(ttdh_table, S)).values()))
+        ttdl, ttdl_ldata = serialize_container(b'TTDL', ttdl_chunks, separating_body = True, aligned = 0x40)
+        ttdh = serialize_container(
+                b'TTDH', ( struct.pack('< IIqqq', 1, i, 0, 0, 0) for i in ttdh_table ),
+                (0x1).to_bytes(4, 'little')
+        )
+        dsttmc_chunks[dsttmc_chunks.index(dsttmc.ttdm._data)] = serialize_container(b'TTDM', (), ttdh, ttdl)
 
     # No need to inject gibs.
     if dst_gib_insert_index is None:
         lheader_chunks = list(dsttmc.lheader._chunks)
         lheader_chunks[lheader_chunks.index(dsttmc.lheader.ttdl)] = ttdl_ldata
-        lheader, lheader_ldata = serialize_container(b'LHeader', lheader_chunks, dsttmc.lheader._metadata, separating_body = True, aligned = 0x80)
+        # Only TTDL is rebuilt; the other ldata sections are passed through as
+        # views of the TMCL of dsttmc, so the output is never copied whole. If
+        # TTDL is as it was, so are LHeader and the TMC.
+        lheader, _ = reserialize(dsttmc.lheader, lheader_chunks, aligned = 0x80, ldata_file = L)
         dsttmc_chunks[dsttmc_chunks.index(dsttmc.lheader._data)] = lheader
-        return (serialize_container(b'TMC', dsttmc_chunks, dsttmc._metadata), lheader_ldata)
+        return (reserialize(dsttmc, dsttmc_chunks, aligned = 0x10), L)
 
     src_slice = slice(src_gib_first_index, src_gib_first_index+0x11)
     dst_slice = slice(dst_gib_insert_index, dst_gib_insert_index+0x11)
@@ -230,6 +644,20 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
             ( bytearray(srctmc.vtxlay.chunks[c.vertex_buffer_index]),
                 bytearray(srctmc.idxlay.chunks[c.index_buffer_index]) )
             for c in srctmc.mdlgeo.chunks[src_slice] for c in c.sub_container.chunks ))
+    G = [ bytearray(c) for c in srctmc.mdlgeo._chunks[src_slice] ]
+    if simplify_ratio is not None or simplify_error is not None:
+        from .simplify import simplify_objects
+        V, I, before, after = zip(*simplify_objects(G, V, I, simplify_ratio, simplify_error))
+        metrics.current.count(triangles_before=sum(before), triangles_after=sum(after))
+    if vertex_tolerance is not None:
+        from .vertex import compact_vertices
+        V = tuple(compact_vertices(G, V, vertex_tolerance))
+    # The buffer of each GeoDecl chunk of G, in order
+    B = range(len(V))
+    if pack_buffers:
+        from . import pack
+        V, I, B = pack.pack_buffers(G, V, I)
+    metrics.current.count(objects_inserted=len(G), buffers_inserted=len(V)+len(I))
 
     c = dsttmc.mdlgeo.chunks[dst_slice.start-1].sub_container.chunks[-1]
     # we use vidx and iidx later
@@ -250,7 +678,7 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
         s = b''.join( struct.pack('< iI', i+0x11*(i>=dst_slice.start), j) for i,j in xrefs )
         struct.pack_into(f'< {len(s)}s', c, 0xd8, s)
     c = mtrcol_chunks[dst_mtrcol_index]
-    xrefs = list(dsttmc.mtrcol.chunks[dst_mtrcol_index].xrefs)
+    xrefs = [ (i+0x11*(i>=dst_slice.start), j) for i,j in dsttmc.mtrcol.chunks[dst_mtrcol_index].xrefs ]
     n = len(xrefs) + 0x11
     c += ((0xd8 + 8*n) - len(c)) * b'\0'
     xrefs += ( (i, 1) for i in range(dst_slice.start, dst_slice.stop) )
@@ -261,7 +689,7 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
     dsttmc_chunks[dsttmc_chunks.index(dsttmc.mtrcol._data)] = serialize_container(b'MtrCol', mtrcol_chunks)
 
     mdlgeo_chunks = list(dsttmc.mdlgeo._chunks)
-    mdlgeo_chunks[dst_insert_slice] = ( bytearray(c) for c in srctmc.mdlgeo._chunks[src_slice] )
+    mdlgeo_chunks[dst_insert_slice] = G
     mdlgeo_chunks[dst_slice.stop:] = ( bytearray(c) for c in mdlgeo_chunks[dst_slice.stop:] )
     for objgeo in mdlgeo_chunks[dst_slice]:
         for o in offset_table_of(objgeo):
@@ -281,29 +709,25 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
         # obj index
         struct.pack_into('< I', objgeo, 0x34, i)
 
-    j = vidx
-    k = iidx
-    for i, objgeo in enumerate(mdlgeo_chunks[dst_slice]):
+    B = iter(B)
+    for objgeo in mdlgeo_chunks[dst_slice]:
         o, = struct.unpack_from('< I', objgeo, 0x28)
         geodecl = memoryview(objgeo)[o:]
-        for k, (j, o) in enumerate(enumerate(offset_table_of(geodecl), j), k):
+        for o in offset_table_of(geodecl):
+            b = next(B)
             # index_buffer_index
-            struct.pack_into('< I', geodecl, o+0xc, k)
+            struct.pack_into('< I', geodecl, o+0xc, iidx+b)
             vertex_info_offset, = struct.unpack_from('< 4xI', geodecl, o)
-            vertex_buffer_index, = struct.unpack_from('< I', geodecl, o+vertex_info_offset)
             # vertex_buffer_index
-            struct.pack_into('< I', geodecl, o+vertex_info_offset, j)
-        j += 1
-        k += 1
+            struct.pack_into('< I', geodecl, o+vertex_info_offset, vidx+b)
 
     for objgeo0, objgeo in zip(dsttmc.mdlgeo.chunks[dst_slice.start:], mdlgeo_chunks[dst_slice.stop:]):
         o, = struct.unpack_from('< I', objgeo, 0x28)
         geodecl = memoryview(objgeo)[o:]
         for c, o in zip(objgeo0.sub_container.chunks, offset_table_of(geodecl)):
-            struct.pack_into('< I', geodecl, o+0xc, c.index_buffer_index+0x11)
+            struct.pack_into('< I', geodecl, o+0xc, c.index_buffer_index+len(I))
             vertex_info_offset, = struct.unpack_from('< 4xI', geodecl, o)
-            vertex_buffer_index, = struct.unpack_from('< I', geodecl, o+vertex_info_offset)
-            struct.pack_into('< I', geodecl, o+vertex_info_offset, c.vertex_buffer_index+0x11)
+            struct.pack_into('< I', geodecl, o+vertex_info_offset, c.vertex_buffer_index+len(V))
 
     dsttmc_chunks[dsttmc_chunks.index(dsttmc.mdlgeo._data)] = serialize_container(b'MdlGeo', mdlgeo_chunks)
 
@@ -315,46 +739,13 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
         struct.pack_into('< I', objinfo, 0x34, idx)
     dsttmc_chunks[dsttmc_chunks.index(dsttmc.mdlinfo._data)] = serialize_container(b'MdlInfo', mdlinfo_chunks)
 
-    hielay_chunks = list( bytearray(c) for c in dsttmc.hielay._chunks )
-    for i, c in enumerate(hielay_chunks):
-        a = dsttmc.hielay.chunks[i]
-        if a.parent == -1:
-            root_index = i
-            n = len(a.children) + 0x11
-            c += ((0x50 + 4*n) - len(c)) * b'\0'
-            # child count
-            struct.pack_into(f'< I', c, 4*16+4, n)
-
-            # child index
-            C = list( i+0x11*(i>=dst_slice.start) for i in a.children )
-            C += range(dst_slice.start, dst_slice.stop)
-            C.sort()
-            struct.pack_into(f'< {len(C)}i', c, 0x50, *C)
-        else:
-            # child index
-            struct.pack_into(f'< {len(a.children)}i', c, 0x50, *( i+0x11*(i>=dst_slice.start) for i in a.children ))
-
-    hielay_chunks[dst_insert_slice] = ( bytearray(c) for c in srctmc.hielay._chunks[src_slice] )
-    for c in hielay_chunks[dst_slice]:
-        # parent, child count and level
-        struct.pack_into('< III', c, 0x40, root_index, 0, 1)
-    dsttmc_chunks[dsttmc_chunks.index(dsttmc.hielay._data)] = serialize_container(b'HieLay', hielay_chunks, b'', dsttmc.hielay._sub_container)
-
-    nodelay_chunks = list( bytearray(c) for c in dsttmc.nodelay._chunks )
-    for i, nodeobj in enumerate(nodelay_chunks):
-        ng = dsttmc.nodelay.chunks[i].chunks[0].node_group
-        o, = offset_table_of(nodeobj)
-        struct.pack_into(f'< {len(ng)}i', nodeobj, o+0x50, *( i+0x11*(i>=dst_slice.start) for i in ng ))
-
-    nodelay_chunks[dst_insert_slice] = ( bytearray(c) for c in srctmc.nodelay._chunks[src_slice] )
-    for idx, nodeobj in enumerate(nodelay_chunks[dst_slice.start:], dst_slice.start):
-        # node index
-        struct.pack_into('< I', nodeobj, 0x38, idx)
-        o, = offset_table_of(nodeobj)
-        # obj index and node index (both are the same for enemies models)
-        struct.pack_into('< I', nodeobj, o, idx)
-        struct.pack_into('< I', nodeobj, o+8, idx)
-    new_nodelay = dsttmc_chunks[dsttmc_chunks.index(dsttmc.nodelay._data)] = serialize_container(b'NodeLay', nodelay_chunks, dsttmc.nodelay._metadata)
+    # Gib nodes go under the root, and their objects are at the same indices.
+    hierarchy = Hierarchy(dsttmc.hielay, dsttmc.nodelay)
+    hierarchy.insert(dst_slice.start, Hierarchy(srctmc.hielay, srctmc.nodelay), src_slice,
+                     obj_index = dst_slice.start)
+    hielay, nodelay = hierarchy.serialize()
+    dsttmc_chunks[dsttmc_chunks.index(dsttmc.hielay._data)] = hielay
+    dsttmc_chunks[dsttmc_chunks.index(dsttmc.nodelay._data)] = nodelay
 
     glblmtx_chunks = list(dsttmc.glblmtx._chunks)
     glblmtx_chunks[dst_insert_slice] = srctmc.glblmtx._chunks[src_slice]
@@ -368,7 +759,7 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
     lheader_chunks[lheader_chunks.index(dsttmc.lheader.ttdl)] = ttdl_ldata
     lheader_chunks[lheader_chunks.index(dsttmc.lheader.vtxlay)] = vtxlay_ldata
     lheader_chunks[lheader_chunks.index(dsttmc.lheader.idxlay)] = idxlay_ldata
-    lheader, lheader_ldata = serialize_container(b'LHeader', lheader_chunks, dsttmc.lheader._metadata, separating_body = True, aligned = 0x80)
+    lheader, _ = serialize_container(b'LHeader', lheader_chunks, dsttmc.lheader._metadata, separating_body = True, aligned = 0x80, ldata_file = L)
     dsttmc_chunks[dsttmc_chunks.index(dsttmc.lheader._data)] = lheader
 
     # This chunk consists of 8 chunks of data. Each of them contains two "short":
@@ -386,7 +777,7 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
     x, = struct.unpack_from('< H', c, n)
     struct.pack_into('< H', c, n, x+(x>0)*0x11)
     n = 0x14 # OPT
-    i = tuple( c.metadata.name[:3] for c in NodeLayParser(new_nodelay).chunks ).index(b'OPT')
+    i = hierarchy.prefix_range(b'OPT').start
     x, = struct.unpack_from('< 2xH', c, n)
     struct.pack_into('< HH', c, n, i, x+0x11)
     n = 0x18 # ?
@@ -397,9 +788,9 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
     struct.pack_into('< H', c, n, x+(x>0)*0x11)
 
     x = dsttmc._chunks[14]
-    n = len(nodelay_chunks)
+    n = len(hierarchy)
     n += -n%8
-    dsttmc_chunks[14] = y = bytearray(4*n + 0x60*len(nodelay_chunks))
+    dsttmc_chunks[14] = y = bytearray(4*n + 0x60*len(hierarchy))
     O = range(4*n, len(y), 0x60)
     R = struct.unpack_from(f'< {n-0x11}I', x)
     y[O[0]:O[dst_slice.start]] = x[R[0]:R[dst_slice.start]]
@@ -408,97 +799,86 @@ def inject_gibs(srctmc, dsttmc, *, src_gib_first_index, src_gib_tex, src_gib_nor
     y[O[dst_slice.stop]:] = x[R[dst_slice.start]:]
     struct.pack_into(f'< {len(O)}I', y, 0, *O)
 
-    return (serialize_container(b'TMC', dsttmc_chunks, dsttmc._metadata), lheader_ldata)
-
-def serialize_container(magic, chunks = (), metadata = b'', sub_container = b'', *, separating_body = False, aligned = 0x10):
-    chunks = tuple( memoryview(c) for c in chunks )
-    tuple_of_chunk_nbytes = tuple( c.nbytes for c in chunks )
-    metadata = memoryview(metadata)
-    sub_container = memoryview(sub_container)
-    separating_body = bool(separating_body)
-
-    # We calculate sizes and offsets first.
-    valid_chunk_count = sum( i > 0 for i in tuple_of_chunk_nbytes )
-    offset_table_nbytes = 4*len(chunks)
-    offset_table_nbytes += -offset_table_nbytes % 0x10
-    size_table_nbytes = offset_table_nbytes * (separating_body or aligned % 0x10)
-    chunks_nbytes = sum( i + -i % aligned for i in tuple_of_chunk_nbytes )
-    metadata_nbytes = metadata.nbytes + -metadata.nbytes % 0x10
-    sub_container_nbytes = sub_container.nbytes + -sub_container.nbytes % 0x10
-    header_nbytes = separating_body and 0x50 or 0x30
-    offset_table_pos0 = header_nbytes + metadata_nbytes
-    size_table_pos0 = offset_table_pos0 + offset_table_nbytes
-    sub_container_pos0 = size_table_pos0 + size_table_nbytes
-
-    i0 = ( 0x10 * separating_body
-          or sub_container_pos0 * (sub_container_nbytes > 0) + sub_container_nbytes
-          or size_table_pos0 * (size_table_nbytes > 0) + size_table_nbytes
-          or offset_table_pos0 * (offset_table_nbytes > 0) + offset_table_nbytes )
-    i0 += -i0 % aligned
-    I = accumulate(( i + -i % aligned for i in tuple_of_chunk_nbytes[:-1] ), initial=i0)
-    offset_table = (offset_table_nbytes > 0) * tuple( i*(j > 0) for i,j in zip(I, tuple_of_chunk_nbytes) )
-    size_table = (size_table_nbytes > 0) * tuple( i for i in tuple_of_chunk_nbytes )
-
-    n = (
-            header_nbytes
-            + metadata_nbytes
-            + offset_table_nbytes
-            + size_table_nbytes
-            + sub_container_nbytes
-            + chunks_nbytes * (not separating_body)
-    )
-    data = bytearray(n + -n%0x10)
-
-    # Let's pack the data.
-    struct.pack_into(
-            '< 8sII III4x III', data, 0,
-            magic, 0x01010000, header_nbytes,
-            len(data), len(chunks), valid_chunk_count,
-            offset_table_pos0 * (offset_table_nbytes > 0),
-            size_table_pos0 * (size_table_nbytes > 0),
-            sub_container_pos0 * (sub_container_nbytes > 0)
-    )
-
-    if separating_body:
-        n = 0x10 + chunks_nbytes
-        ldata = bytearray(n + -n%aligned)
-        struct.pack_into(
-                '< III', data, 0x40,
-                valid_chunk_count, len(ldata), 0x01234567
-        )
-        ldata[:0x10] = data[0x40:0x50]
-
-    struct.pack_into(f'< {metadata.nbytes}s', data, header_nbytes, metadata.tobytes())
-    struct.pack_into(f'< {len(offset_table)}I', data, offset_table_pos0, *offset_table)
-    struct.pack_into(f'< {len(size_table)}I', data, size_table_pos0, *size_table)
-    struct.pack_into(f'< {sub_container.nbytes}s', data, sub_container_pos0, sub_container.tobytes())
-
-    A = separating_body and ldata or data
-    for o, c in zip(offset_table, chunks):
-        A[o:o+c.nbytes] = c
-
-    return separating_body and (data, ldata) or data
-
-def offset_table_of(x):
-    n, = struct.unpack_from('< I', x, 0x14)
-    o, = struct.unpack_from('< I', x, 0x20)
-    return struct.unpack_from(f' {n}I', x, o)
-
-def mmap_open(path):
-    with open(path, 'rb') as f:
-        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return (serialize_container(b'TMC', dsttmc_chunks, dsttmc._metadata), L)
+
+def chunk_digest(c):
+    h = hashlib.blake2b(digest_size=16)
+    for b in c if isinstance(c, Gather) else (c,):
+        h.update(b)
+    return h.digest()
+
+def reduce_textures(chunks, max_size, max_mips):
+    # Returns the chunks reduced by reduce_dds and the bytes dropped from each.
+    # Chunks which aren't DDS textures it can read are left as they are.
+    from .dds import reduce_dds, DDSError
+    R = []
+    for c in chunks:
+        try:
+            R.append(reduce_dds(c, max_size, max_mips))
+        except DDSError as e:
+            warnings.warn(f'A texture is left as it is: {e}')
+            R.append((c, 0))
+    C, S = zip(*R) if R else ((), ())
+    return list(C), S
+
+def index_or_append(chunks, c, digests = None):
+    # With digests ({digest: index} of chunks), the index of the same bytes
+    # is returned instead of appending c again.
+    if digests is not None:
+        h = chunk_digest(c)
+        if h in digests:
+            metrics.current.count(texture_dedup_hits=1)
+            return digests[h]
+        metrics.current.count(texture_dedup_misses=1)
+        digests[h] = len(chunks)
+    chunks.append(c)
+    return len(chunks) - 1
+
+def deduplicate(chunks):
+    # Returns the unique chunks and, for each of the original chunks, the index
+    # of its bytes in the unique chunks.
+    D = {}
+    U = []
+    T = tuple( index_or_append(U, c, D) for c in chunks )
+    return U, T
 
 def parse_tmc(db, n):
-    return TMCParser(decompress(db.chunks[n]), decompress(db.chunks[n+1]))
+    C = db.chunks[n:n+2]
+    metrics.current.count(compressed_bytes_read=sum( c.compressed_size for c in C ),
+                          decompressed_bytes_read=sum( c.decompressed_size for c in C ))
+    return TMCParser(*( decompress(c) for c in C ))
+
+def parse_slice(s):
+    a, _, b = s.partition(':')
+    return slice(a and int(a, 0) or None, b and int(b, 0) or None)
+
+def load_tmc(spec, databin = 'databin', overlay = None):
+    # spec is a chunk number in databin (with the overrides in the directory
+    # overlay), or a path to a TMC whose TMCL is the next numbered file.
+    if spec.isdigit():
+        with mmap_open(databin) as db, DatabinParser(db) as db, with_overlay(db, overlay) as db:
+            return parse_tmc(db, int(spec))
+    d, f = os.path.split(spec)
+    n, ext = os.path.splitext(f)
+    with open(spec, 'rb') as f, open(os.path.join(d, f'{int(n)+1:0{len(n)}}{ext}'), 'rb') as g:
+        return TMCParser(f.read(), g.read())
 
 def save(path, data):
-    with open(path, 'wb') as f:
-        f.write(data)
+    # The file is replaced by renaming, so that mappings of the old one (e.g.
+    # by OverlayParser) stay valid.
+    with open(path + '.tmp', 'wb') as f:
+        if isinstance(data, Gather):
+            f.writelines(data)
+        else:
+            f.write(data)
+    os.replace(path + '.tmp', path)
+
+def output_path(n):
+    return os.path.join('mods', f'{n:05}.dat')
 
 def save_(n, tmc, tmcl):
-    s = r'mods\{:05}.dat'
-    save(s.format(n), tmc)
-    save(s.format(n+1), tmcl)
+    save(output_path(n), tmc)
+    save(output_path(n+1), tmcl)
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module builds an SQLite catalog of every TMC in databin: the objects,
+# nodes, textures and materials of each model, indexed by name and node
+# prefix (MOT, OPT, SUP, WGT, WPB, ...), e.g.
+#
+#   SELECT name FROM models WHERE chunk NOT IN (SELECT chunk FROM nodes WHERE prefix = 'OPT')
+
+from .tcmlib.ngs2 import TMCParser
+from .databin import decompress
+from . import pool
+
+from concurrent.futures import ProcessPoolExecutor
+import warnings
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE models (
+    chunk INTEGER PRIMARY KEY,
+    name TEXT,
+    objects INTEGER,
+    nodes INTEGER,
+    textures INTEGER,
+    mtrcols INTEGER,
+    has_gibs INTEGER
+);
+CREATE TABLE objects (chunk INTEGER, obj_index INTEGER, name TEXT);
+CREATE TABLE nodes (chunk INTEGER, node_index INTEGER, name TEXT, prefix TEXT, obj_index INTEGER);
+CREATE INDEX objects_name ON objects (name, chunk);
+CREATE INDEX nodes_name ON nodes (name, chunk);
+CREATE INDEX nodes_prefix ON nodes (prefix, chunk);
+'''
+
+def _scan_tmc(n):
+    # Only the TMC is decompressed; the counts here don't need its TMCL.
+    # Sections are parsed lazily, on the reads below, so a malformed model is
+    # skipped there too rather than failing the whole batch. Its error is
+    # returned in place of the rows.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            with TMCParser(decompress(pool.db.chunks[n]), lazy=True) as tmc:
+                mdlgeo = getattr(tmc, 'mdlgeo', None)
+                nodelay = getattr(tmc, 'nodelay', None)
+                ttdm = getattr(tmc, 'ttdm', None)
+                mtrcol = getattr(tmc, 'mtrcol', None)
+                objects = [ o.metadata.name.decode(errors='replace') for o in mdlgeo and mdlgeo.chunks or () ]
+                nodes = [ (c.metadata.name.decode(errors='replace'), c.chunks[0].obj_index if c.chunks else -1)
+                          for c in nodelay and nodelay.chunks or () ]
+                textures = ttdm and len(ttdm.metadata.chunks) or 0
+                mtrcols = mtrcol and len(mtrcol.chunks) or 0
+                name = tmc.metadata.name.decode(errors='replace')
+        except Exception as e:
+            return f'{type(e).__name__}: {e}'
+    has_gibs = any( x.startswith('OPTscat') for x in objects ) or any( x.startswith('OPTscat') for x, _ in nodes )
+    return (n, name, len(objects), len(nodes), textures, mtrcols, has_gibs), objects, nodes
+
+def _scan(chunks):
+    return [ (n, _scan_tmc(n)) for n in chunks if pool.is_tmc(n) ]
+
+def build_catalog(databin, path, jobs = None, batch = 64, overlay = None):
+    # Returns the number of models in the catalog and [(chunk, error)] of
+    # the TMCs skipped.
+    n = pool.chunk_count(databin)
+    batches = [ range(i, min(i+batch, n)) for i in range(0, n, batch) ]
+    count = 0
+    skipped = []
+    con = sqlite3.connect(path)
+    with con:
+        con.executescript('DROP TABLE IF EXISTS models; DROP TABLE IF EXISTS objects; DROP TABLE IF EXISTS nodes;')
+        con.executescript(SCHEMA)
+        with ProcessPoolExecutor(jobs, initializer=pool.open_databin, initargs=(databin, overlay)) as ex:
+            for R in ex.map(_scan, batches):
+                for k, x in R:
+                    if isinstance(x, str):
+                        skipped.append((k, x))
+                        continue
+                    model, objects, nodes = x
+                    count += 1
+                    con.execute('INSERT INTO models VALUES (?, ?, ?, ?, ?, ?, ?)', model)
+                    con.executemany('INSERT INTO objects VALUES (?, ?, ?)',
+                                    ( (k, i, x) for i, x in enumerate(objects) ))
+                    con.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?, ?)',
+                                    ( (k, i, x, x[:3], o) for i, (x, o) in enumerate(nodes) ))
+    con.close()
+    return count, skipped
@@ -0,0 +1,138 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module keeps databin mapped and the source models parsed in a
+# long-running process that takes injection jobs over a Unix socket. A request
+# is a JSON object on one line, and so is its response, e.g.
+#
+#   {"op": "inject", "target": 1090, "kwargs": {"dst_gib_tex_index": 6}}
+#   {"ok": true, "target": 1090, "seconds": 0.004}
+#
+# The group fields (src, src_gib_first_index, tex_src, gib_tex,
+# gib_normal_tex, metal_tex) and kwargs default to the entry of the target in
+# GROUPS; kwargs given are merged over it. A target not in GROUPS takes every
+# group field and its kwargs from the request. options are the keyword options of
+# inject_gibs (vertex_tolerance, simplify_ratio, simplify_error,
+# pack_buffers, dedup_textures, max_texture_size, max_texture_mips). The
+# other ops are "ping" and "shutdown".
+
+from .tcmlib.ngs2 import TMCParser
+from .databin import DatabinParser, decompress, mmap_open, with_overlay
+from . import metrics
+
+import socketserver
+import threading
+import socket
+import json
+import os
+import time
+
+class Daemon:
+    def __init__(self, databin, e_nin_c_cut_dds, groups, inject, overlay = None):
+        # With overlay, targets are read from the outputs in it if they are.
+        self.db = with_overlay(DatabinParser(mmap_open(databin)), overlay)
+        self.e_nin_c_cut_dds = mmap_open(e_nin_c_cut_dds)
+        self.groups = groups
+        # inject(db, sources, e_nin_c_cut_dds, group, target, options)
+        self.inject = inject
+        # Source models parsed on first use and kept
+        self.sources = {}
+        self._lock = threading.Lock()
+        # {target: lock}, so jobs on the same target don't write its files at
+        # the same time
+        self._targets = {}
+
+    def source(self, n):
+        with self._lock:
+            if n not in self.sources:
+                self.sources[n] = TMCParser(decompress(self.db.chunks[n]), decompress(self.db.chunks[n+1]))
+                metrics.current.count(source_cache_misses=1)
+            else:
+                metrics.current.count(source_cache_hits=1)
+            return self.sources[n]
+
+    def handle(self, request):
+        match request.get('op', 'inject'):
+            case 'ping':
+                return dict(ok=True)
+            case 'inject':
+                t = time.perf_counter()
+                g, target = self.job(request)
+                for n in (g.src, g.tex_src):
+                    self.source(n)
+                with self._lock:
+                    lock = self._targets.setdefault(target.n, threading.Lock())
+                with lock:
+                    self.inject(self.db, self.sources, self.e_nin_c_cut_dds, g, target, request.get('options', {}))
+                return dict(ok=True, target=target.n, seconds=time.perf_counter()-t)
+            case op:
+                raise ValueError(f'Unknown op {op!r}')
+
+    def job(self, request):
+        n = request['target']
+        g, t = next(( (g, t) for g in self.groups for t in g.targets if t.n == n ), (None, None))
+        if g is None:
+            # The records are those of GROUPS, with every field replaced.
+            g = self.groups[0]
+            fields = [ k for k in g._fields if k != 'targets' ]
+            if missing := [ k for k in fields if k not in request ]:
+                raise ValueError(f'{n} is not a target in GROUPS, and {", ".join(missing)} are not given')
+            g = g._replace(targets = (), **{ k: request[k] for k in fields })
+            return g, self.groups[0].targets[0]._replace(n = n, kwargs = request.get('kwargs', {}))
+        g = g._replace(**{ k: request[k] for k in g._fields if k in request and k != 'targets' })
+        return g, t._replace(kwargs = dict(t.kwargs, **request.get('kwargs', {})))
+
+    def close(self):
+        for x in self.sources.values():
+            x.close()
+        self.db.close()
+        self.e_nin_c_cut_dds.close()
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request.get('op') == 'shutdown':
+                    response = dict(ok=True)
+                    threading.Thread(target=self.server.shutdown).start()
+                else:
+                    response = self.server.injector.handle(request)
+            except Exception as e:
+                response = dict(ok=False, error=f'{type(e).__name__}: {e}')
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+def serve(path, databin, e_nin_c_cut_dds, groups, inject, overlay = None):
+    _unlink_stale(path)
+    daemon = Daemon(databin, e_nin_c_cut_dds, groups, inject, overlay)
+    try:
+        with socketserver.ThreadingUnixStreamServer(path, _Handler) as server:
+            try:
+                server.injector = daemon
+                server.serve_forever()
+            finally:
+                os.unlink(path)
+    finally:
+        daemon.close()
+
+def _unlink_stale(path):
+    # A socket file left by a daemon that didn't exit cleanly is removed, but
+    # not one that is still listened on.
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        else:
+            raise FileExistsError(f'A daemon is already listening on {path}')
+
+def request(path, message):
+    # Sends message (a dict) to the daemon at path and returns its response.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        with s.makefile('rwb') as f:
+            f.write(json.dumps(message).encode() + b'\n')
+            f.flush()
+            return json.loads(f.readline())
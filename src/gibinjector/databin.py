@@ -8,12 +8,24 @@
 from __future__ import annotations
 from typing import NamedTuple
 from contextlib import contextmanager
+import threading
+import ctypes.util
+import ctypes
+import struct
 import zlib
+import mmap
+import os
 
 class DatabinParser:
     chunks: tuple[Chunk]
 
-    def __init__(self, data):
+    def __init__(self, data, index_directory = None):
+        # madvise needs the mmap itself, not a view of it.
+        self._mmap = data if isinstance(data, mmap.mmap) else None
+        # Where the ChunkIndex of large chunks are kept (see index_directory)
+        self.index_directory = index_directory
+        # {chunk index: ChunkIndex or None}
+        self._indices = {}
         data = memoryview(data).toreadonly()
 
         # version = int.from_bytes(data[:4], 'little')
@@ -45,10 +57,10 @@ class DatabinParser:
         chunk_info = tuple( directory[o:o+n] for o in chunk_info_ofs_table )
 
         o = head_size + directory_size
-        self.chunks = tuple(self._gen_chunks(chunk_info, data[o:]))
+        self.chunks = tuple(self._gen_chunks(chunk_info, data[o:], o))
 
     @staticmethod
-    def _gen_chunks(chunk_info, chunkbin):
+    def _gen_chunks(chunk_info, chunkbin, chunkbin_offset):
         for k, i in enumerate(chunk_info):
             offset = int.from_bytes(i[:0x8], 'little')
             decompressed_size = int.from_bytes(i[0x8:0xc], 'little')
@@ -62,9 +74,25 @@ class DatabinParser:
             data = chunkbin[o1:o2]
 
             yield Chunk( k, decompressed_size, compressed_size,
-                         linked_chunk_index, tag1, tag2, data )
+                         linked_chunk_index, tag1, tag2, data,
+                         chunkbin_offset + offset )
+
+    def read(self, index, offset, size):
+        # A memoryview of size bytes at offset of the decompressed chunk.
+        # Chunks of CHUNK_INDEX_THRESHOLD bytes or more are inflated from the
+        # nearest checkpoint of their ChunkIndex, which is loaded from
+        # index_directory, or built and saved there on the first read.
+        c = self.chunks[index]
+        if self.index_directory is None or c.decompressed_size < CHUNK_INDEX_THRESHOLD:
+            return decompress_range(c, offset, size)
+        if index not in self._indices:
+            # Threads may race to load it; the first one stored is kept.
+            self._indices.setdefault(index, ChunkIndex.open(c, self.index_directory))
+        x = self._indices[index]
+        return x.read(c, offset, size) if x else decompress_range(c, offset, size)
 
     def close(self):
+        self._indices.clear()
         for c in self.chunks:
             c.data.release()
 
@@ -82,9 +110,387 @@ class Chunk(NamedTuple):
     tag1: int
     tag2: int
     data: memoryview
+    # Offset of data in databin
+    offset: int
+    # False for loose chunks of OverlayParser, whose data is not deflated
+    compressed: bool = True
+
+class ReadAhead:
+    # Orders pending chunk reads by their offset in databin and keeps the
+    # kernel reading about window bytes of compressed data ahead of them with
+    # madvise. Consumed chunks are dropped from the mapping, so the resident
+    # part of databin stays around one window. Without madvise (e.g. Windows)
+    # it only orders.
+    def __init__(self, db, window = 1<<26):
+        self._db = db
+        self.window = window
+        # {chunk index: [references, advised]}, in the order of reads
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, items, key):
+        # Returns items sorted by the offset of their chunks, key(item) being
+        # the indices of the chunks an item reads.
+        C = self._db.chunks
+        items = sorted(items, key=lambda x: min( C[i].offset for i in key(x) ))
+        with self._lock:
+            for x in items:
+                for i in key(x):
+                    self._pending.setdefault(i, [0, False])[0] += 1
+            self._advise()
+        return items
+
+    def done(self, *indices):
+        C = self._db.chunks
+        with self._lock:
+            for i in indices:
+                x = self._pending.get(i)
+                if x is None:
+                    continue
+                x[0] -= 1
+                if x[0] == 0:
+                    del self._pending[i]
+                    self._madvise('MADV_DONTNEED', C[i])
+            self._advise(C)
+
+    def _advise(self, C = None):
+        C = C or self._db.chunks
+        n = 0
+        for i, x in self._pending.items():
+            if n >= self.window:
+                break
+            c = C[i]
+            n += c.compressed_size
+            if not x[1]:
+                x[1] = True
+                # Inflating reads a chunk front to back.
+                self._madvise('MADV_SEQUENTIAL', c)
+                self._madvise('MADV_WILLNEED', c)
+
+    def _madvise(self, option, c):
+        m = self._db._mmap
+        if m is None or not hasattr(mmap, option) or not c.compressed_size or not c.compressed:
+            return
+        o = c.offset - c.offset % mmap.PAGESIZE
+        m.madvise(getattr(mmap, option), o, c.offset + c.compressed_size - o)
+
+class OverlayParser:
+    # DatabinParser db with chunks overridden by loose files in directory,
+    # named by their indices as the injection writes them (01090.dat). Loose
+    # chunks are mapped as they are and never inflated; the others are read
+    # from db. The overrides are scanned again when the mtime of directory
+    # changes, which files replaced by renaming (as save does) change. On
+    # Windows, where mapped files can't be replaced, loose chunks are read.
+    def __init__(self, db, directory):
+        self._db = db
+        self._mmap = db._mmap
+        self.directory = directory
+        self._mtime = None
+        self._chunks = db.chunks
+        # {chunk index: mmap or bytes}
+        self._loose = {}
+        self._lock = threading.Lock()
+
+    @property
+    def chunks(self):
+        self.refresh()
+        return self._chunks
+
+    def overrides(self):
+        self.refresh()
+        return sorted(self._loose)
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            self._mtime = mtime
+            loose = {}
+            for f in mtime is not None and os.listdir(self.directory) or ():
+                n, ext = os.path.splitext(f)
+                if ext == '.dat' and n.isdigit() and int(n) < len(self._db.chunks):
+                    loose[int(n)] = _map(os.path.join(self.directory, f))
+            C = list(self._db.chunks)
+            for n, m in loose.items():
+                c = C[n]
+                C[n] = Chunk(n, len(m), len(m), c.linked_chunk_index, c.tag1, c.tag2,
+                             memoryview(m).toreadonly(), 0, False)
+            self._loose = loose
+            self._chunks = tuple(C)
+
+    def read(self, index, offset, size):
+        c = self.chunks[index]
+        if not c.compressed:
+            return c.data[offset:offset+size]
+        return self._db.read(index, offset, size)
+
+    def close(self):
+        # The mappings of loose chunks are left to be collected, as parsers
+        # returned (e.g. by load_tmc) may outlive this.
+        self._loose.clear()
+        self._chunks = self._db.chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, trace):
+        self.close()
+
+def _map(path):
+    with open(path, 'rb') as f:
+        if os.name == 'nt' or not os.fstat(f.fileno()).st_size:
+            return f.read()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def with_overlay(db, directory = None):
+    # db with the overrides in directory, or db itself without directory.
+    return directory and OverlayParser(db, directory) or db
 
 def decompress(chunk):
+    if not chunk.compressed:
+        return chunk.data
     try:
         return zlib.decompress(chunk.data)
     except zlib.error:
         return b''
+
+def decompress_range(chunk, offset, size):
+    # A memoryview of size bytes at offset of the decompressed chunk. The
+    # chunk is inflated only up to the end of them, and nothing before them
+    # is kept, so e.g. the first sections of a TMCL are read without
+    # inflating the rest. The inflated bytes aren't copied again.
+    if not chunk.compressed:
+        return chunk.data[offset:offset+size]
+    d = zlib.decompressobj()
+    data = chunk.data
+    end = offset + size
+    out = bytearray()
+    o = 0
+    try:
+        for i in range(0, data.nbytes, 0x10000):
+            x = d.decompress(data[i:i+0x10000])
+            if o + len(x) > offset:
+                out += x[max(0, offset-o):end-o]
+            o += len(x)
+            if o >= end or d.eof:
+                break
+    except zlib.error:
+        return memoryview(b'')
+    return memoryview(out)
+
+def index_directory(databin):
+    # The directory of the ChunkIndex files of databin, next to it.
+    return databin + '.idx'
+
+CHUNK_INDEX_THRESHOLD = 1<<22
+
+class ChunkIndex:
+    # Checkpoints of the inflate state of a chunk, taken at the first deflate
+    # block boundary after every span bytes of the decompressed data, so a
+    # byte range is inflated from the nearest checkpoint instead of the start
+    # (cf. zran.c of zlib). A checkpoint is the position of the block in bits
+    # and the 32 KiB window before it, which primes a raw inflate as its
+    # dictionary.
+    #
+    # The stdlib zlib tells neither where blocks end nor lets an inflate
+    # start at a bit, so indices are built with the zlib library through
+    # ctypes, and a block starting mid byte is read from input shifted to it.
+    # Where the library can't be loaded, no index is built (build returns
+    # None), but saved ones are read all the same.
+    #
+    # An index is saved as one file per chunk, e.g. databin.idx/01091.idx:
+    # a header with what identifies the chunk, (decompressed offset,
+    # compressed offset, bits, window size) of each checkpoint, and the
+    # deflated windows.
+    HEADER = struct.Struct('< 8sQIIII')
+    CHECKPOINT = struct.Struct('< IIII')
+    MAGIC = b'GIBZIDX1'
+
+    def __init__(self, checkpoints):
+        # [(decompressed offset, compressed offset, bits, window)], where the
+        # block starts bits bits before the byte at compressed offset
+        self.checkpoints = checkpoints
+
+    @classmethod
+    def open(cls, chunk, directory, span = 1<<20):
+        # The saved index of chunk, or one built and saved, or None.
+        path = os.path.join(directory, f'{chunk.index:05}.idx')
+        try:
+            with open(path, 'rb') as f:
+                return cls.load(f.read(), chunk)
+        except (OSError, ValueError, struct.error, zlib.error):
+            pass
+        x = cls.build(chunk, span)
+        if x is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with open(path + f'.{os.getpid()}.tmp', 'wb') as f:
+                    f.write(x.dump(chunk))
+                os.replace(path + f'.{os.getpid()}.tmp', path)
+            except OSError:
+                pass
+        return x
+
+    @staticmethod
+    def _key(chunk):
+        # The adler32 of the decompressed data ends the zlib stream.
+        return (chunk.offset, chunk.compressed_size, chunk.decompressed_size,
+                int.from_bytes(chunk.data[-4:], 'big'))
+
+    def dump(self, chunk):
+        W = [ zlib.compress(w) for _, _, _, w in self.checkpoints ]
+        return b''.join((
+            self.HEADER.pack(self.MAGIC, *self._key(chunk), len(W)),
+            *( self.CHECKPOINT.pack(o, i, b, len(w)) for (o, i, b, _), w in zip(self.checkpoints, W) ),
+            *W))
+
+    @classmethod
+    def load(cls, data, chunk):
+        magic, *key, n = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or tuple(key) != cls._key(chunk):
+            raise ValueError('The index is not of the chunk')
+        o = cls.HEADER.size
+        C = [ cls.CHECKPOINT.unpack_from(data, o + cls.CHECKPOINT.size*k) for k in range(n) ]
+        o += cls.CHECKPOINT.size*n
+        checkpoints = []
+        for x, i, b, size in C:
+            checkpoints.append((x, i, b, zlib.decompress(data[o:o+size])))
+            o += size
+        return cls(checkpoints)
+
+    @classmethod
+    def build(cls, chunk, span = 1<<20):
+        z = _libz()
+        if z is None or not chunk.compressed:
+            return None
+        data = chunk.data
+        strm = _ZStream()
+        version = z.zlibVersion()
+        if z.inflateInit2_(ctypes.byref(strm), 15, version, ctypes.sizeof(strm)) != 0:
+            return None
+        window = ctypes.create_string_buffer(0x8000)
+        checkpoints = []
+        total_in = total_out = last = 0
+        try:
+            done = False
+            for i in range(0, data.nbytes, 0x10000):
+                block = ctypes.create_string_buffer(bytes(data[i:i+0x10000]), min(0x10000, data.nbytes-i))
+                strm.next_in = ctypes.cast(block, ctypes.c_void_p)
+                strm.avail_in = len(block)
+                while strm.avail_in and not done:
+                    if not strm.avail_out:
+                        strm.next_out = ctypes.cast(window, ctypes.c_void_p)
+                        strm.avail_out = 0x8000
+                    total_in += strm.avail_in
+                    total_out += strm.avail_out
+                    # Z_BLOCK
+                    ret = z.inflate(ctypes.byref(strm), 5)
+                    total_in -= strm.avail_in
+                    total_out -= strm.avail_out
+                    if ret == 1:
+                        done = True
+                    elif ret != 0:
+                        return None
+                    # At the end of a block that isn't the last
+                    elif strm.data_type & 128 and not strm.data_type & 64 and total_out - last >= span:
+                        k = 0x8000 - strm.avail_out
+                        checkpoints.append((total_out, total_in, strm.data_type & 7,
+                                            window.raw[k:] + window.raw[:k]))
+                        last = total_out
+                if done:
+                    break
+        finally:
+            z.inflateEnd(ctypes.byref(strm))
+        return cls(checkpoints)
+
+    def read(self, chunk, offset, size):
+        k = max(( k for k, c in enumerate(self.checkpoints) if c[0] <= offset ), default=None)
+        if k is None:
+            return decompress_range(chunk, offset, size)
+        o, i, bits, window = self.checkpoints[k]
+        d = zlib.decompressobj(-15, zdict=window)
+        end = offset + size
+        out = bytearray()
+        try:
+            for x in _shifted(chunk.data, i, bits):
+                x = d.decompress(x)
+                if o + len(x) > offset:
+                    out += x[max(0, offset-o):end-o]
+                o += len(x)
+                if o >= end or d.eof:
+                    break
+        except zlib.error:
+            return memoryview(b'')
+        return memoryview(out)
+
+def _shifted(data, i, bits, n = 0x10000):
+    # data from bits bits before byte i on, in blocks of n bytes
+    if not bits:
+        for k in range(i, data.nbytes, n):
+            yield data[k:k+n]
+        return
+    for k in range(i-1, data.nbytes, n):
+        x = int.from_bytes(data[k:k+n+1], 'little') >> (8-bits)
+        yield x.to_bytes(n+1, 'little')[:min(n, data.nbytes-k)]
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint), ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p), ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong),
+    ]
+
+_z = False
+
+def _libz():
+    # The zlib library, or None if there is none to load.
+    global _z
+    if _z is False:
+        try:
+            _z = ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+            _z.zlibVersion.restype = ctypes.c_char_p
+            _z.inflateInit2_.argtypes = (ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int)
+            _z.inflate.argtypes = (ctypes.c_void_p, ctypes.c_int)
+            _z.inflateEnd.argtypes = (ctypes.c_void_p,)
+        except (OSError, AttributeError):
+            _z = None
+    return _z
+
+def decompress_into(chunk, buf):
+    # Inflates chunk into buf, which must have room for decompressed_size
+    # bytes, and returns the number of bytes written.
+    if not chunk.compressed:
+        buf[:chunk.data.nbytes] = chunk.data
+        return chunk.data.nbytes
+    d = zlib.decompressobj()
+    data = chunk.data
+    o = 0
+    try:
+        for i in range(0, data.nbytes, 0x10000):
+            x = d.decompress(data[i:i+0x10000])
+            buf[o:o+len(x)] = x
+            o += len(x)
+            if d.eof:
+                break
+    except zlib.error:
+        return 0
+    return o
+
+def decompress_head(chunk, n):
+    # The first n bytes of the decompressed chunk without inflating the rest.
+    if not chunk.compressed:
+        return bytes(chunk.data[:n])
+    try:
+        return zlib.decompressobj().decompress(chunk.data[:0x1000], n)
+    except zlib.error:
+        return b''
+
+def mmap_open(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,149 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module parses the header and mip chain of DDS textures (TTDL chunks)
+# and reduces textures to a budget: top levels larger than a maximum size and
+# levels beyond a maximum count are dropped. The levels kept are contiguous
+# in the original, so a reduced texture is a new header and a view of them.
+
+from .tcmlib import Gather
+
+from typing import NamedTuple
+import struct
+
+class DDSHeader(NamedTuple):
+    flags: int
+    height: int
+    width: int
+    pitch_or_linear_size: int
+    depth: int
+    mip_count: int
+    pixel_format_flags: int
+    fourcc: bytes
+    bit_count: int
+    caps: int
+    caps2: int
+    # Of the DX10 header; 0 without one
+    dxgi_format: int
+    array_size: int
+
+class DDS(NamedTuple):
+    header: DDSHeader
+    # 128, or 148 with the DX10 header
+    header_nbytes: int
+    # Levels of the surface, largest first
+    mips: tuple[memoryview]
+
+DDSD_PITCH = 0x8
+DDSD_MIPMAPCOUNT = 0x20000
+DDSD_LINEARSIZE = 0x80000
+DDPF_FOURCC = 0x4
+DDSCAPS_COMPLEX = 0x8
+DDSCAPS_MIPMAP = 0x400000
+DDSCAPS2_CUBEMAP = 0x200
+DDSCAPS2_VOLUME = 0x200000
+
+# Bytes of a 4x4 block
+_BLOCK_NBYTES = {
+    b'DXT1': 8, b'DXT2': 16, b'DXT3': 16, b'DXT4': 16, b'DXT5': 16,
+    b'ATI1': 8, b'BC4U': 8, b'BC4S': 8, b'ATI2': 16, b'BC5U': 16, b'BC5S': 16,
+}
+
+# DXGI_FORMAT: bytes of a 4x4 block (BC1-BC7)
+_DXGI_BLOCK_NBYTES = {
+    **dict.fromkeys(range(70, 73), 8), **dict.fromkeys(range(73, 79), 16),
+    **dict.fromkeys(range(79, 82), 8), **dict.fromkeys(range(82, 85), 16),
+    **dict.fromkeys(range(94, 100), 16),
+}
+
+# DXGI_FORMAT: bits of a pixel of common uncompressed formats
+_DXGI_BIT_COUNT = {
+    2: 128, 10: 64, 11: 64, 24: 32, 28: 32, 29: 32, 41: 32,
+    49: 16, 56: 16, 61: 8, 85: 16, 86: 16, 87: 32, 88: 32, 91: 32,
+}
+
+def parse_dds(data):
+    data = memoryview(data).cast('B')
+    if data[:4] != b'DDS ' or data.nbytes < 0x80:
+        raise DDSError('No magic bytes "DDS " found')
+    (
+            size, flags, height, width, pitch_or_linear_size, depth, mip_count,
+    ) = struct.unpack_from('< 7I', data, 0x4)
+    pf_flags, fourcc, bit_count = struct.unpack_from('< I4sI', data, 0x50)
+    caps, caps2 = struct.unpack_from('< II', data, 0x6c)
+    if size != 124:
+        raise DDSError(f'Header size {size} is not 124')
+
+    o = 0x80
+    dxgi_format = array_size = 0
+    if pf_flags & DDPF_FOURCC and fourcc == b'DX10':
+        dxgi_format, _, _, array_size = struct.unpack_from('< 4I', data, o)
+        o += 0x14
+    if caps2 & (DDSCAPS2_CUBEMAP | DDSCAPS2_VOLUME) or array_size > 1:
+        raise DDSError('Cube maps, volumes and arrays are not supported')
+
+    h = DDSHeader(flags, height, width, pitch_or_linear_size, depth,
+                  (flags & DDSD_MIPMAPCOUNT or caps & DDSCAPS_MIPMAP) and mip_count or 1,
+                  pf_flags, fourcc, bit_count, caps, caps2, dxgi_format, array_size)
+    header_nbytes = o
+    mips = []
+    for n in mip_sizes(h):
+        if o + n > data.nbytes:
+            raise DDSError(f'Mip level {len(mips)} is out of the data')
+        mips.append(data[o:o+n])
+        o += n
+    return DDS(h, header_nbytes, tuple(mips))
+
+def mip_sizes(h):
+    return tuple( level_nbytes(h, max(1, h.width >> i), max(1, h.height >> i)) for i in range(h.mip_count) )
+
+def level_nbytes(h, width, height):
+    n = ( h.pixel_format_flags & DDPF_FOURCC and _BLOCK_NBYTES.get(h.fourcc)
+          or _DXGI_BLOCK_NBYTES.get(h.dxgi_format) )
+    if n:
+        return max(1, (width+3)//4) * max(1, (height+3)//4) * n
+    bits = h.fourcc == b'DX10' and _DXGI_BIT_COUNT.get(h.dxgi_format) or h.bit_count
+    if not bits:
+        raise DDSError(f'Unknown format {h.fourcc} {h.dxgi_format}')
+    return (width*bits + 7)//8 * height
+
+def reduce_dds(data, max_size = None, max_mips = None):
+    # Returns the texture with the levels larger than max_size (in pixels, of
+    # the longer side) and those beyond the first max_mips dropped, and the
+    # bytes dropped. It's a Gather of a new header and a view of the levels
+    # kept, or data as it is if nothing is dropped. None is no limit.
+    if max_size is not None and max_size <= 0:
+        raise ValueError(f'max_size {max_size} is not positive')
+    if max_mips is not None and max_mips <= 0:
+        raise ValueError(f'max_mips {max_mips} is not positive')
+    x = parse_dds(data)
+    h = x.header
+    k = 0
+    while max_size is not None and k < h.mip_count-1 and max(h.width >> k, h.height >> k) > max_size:
+        k += 1
+    M = x.mips[k:k+(h.mip_count if max_mips is None else max_mips)]
+    if len(M) == h.mip_count:
+        return data, 0
+
+    width = max(1, h.width >> k)
+    height = max(1, h.height >> k)
+    data = memoryview(data).cast('B')
+    header = bytearray(data[:x.header_nbytes])
+    struct.pack_into('< II', header, 0xc, height, width)
+    struct.pack_into('< I', header, 0x1c, len(M))
+    if h.flags & DDSD_LINEARSIZE:
+        struct.pack_into('< I', header, 0x14, M[0].nbytes)
+    elif h.flags & DDSD_PITCH:
+        struct.pack_into('< I', header, 0x14, level_nbytes(h, width, 1))
+    if len(M) == 1:
+        flags = h.flags & ~DDSD_MIPMAPCOUNT
+        caps = h.caps & ~(DDSCAPS_MIPMAP | DDSCAPS_COMPLEX)
+        struct.pack_into('< I', header, 0x8, flags)
+        struct.pack_into('< I', header, 0x6c, caps)
+
+    # The levels kept are contiguous.
+    o = x.header_nbytes + sum( m.nbytes for m in x.mips[:k] )
+    body = data[o:o+sum( m.nbytes for m in M )]
+    return Gather([header, body]), data.nbytes - len(header) - body.nbytes
+
+class DDSError(Exception):
+    pass
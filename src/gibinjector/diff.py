@@ -0,0 +1,166 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module compares two TMC/TMCL pairs section by section. Every container
+# is hashed as a Merkle tree of its metadata, sub container and chunks, so two
+# models are compared by walking only the subtrees whose digests differ:
+#
+#   TMC -> MdlGeo -> ObjGeo -> GeoDecl
+#   TMC -> LHeader -> TTDL, VtxLay, IdxLay (the bodies of the separated sections)
+#
+# The digest of a Node can also be used as a cache key of its section.
+
+from __future__ import annotations
+
+from .tcmlib import ContainerParser, ParserError
+
+from typing import NamedTuple
+from difflib import SequenceMatcher
+from operator import indexOf
+import hashlib
+import warnings
+
+class Node(NamedTuple):
+    name: str
+    digest: bytes
+    # Bytes of a leaf; empty for containers
+    data: memoryview
+    children: tuple[Node]
+
+class Change(NamedTuple):
+    path: str
+    # 'changed', 'added' or 'removed'
+    kind: str
+    sizes: tuple[int, int]
+    # Differing (start, stop) byte ranges of a changed leaf of the same size
+    ranges: tuple[tuple[int, int]]
+
+def _digest(x):
+    return hashlib.blake2b(x, digest_size=16).digest()
+
+def leaf(name, data):
+    data = memoryview(data)
+    return Node(name, _digest(data), data, ())
+
+def branch(name, children):
+    return Node(name, _digest(b''.join( c.digest for c in children )), memoryview(b''), tuple(children))
+
+def is_container(data):
+    return data.nbytes >= 0x30 and data[8:12] == b'\0\0\1\1'
+
+def container_tree(name, data):
+    # Separated containers have no chunks here; their bodies are in LHeader.
+    if not is_container(data):
+        return leaf(name, data)
+    magic = bytes(data[:8]).rstrip(b'\0')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            c = ContainerParser(magic, data)
+        except (ParserError, ValueError, TypeError):
+            return leaf(name, data)
+    children = [ _layout(c), container_tree(_name(c._metadata, 'metadata'), c._metadata) ]
+    if c._sub_container:
+        children.append(container_tree(_name(c._sub_container, 'sub_container'), c._sub_container))
+    if int.from_bytes(data[0xc:0x10], 'little') != 0x50:
+        children += ( container_tree(_name(x, '') + f'[{i}]', x) for i, x in enumerate(c._chunks) )
+    return branch(name, children)
+
+def _layout(c):
+    # Header and tables of offsets and sizes
+    header_nbytes = int.from_bytes(c._data[0xc:0x10], 'little')
+    return leaf('layout', bytes(c._data[:header_nbytes]) + c._offset_table.tobytes() + c._size_table.tobytes())
+
+def _name(data, default):
+    return is_container(data) and bytes(data[:8]).rstrip(b'\0').decode(errors='replace') or default
+
+_LDATA_SECTIONS = {
+    0xC000_0002: 'TTDL',
+    0xC000_0003: 'VtxLay',
+    0xC000_0004: 'IdxLay',
+}
+
+def tmc_tree(tmc):
+    # tmc is a TMCParser with its TMCL.
+    L = tmc.lheader
+    sections = dict(TTDL=tmc.ttdm and tmc.ttdm.sub_container, VtxLay=tmc.vtxlay, IdxLay=tmc.idxlay)
+    types = L._metadata[0x20:0x20+4*len(L._chunks)].cast('I')
+    lchildren = [ _layout(L), leaf('metadata', L._metadata) ]
+    for i, (t, c) in enumerate(zip(types, L._chunks)):
+        name = _LDATA_SECTIONS.get(t)
+        p = sections.get(name)
+        if not p:
+            lchildren.append(leaf(f'[{i}]', c))
+            continue
+        # The lhead and the chunks of the section in its body
+        lchildren.append(branch(f'{name}[{i}]', [ leaf('lhead', c[:0x10]) ]
+                                + [ leaf(f'[{k}]', x) for k, x in enumerate(p._chunks) ]))
+
+    k = indexOf(tmc._metadata[0xc0:0xc0+4*len(tmc._chunks)].cast('I'), 0x8000_0020)
+    children = [ _layout(tmc), leaf('metadata', tmc._metadata) ]
+    for i, c in enumerate(tmc._chunks):
+        if i == k:
+            children.append(branch(f'LHeader[{i}]', lchildren))
+        else:
+            children.append(container_tree(_name(c, '') + f'[{i}]', c))
+    return branch('TMC', children)
+
+def diff_trees(a, b, path = ''):
+    # Yields the Changes between Nodes a and b.
+    path = path and f'{path}/{a.name}' or a.name
+    if a.digest == b.digest:
+        return
+    if not a.children or not b.children:
+        yield Change(path, 'changed', (a.data.nbytes, b.data.nbytes), _ranges(a.data, b.data))
+        return
+    # Children are aligned by digest, so that inserted chunks don't make the
+    # following ones differ.
+    A = [ x.digest for x in a.children ]
+    B = [ x.digest for x in b.children ]
+    C = []
+    for op, i1, i2, j1, j2 in SequenceMatcher(None, A, B, autojunk=False).get_opcodes():
+        if op == 'equal':
+            continue
+        if op == 'replace' and i2-i1 == j2-j1:
+            for x, y in zip(a.children[i1:i2], b.children[j1:j2]):
+                C.extend(diff_trees(x, y, path))
+            continue
+        C.extend( Change(f'{path}/{x.name}', 'removed', (_nbytes(x), 0), ()) for x in a.children[i1:i2] )
+        C.extend( Change(f'{path}/{x.name}', 'added', (0, _nbytes(x)), ()) for x in b.children[j1:j2] )
+    # The layout follows from the rest, so it's noise unless nothing else changed.
+    if any( not x.path.endswith('/layout') for x in C ):
+        C = [ x for x in C if not x.path.endswith('/layout') ]
+    yield from C
+
+def _nbytes(x):
+    return x.data.nbytes + sum( _nbytes(c) for c in x.children )
+
+def _ranges(a, b, block = 0x40):
+    if a.nbytes != b.nbytes:
+        return ()
+    R = []
+    for o in range(0, a.nbytes, block):
+        if a[o:o+block] == b[o:o+block]:
+            continue
+        for i in range(o, min(o+block, a.nbytes)):
+            if a[i] == b[i]:
+                continue
+            if R and R[-1][1] == i:
+                R[-1][1] = i+1
+            else:
+                R.append([i, i+1])
+    return tuple(map(tuple, R))
+
+def diff_tmc(a, b):
+    # a and b are TMCParsers with their TMCLs.
+    return list(diff_trees(tmc_tree(a), tmc_tree(b)))
+
+def format_change(x, max_ranges = 8):
+    s = f'{x.path}: {x.kind}'
+    if x.kind == 'changed' and x.sizes[0] != x.sizes[1]:
+        s += f' ({x.sizes[0]:#x} -> {x.sizes[1]:#x} bytes)'
+    elif x.kind != 'changed':
+        s += f' ({max(x.sizes):#x} bytes)'
+    if x.ranges:
+        s += ' at ' + ', '.join( f'{i:#x}:{j:#x}' for i, j in x.ranges[:max_ranges] )
+        s += len(x.ranges) > max_ranges and ', ...' or ''
+    return s
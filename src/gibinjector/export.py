@@ -0,0 +1,148 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module exports meshes of a TMC to glTF 2.0 (GLB) and OBJ. It requires NumPy.
+
+from .tcmlib.ngs2 import D3DDECLUSAGE
+from .vertex import decode_element
+
+from typing import NamedTuple
+import json
+import struct
+import numpy as np
+
+# D3DPRIMITIVETYPE
+D3DPT_TRIANGLELIST = 4
+D3DPT_TRIANGLESTRIP = 5
+
+class Primitive(NamedTuple):
+    name: str
+    # D3DPRIMITIVETYPE
+    mode: int
+    positions: np.ndarray
+    normals: np.ndarray | None
+    texcoords: np.ndarray | None
+    # Relative to positions
+    indices: np.ndarray
+    # {TextureUsage name: texture index}
+    textures: dict[str, int]
+
+def gen_primitives(tmc, objects = slice(None)):
+    # Yields (obj_index, Primitive) for every ObjGeo chunk of the objects.
+    chunks = tmc.mdlgeo.chunks
+    for i in range(*objects.indices(len(chunks))):
+        objgeo = chunks[i]
+        for j, c in enumerate(objgeo.chunks):
+            yield i, decode_primitive(tmc, objgeo, c, f'{objgeo.metadata.name.decode()}.{j}')
+
+def decode_primitive(tmc, objgeo, c, name = ''):
+    g = objgeo.sub_container.chunks[c.geodecl_chunk_index]
+    dtype = g.vertex_count < 1<<16 and '<u2' or '<u4'
+    I = np.frombuffer(tmc.idxlay.chunks[g.index_buffer_index], dtype)
+    I = I[c.first_index_index:c.first_index_index+c.index_count]
+    # Only the referenced range of the vertex buffer is decoded.
+    lo = int(I.min()) if I.size else 0
+    hi = int(I.max())+1 if I.size else 0
+    V = np.frombuffer(tmc.vtxlay.chunks[g.vertex_buffer_index], np.uint8)
+    V = V[lo*g.vertex_size:hi*g.vertex_size].reshape(-1, g.vertex_size)
+    E = { (e.usage, e.usage_index): e for e in g.vertex_elements if e.stream == 0 }
+
+    positions = decode_element(V, E[D3DDECLUSAGE.POSITION, 0])[:, :3]
+    normals = (e := E.get((D3DDECLUSAGE.NORMAL, 0))) and decode_element(V, e)[:, :3]
+    if normals is not None:
+        n = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals = normals / np.where(n > 0, n, 1)
+    texcoords = (e := E.get((D3DDECLUSAGE.TEXCOORD, 0))) and decode_element(V, e)[:, :2]
+    textures = { t.usage.name: t.texture_index for t in c.texture_info_table }
+    return Primitive(name, c.primitive_type, positions, normals, texcoords,
+                     (I - lo).astype(np.uint32), textures)
+
+def triangle_list(p):
+    # Triangle list indices of p. Degenerate triangles of strips are dropped.
+    return triangles_of(p.indices, p.mode)
+
+def triangles_of(I, mode):
+    if mode != D3DPT_TRIANGLESTRIP:
+        return I[:len(I) - len(I) % 3].reshape(-1, 3)
+    if len(I) < 3:
+        return I[:0].reshape(0, 3)
+    T = np.stack((I[:-2], I[1:-1], I[2:]), 1)
+    T[1::2, [0, 1]] = T[1::2, [1, 0]]
+    return T[(T[:, 0] != T[:, 1]) & (T[:, 1] != T[:, 2]) & (T[:, 2] != T[:, 0])]
+
+def export_obj(tmc, f, objects = slice(None)):
+    base = 1
+    for i, p in gen_primitives(tmc, objects):
+        f.write(f'o {p.name}\n'.encode())
+        np.savetxt(f, p.positions, 'v %.6f %.6f %.6f')
+        if p.texcoords is not None:
+            np.savetxt(f, p.texcoords * (1, -1) + (0, 1), 'vt %.6f %.6f')
+        if p.normals is not None:
+            np.savetxt(f, p.normals, 'vn %.6f %.6f %.6f')
+        T = triangle_list(p) + base
+        k = (p.texcoords is not None) + 2*(p.normals is not None)
+        fmt = ('{0}', '{0}/{0}', '{0}//{0}', '{0}/{0}/{0}')[k]
+        fmt = 'f ' + ' '.join( fmt.replace('0', str(j)) for j in range(3) )
+        f.write(''.join( fmt.format(*t) + '\n' for t in T.tolist() ).encode())
+        base += len(p.positions)
+
+def export_glb(tmc, f, objects = slice(None)):
+    buffer = bytearray()
+    views = []
+    accessors = []
+
+    def add(a, target, component_type, type_, minmax = False):
+        buffer.extend(bytes(-len(buffer) % 4))
+        views.append(dict(buffer=0, byteOffset=len(buffer), byteLength=a.nbytes, target=target))
+        buffer.extend(a.tobytes())
+        x = dict(bufferView=len(views)-1, componentType=component_type,
+                 count=len(a), type=type_)
+        if minmax:
+            x.update(min=a.min(0).tolist(), max=a.max(0).tolist())
+        accessors.append(x)
+        return len(accessors)-1
+
+    meshes = {}
+    for i, p in gen_primitives(tmc, objects):
+        # An empty accessor can't have min and max, and a primitive without
+        # vertices draws nothing anyway.
+        if not len(p.positions) or not len(p.indices):
+            continue
+        attributes = dict(POSITION=add(p.positions, 34962, 5126, 'VEC3', True))
+        if p.normals is not None:
+            attributes.update(NORMAL=add(p.normals.astype(np.float32), 34962, 5126, 'VEC3'))
+        if p.texcoords is not None:
+            attributes.update(TEXCOORD_0=add(p.texcoords, 34962, 5126, 'VEC2'))
+        primitive = dict(attributes=attributes, indices=add(p.indices, 34963, 5125, 'SCALAR'),
+                         mode=p.mode == D3DPT_TRIANGLESTRIP and 5 or 4,
+                         extras=dict(textures=p.textures))
+        meshes.setdefault(i, []).append(primitive)
+
+    names = [ o.metadata.name.decode() for o in tmc.mdlgeo.chunks ]
+    nodes = [ dict(name=names[i], mesh=k) for k, i in enumerate(meshes) ]
+    scene = list(range(len(nodes)))
+
+    # The skeleton from HieLay, named after NodeLay.
+    if tmc.hielay:
+        n = len(nodes)
+        node_names = [ c.metadata.name.decode() for c in tmc.nodelay.chunks ] if tmc.nodelay else []
+        for i, c in enumerate(tmc.hielay.chunks):
+            x = dict(name=i < len(node_names) and node_names[i] or f'node{i}', matrix=list(c.matrix))
+            if c.children:
+                x.update(children=[ n+k for k in c.children ])
+            nodes.append(x)
+            if c.parent == -1:
+                scene.append(n+i)
+
+    gltf = dict(asset=dict(version='2.0', generator='gibinjector'),
+                scene=0, scenes=[dict(nodes=scene)], nodes=nodes,
+                meshes=[ dict(name=names[i], primitives=p) for i, p in meshes.items() ],
+                accessors=accessors, bufferViews=views,
+                buffers=[dict(byteLength=len(buffer))])
+    j = json.dumps(gltf, separators=(',', ':')).encode()
+    j += b' ' * (-len(j) % 4)
+    buffer.extend(bytes(-len(buffer) % 4))
+    f.write(struct.pack('< 4sII', b'glTF', 2, 12 + 8 + len(j) + 8 + len(buffer)))
+    f.write(struct.pack('< I4s', len(j), b'JSON'))
+    f.write(j)
+    f.write(struct.pack('< I4s', len(buffer), b'BIN\0'))
+    f.write(buffer)
@@ -0,0 +1,109 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module extracts the chunks of TTDL (DDS textures), VtxLay (vertex
+# buffers) and IdxLay (index buffers) of TMCs in databin to files named by
+# their digests, e.g. ttdl/3f2a...c1.dds, so identical blobs are written once
+# however many models have them. Only the TMC is decompressed whole; the
+# chunks are found in the TMCL from it and read with the read of the databin
+# parser, which inflates the TMCL only up to the last section asked for.
+# Chunks are written with os.write straight from the bytes read. Models are
+# processed in parallel; a manifest of which chunk of which model is which
+# file is kept as JSON lines.
+
+from .tcmlib.ngs2 import TMCParser
+from .databin import decompress
+from .summary import select_chunks
+from . import pool
+
+from concurrent.futures import ProcessPoolExecutor
+import warnings
+import hashlib
+import json
+import os
+
+SECTIONS = {
+    'ttdl': '.dds',
+    'vtxlay': '.vb',
+    'idxlay': '.ib',
+}
+
+def ldata_chunks(db, n, tmc, sections = tuple(SECTIONS)):
+    # Yields (section, index, bytes) of the chunks of sections of TMC n of db
+    # (a DatabinParser or OverlayParser), tmc being the TMCParser of its TMC
+    # alone. The TMCL is read once, from the first chunk to the end of the
+    # last.
+    R = []
+    for section in sections:
+        p = section == 'ttdl' and tmc.ttdm and tmc.ttdm.sub_container or getattr(tmc, section)
+        if p:
+            R += ( (section, i, *tmc.ldata_range(section, i)) for i in range(len(p._offset_table)) )
+    R = [ r for r in R if r[3] ]
+    if not R:
+        return
+    lo = min( o for _, _, o, _ in R )
+    data = db.read(n+1, lo, max( o+size for _, _, o, size in R ) - lo)
+    for section, i, o, size in R:
+        yield section, i, data[o-lo:o-lo+size]
+
+def extract_tmc(chunks, output, seen = None):
+    # Writes chunks ((section, index, bytes) as ldata_chunks yields them)
+    # under output, and yields a dict for the manifest for each. seen is a
+    # set of digests already written, to skip them without a system call.
+    seen = set() if seen is None else seen
+    for section, i, c in chunks:
+        if c.nbytes:
+            os.makedirs(os.path.join(output, section), exist_ok=True)
+            h = hashlib.blake2b(c, digest_size=16).hexdigest()
+            f = os.path.join(section, h + SECTIONS[section])
+            written = h not in seen and write_new(os.path.join(output, f), c)
+            seen.add(h)
+            yield dict(section=section, index=i, file=f, nbytes=c.nbytes, written=written)
+
+def write_new(path, data):
+    # Writes data to path unless it exists, and returns whether it's written.
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+    except FileExistsError:
+        return False
+    try:
+        data = memoryview(data).cast('B')
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+    return True
+
+_job = None
+
+def _init_worker(databin, overlay, output, sections):
+    global _job
+    pool.open_databin(databin, overlay)
+    _job = (output, sections, set())
+
+def _extract(n):
+    output, sections, seen = _job
+    if not pool.is_tmc(n):
+        return []
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with TMCParser(decompress(pool.db.chunks[n]), lazy=True) as tmc:
+                name = tmc.metadata.name.decode(errors='replace')
+                C = ldata_chunks(pool.db, n, tmc, sections)
+                return [ dict(chunk=n, name=name, **r) for r in extract_tmc(C, output, seen) ]
+    except Exception as e:
+        return [ dict(chunk=n, error=f'{type(e).__name__}: {e}') ]
+
+def extract(databin, specs, output, sections = tuple(SECTIONS), jobs = None, overlay = None):
+    # Extracts the chunks of sections of the TMCs selected by specs (see
+    # summary.select_chunks) under output, and yields the manifest records in
+    # chunk order, which are also written to output/manifest.jsonl.
+    os.makedirs(output, exist_ok=True)
+    with ( ProcessPoolExecutor(jobs, initializer=_init_worker,
+                               initargs=(databin, overlay, output, tuple(sections))) as ex,
+           open(os.path.join(output, 'manifest.jsonl'), 'w') as f ):
+        chunks = select_chunks(ex, specs, pool.chunk_count(databin))
+        for R in ex.map(_extract, chunks):
+            for r in R:
+                f.write(json.dumps(r) + '\n')
+                yield r
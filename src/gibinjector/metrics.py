@@ -0,0 +1,103 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module counts what a run of the injection reads, inserts and writes,
+# shows its progress, and writes a summary as JSON or in the textfile format
+# of the Prometheus node exporter. The pipeline updates the Metrics in
+# current; worker processes have their own, which are merged by the parent.
+
+from collections import Counter
+import threading
+import json
+import time
+import os
+
+class Metrics:
+    def __init__(self, total = 0, progress = None, label = 'written'):
+        # Counters are e.g. compressed_bytes_read, decompressed_bytes_read,
+        # objects_inserted, textures_inserted, buffers_inserted,
+        # source_cache_hits, texture_dedup_hits, triangles_before and
+        # triangles_after.
+        self.counters = Counter()
+        # {target: bytes written}
+        self.written = {}
+        self.total = total
+        self.progress = progress
+        # What the throughput of progress is of
+        self.label = label
+        self.started = time.monotonic()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def count(self, **counters):
+        with self._lock:
+            self.counters.update(counters)
+
+    def target_done(self, n, nbytes):
+        with self._lock:
+            self.written[n] = nbytes
+            if self.progress:
+                self._print_progress()
+
+    def take(self):
+        # Returns the counters and written bytes so far and resets them, for
+        # worker processes to pass them to the parent's merge.
+        with self._lock:
+            x = dict(self.counters), dict(self.written)
+            self.counters.clear()
+            self.written.clear()
+            return x
+
+    def merge(self, counters, written):
+        self.count(**counters)
+        for n, nbytes in written.items():
+            self.target_done(n, nbytes)
+
+    def _print_progress(self):
+        done = len(self.written)
+        t = time.monotonic() - self.started
+        rate = sum(self.written.values()) / max(t, 1e-9)
+        eta = done and t / done * (self.total - done)
+        end = self.progress.isatty() and '\r' or '\n'
+        if done == self.total and end == '\r':
+            end = '\n'
+        self.progress.write(f'[{done}/{self.total}] {rate/(1<<20):.1f} MiB/s {self.label}, '
+                            f'ETA {int(eta)//60}:{int(eta)%60:02}{end}')
+        self.progress.flush()
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def summary(self):
+        seconds = (self.finished or time.monotonic()) - self.started
+        counters = dict(self.counters, bytes_written=sum(self.written.values()))
+        return dict(seconds = seconds, targets = len(self.written), counters = counters,
+                    bytes_written_per_target = { str(n): x for n, x in sorted(self.written.items()) })
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.summary(), indent=2) + '\n')
+
+    def write_prometheus(self, path):
+        s = self.summary()
+        lines = [ '# TYPE gibinjector_run_seconds gauge',
+                  f'gibinjector_run_seconds {s["seconds"]:.3f}',
+                  '# TYPE gibinjector_targets gauge',
+                  f'gibinjector_targets {s["targets"]}' ]
+        for k, x in sorted(s['counters'].items()):
+            lines += [ f'# TYPE gibinjector_{k}_total counter', f'gibinjector_{k}_total {x}' ]
+        lines.append('# TYPE gibinjector_target_bytes_written gauge')
+        lines += ( f'gibinjector_target_bytes_written{{target="{n}"}} {x}'
+                   for n, x in s['bytes_written_per_target'].items() )
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+def _write_atomically(path, s):
+    # The node exporter may read the file at any time.
+    with open(path + '.tmp', 'w') as f:
+        f.write(s)
+    os.replace(path + '.tmp', path)
+
+current = Metrics()
+
+def start(total = 0, progress = None, label = 'written'):
+    global current
+    current = Metrics(total, progress, label)
+    return current
@@ -0,0 +1,67 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module packs the vertex and index buffers of GeoDecl chunks with the
+# same vertex declaration into shared buffers. Vertex buffers are
+# concatenated, and the indices of each are rebased by the vertices before it,
+# so they stay absolute. The index and vertex ranges of the ObjGeo chunks
+# (first_index_index, first_vertex_index) are moved along, and every GeoDecl
+# chunk sharing a buffer gets its index and vertex counts. A shared buffer is
+# not let grow past 16-bit indices. It requires NumPy.
+
+from .tcmlib import offset_table_of
+from .tcmlib.ngs2 import ObjGeoParser
+
+import struct
+import numpy as np
+
+def pack_buffers(objgeo_chunks, vertex_buffers, index_buffers):
+    # Rewrites objgeo_chunks (bytearrays of ObjGeo containers) in place and
+    # returns the packed vertex buffers, the index buffers at the same
+    # indices, and the index of the buffers of each GeoDecl chunk in order.
+    # The buffers given are in the order of the GeoDecl chunks, as
+    # compact_vertices takes them. The buffer indices in the GeoDecl chunks
+    # are left to the caller.
+    #
+    # [vertex buffer, [index arrays], index count, vertex count, [(GeoDecl view, offset)]]
+    P = []
+    B = []
+    # {vertex declaration: index in P of its current buffer}
+    current = {}
+    buffers = iter(zip(vertex_buffers, index_buffers))
+    for objgeo in objgeo_chunks:
+        o, = struct.unpack_from('< I', objgeo, 0x28)
+        geodecl = memoryview(objgeo)[o:]
+        O = offset_table_of(objgeo)
+        with ObjGeoParser(objgeo) as x:
+            for j, (g, o) in enumerate(zip(x.sub_container.chunks, offset_table_of(geodecl))):
+                vb, ib = next(buffers)
+                key = (g.unknown0x8, g.unknown0x18, g.vertex_size, g.vertex_elements)
+                n = current.get(key)
+                if n is None or P[n][3] + g.vertex_count >= 1<<16:
+                    n = len(P)
+                    P.append([ bytearray(), [], 0, 0, [] ])
+                    if g.vertex_count < 1<<16:
+                        current[key] = n
+                v, indices, first_index, first_vertex, users = P[n]
+                v += memoryview(vb)[:g.vertex_count*g.vertex_size]
+                indices.append(np.frombuffer(ib, _index_dtype(g.vertex_count), g.index_count) + first_vertex)
+                P[n][2] += g.index_count
+                P[n][3] += g.vertex_count
+                users.append((geodecl, o))
+                B.append(n)
+
+                for i, c in enumerate(x.chunks):
+                    if c.geodecl_chunk_index == j:
+                        # first_index_index, first_vertex_index
+                        struct.pack_into('< I', objgeo, O[i]+0x78, c.first_index_index + first_index)
+                        struct.pack_into('< I', objgeo, O[i]+0x80, c.first_vertex_index + first_vertex)
+
+    for _, _, index_count, vertex_count, users in P:
+        for geodecl, o in users:
+            # index_count, vertex_count
+            struct.pack_into('< II', geodecl, o+0x10, index_count, vertex_count)
+    return ( [ x[0] for x in P ],
+             [ bytearray(np.concatenate(x[1]).astype(_index_dtype(x[3])).tobytes()) for x in P ], B )
+
+def _index_dtype(vertex_count):
+    return vertex_count < 1<<16 and '<u2' or '<u4'
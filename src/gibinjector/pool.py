@@ -0,0 +1,25 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module holds the databin of the worker processes of the commands that
+# go through TMCs in parallel (inspect, extract, roundtrip and catalog).
+# open_databin is the initializer of their pools, and the jobs read db.
+
+from .databin import DatabinParser, decompress_head, index_directory, mmap_open, with_overlay
+
+TMC_MAGIC = b'TMC\0\0\0\0\0'
+
+db = None
+
+def open_databin(path, overlay = None):
+    # overlay is a directory of chunks read instead of those in databin (see
+    # databin.OverlayParser).
+    global db
+    db = with_overlay(DatabinParser(mmap_open(path), index_directory(path)), overlay)
+
+def is_tmc(n):
+    # Whether chunk n of db is a TMC, with its TMCL after it.
+    return 0 <= n and n + 1 < len(db.chunks) and decompress_head(db.chunks[n], 8) == TMC_MAGIC
+
+def chunk_count(path):
+    with mmap_open(path) as x, DatabinParser(x) as x:
+        return len(x.chunks)
@@ -0,0 +1,64 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module checks that every container of TMCs round-trips: serialized
+# again from its parts in the layout it was parsed with, it gives back the
+# same bytes. The separated sections (TTDL, VtxLay and IdxLay) are checked
+# with their bodies in the TMCL. Containers that round-trip can be passed
+# through or rebuilt by reserialize without changing the model.
+
+from .tcmlib import ContainerParser, ParserError, reproduces
+from .tcmlib.ngs2 import TMCParser
+from .databin import decompress
+from .diff import is_container
+from .summary import select_chunks
+from . import pool
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import warnings
+
+class Result(NamedTuple):
+    # e.g. 'TMC/MdlGeo[0]/ObjGeo[3]'
+    path: str
+    layout: object
+    ok: bool
+
+def check_tmc(tmc):
+    # Yields a Result for every container of tmc (a TMCParser with its TMCL).
+    L = tmc.lheader
+    ldata = lambda magic: magic == b'LHeader' and L._ldata or getattr(L, magic.decode().lower(), b'')
+    yield from _check('TMC', tmc, ldata)
+
+def _check(path, c, ldata):
+    yield Result(path, c.layout, reproduces(c))
+    parts = [ ('metadata', c._metadata), ('sub_container', c._sub_container) ]
+    if c.layout.header_nbytes != 0x50:
+        parts += ( (f'[{i}]', x) for i, x in enumerate(c._chunks) )
+    for name, x in parts:
+        if not is_container(x):
+            continue
+        magic = bytes(x[:8]).rstrip(b'\0')
+        try:
+            y = ContainerParser(magic, x, ldata(magic))
+        except (ParserError, ValueError, TypeError):
+            continue
+        yield from _check(f'{path}/{magic.decode(errors="replace")}{name[0] == "[" and name or ""}', y, ldata)
+
+def _check_chunk(n):
+    # (chunk, Results that don't round-trip, or an error)
+    if not pool.is_tmc(n):
+        return None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with TMCParser(decompress(pool.db.chunks[n]), decompress(pool.db.chunks[n+1])) as tmc:
+                return n, [ x for x in check_tmc(tmc) if not x.ok ], None
+    except Exception as e:
+        return n, [], f'{type(e).__name__}: {e}'
+
+def check_databin(databin, specs, jobs = None, overlay = None):
+    # Yields (chunk, Results that don't round-trip, error or None) for the
+    # TMCs selected by specs (see summary.select_chunks) in chunk order.
+    with ProcessPoolExecutor(jobs, initializer=pool.open_databin, initargs=(databin, overlay)) as ex:
+        chunks = select_chunks(ex, specs, pool.chunk_count(databin))
+        yield from filter(None, ex.map(_check_chunk, chunks, chunksize=8))
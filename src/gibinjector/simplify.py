@@ -0,0 +1,227 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module simplifies meshes by quadric error edge collapses (Garland and
+# Heckbert) and applies it to the vertex and index buffers of GeoDecl chunks.
+# It requires NumPy.
+#
+# Collapses are done in passes over whole arrays instead of one at a time from
+# a heap. In a pass, every edge gets the cost of collapsing it into the
+# cheaper of its ends, and of the cheaper half of them, those that share no
+# triangle with another are collapsed at once, cheapest first. An edge is
+# collapsed into one of its vertices, so no vertex is made up and every
+# attribute (texcoords, blend weights, ...) is kept as it was. Vertices on
+# borders, which include UV seams and the boundaries between primitives, are
+# never removed, nor are collapses that would fold the mesh or flip a
+# triangle done. The order of a pass is random but fixed, so the output is
+# the same on every run.
+
+from .tcmlib import offset_table_of
+from .tcmlib.ngs2 import D3DDECLUSAGE, ObjGeoParser
+from .export import D3DPT_TRIANGLELIST, triangles_of
+from .vertex import decode_element
+
+from typing import NamedTuple
+import struct
+import numpy as np
+
+def plane_quadrics(positions, triangles):
+    # (N, 4, 4) quadrics of the planes of the triangles around each vertex,
+    # weighted by the areas of the triangles.
+    P = positions[triangles]
+    n = np.cross(P[:, 1] - P[:, 0], P[:, 2] - P[:, 0])
+    area = np.linalg.norm(n, axis=1)
+    n /= np.where(area > 0, area, 1)[:, None]
+    p = np.hstack((n, -np.einsum('ij,ij->i', n, P[:, 0])[:, None]))
+    K = np.einsum('i,ij,ik->ijk', area / 2, p, p)
+    Q = np.zeros((len(positions), 4, 4))
+    for k in range(3):
+        np.add.at(Q, triangles[:, k], K)
+    return Q
+
+def border_vertices(triangles, n):
+    # Vertices on edges that don't have exactly two triangles.
+    a, b, faces = _edges(triangles, n)
+    border = np.zeros(n, bool)
+    border[a[faces != 2]] = border[b[faces != 2]] = True
+    return border
+
+def _edges(triangles, n):
+    # (a, b, the number of triangles) of every edge, a < b
+    E = np.sort(triangles[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), 1)
+    E, faces = np.unique(E[:, 0]*n + E[:, 1], return_counts=True)
+    return E // n, E % n, faces
+
+def simplify(positions, triangles, target_count = 0, max_error = np.inf, locked = None):
+    # Returns triangles (T, 3) simplified until there are no more than
+    # target_count of them or no collapse is within max_error, and the
+    # indices of the input triangles they were. The error is the area
+    # weighted RMS distance of a vertex to the planes it has taken over.
+    # Vertices in locked (an (N,) bool array) are kept.
+    positions = np.asarray(positions, np.float64)
+    triangles = np.asarray(triangles, np.int64).reshape(-1, 3)
+    n = len(positions)
+    Q = plane_quadrics(positions, triangles)
+    P = np.hstack((positions, np.ones((n, 1))))
+    locked = (np.zeros(n, bool) if locked is None else locked) | border_vertices(triangles, n)
+    max_error2 = max_error * max_error
+    ids = np.arange(len(triangles))
+    rng = np.random.default_rng(0)
+
+    while len(triangles) > target_count:
+        a, b, faces = _edges(triangles, n)
+        # The cost of moving a to b and that of moving b to a
+        q = Q[a] + Q[b]
+        trace = np.maximum(np.trace(q[:, :3, :3], axis1=1, axis2=2), 1e-30)
+        ab = np.einsum('ei,eij,ej->e', P[b], q, P[b]) / trace
+        ba = np.einsum('ei,eij,ej->e', P[a], q, P[a]) / trace
+        ab[locked[a]] = np.inf
+        ba[locked[b]] = np.inf
+        swap = ba < ab
+        src = np.where(swap, b, a)
+        dst = np.where(swap, a, b)
+        cost = np.minimum(ab, ba)
+        k = (cost <= max_error2) & np.isfinite(cost)
+        src, dst, cost, faces = src[k], dst[k], cost[k], faces[k]
+        if not len(src):
+            break
+
+        # The cheaper half is tried in a pass, in a random but fixed order: a
+        # collapse is taken if it comes first of those touching any triangle
+        # it touches, so no triangle sees two of them.
+        k = cost <= np.median(cost)
+        src, dst, cost, faces = src[k], dst[k], cost[k], faces[k]
+        m = len(src)
+        order = rng.permutation(m)
+        first = np.full(n, m)
+        np.minimum.at(first, src, order)
+        np.minimum.at(first, dst, order)
+        first = np.repeat(first[triangles].min(1), 3)
+        around = np.full(n, m)
+        np.minimum.at(around, triangles.ravel(), first)
+        i = np.flatnonzero((around[src] == order) & (around[dst] == order))
+
+        # Only as many as needed for target_count, cheapest first; an edge
+        # inside the mesh takes two triangles with it.
+        i = i[np.argsort(cost[i], kind='stable')]
+        i = i[:np.searchsorted(np.cumsum(faces[i]), len(triangles) - target_count) + 1]
+
+        # Collapses of edges whose ends have neighbors in common other than
+        # the corners of the triangles of the edge would fold the mesh, and
+        # those that turn a triangle around them by more than about 75
+        # degrees (or make it degenerate) are undone.
+        i = i[_common_neighbors(a, b, n, src[i], dst[i]) == faces[i]]
+        remap = np.arange(n)
+        remap[src[i]] = dst[i]
+        T = remap[triangles]
+        moved = (T != triangles).any(1) & (T[:, 0] != T[:, 1]) & (T[:, 1] != T[:, 2]) & (T[:, 2] != T[:, 0])
+        flipped = np.einsum('ij,ij->i', _normals(positions, triangles[moved]), _normals(positions, T[moved])) < 0.25
+        bad = triangles[moved][flipped].ravel()
+        i = i[~np.isin(src[i], bad)]
+        if not len(i):
+            break
+        remap = np.arange(n)
+        remap[src[i]] = dst[i]
+        np.add.at(Q, dst[i], Q[src[i]])
+        triangles = remap[triangles]
+        k = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 2] != triangles[:, 0])
+        triangles, ids = triangles[k], ids[k]
+    return triangles, ids
+
+def _common_neighbors(a, b, n, x, y):
+    # The number of vertices adjacent to both x and y for edges (a, b), a < b,
+    # sorted as _edges returns them.
+    U = np.concatenate((a, b))
+    W = np.concatenate((b, a))
+    k = np.argsort(U, kind='stable')
+    U, W = U[k], W[k]
+    lo = np.searchsorted(U, x)
+    count = np.searchsorted(U, x, 'right') - lo
+    rows = np.repeat(np.arange(len(x)), count)
+    c = W[np.arange(count.sum()) - np.repeat(np.cumsum(count) - count - lo, count)]
+    y = y[rows]
+    key = np.minimum(y, c)*n + np.maximum(y, c)
+    keys = a*n + b
+    j = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+    return np.bincount(rows, keys[j] == key, len(x))
+
+def _normals(positions, triangles):
+    # Unit normals; those of degenerate triangles are 0.
+    P = positions[triangles]
+    n = np.cross(P[:, 1] - P[:, 0], P[:, 2] - P[:, 0])
+    return n / np.maximum(np.linalg.norm(n, axis=1, keepdims=True), 1e-30)
+
+class Simplified(NamedTuple):
+    vertex_buffer: bytearray
+    index_buffer: bytearray
+    triangles_before: int
+    triangles_after: int
+
+def simplify_geodecl(objgeo, x, j, vertex_buffer, index_buffer, ratio = None, max_error = None):
+    # Simplifies the primitives of GeoDecl chunk j of objgeo (a bytearray of
+    # an ObjGeo container, parsed as x) together, and rewrites their index
+    # ranges and the counts of the GeoDecl chunk in place. Primitives are
+    # written as triangle lists.
+    g = x.sub_container.chunks[j]
+    E = { (e.usage, e.usage_index): e for e in g.vertex_elements if e.stream == 0 }
+    e = E.get((D3DDECLUSAGE.POSITION, 0))
+    dtype = g.vertex_count < 1<<16 and '<u2' or '<u4'
+    I = np.frombuffer(index_buffer, dtype)
+    C = [ (i, c) for i, c in enumerate(x.chunks) if c.geodecl_chunk_index == j ]
+    n = len(vertex_buffer) // g.vertex_size
+    if e is None or not n or not C:
+        return Simplified(vertex_buffer, index_buffer, 0, 0)
+
+    V = np.frombuffer(vertex_buffer, np.uint8, n*g.vertex_size).reshape(n, g.vertex_size)
+    positions = decode_element(V, e)[:, :3]
+    T = [ triangles_of(I[c.first_index_index:c.first_index_index+c.index_count].astype(np.int64), c.primitive_type)
+          for _, c in C ]
+    primitive = np.repeat(np.arange(len(T)), [ len(t) for t in T ])
+    T = np.concatenate(T)
+    if T.size and T.max() >= n:
+        return Simplified(vertex_buffer, index_buffer, 0, 0)
+    # Vertices shared by primitives are kept, so their boundaries stay closed.
+    owner = np.full(n, -1)
+    owner[T.ravel()] = np.repeat(primitive, 3)
+    locked = np.zeros(n, bool)
+    locked[T.ravel()[owner[T.ravel()] != np.repeat(primitive, 3)]] = True
+
+    target = int(len(T) * ratio) if ratio is not None else 0
+    S, k = simplify(positions, T, target, np.inf if max_error is None else max_error, locked)
+    p = primitive[k]
+    k = np.argsort(p, kind='stable')
+    S, p = S[k], p[k]
+    # Vertices are renumbered in the order they're first used.
+    used, first = np.unique(S.ravel(), return_index=True)
+    used = used[np.argsort(first)]
+    remap = np.empty(n, np.int64)
+    remap[used] = np.arange(len(used))
+    S = remap[S]
+
+    vertex_count = len(used)
+    dtype = vertex_count < 1<<16 and '<u2' or '<u4'
+    o, = struct.unpack_from('< I', objgeo, 0x28)
+    geodecl = memoryview(objgeo)[o:]
+    # index_count, vertex_count
+    struct.pack_into('< II', geodecl, offset_table_of(geodecl)[j]+0x10, S.size, vertex_count)
+    O = offset_table_of(objgeo)
+    for k, (i, _) in enumerate(C):
+        y = S[p == k]
+        lo = int(y.min()) if y.size else 0
+        hi = int(y.max())+1 if y.size else 0
+        # primitive_type
+        struct.pack_into('< I', objgeo, O[i]+0x6c, D3DPT_TRIANGLELIST)
+        # first_index_index, index_count, first_vertex_index, vertex_count
+        struct.pack_into('< II', objgeo, O[i]+0x78, 3*int(np.count_nonzero(p < k)), y.size)
+        struct.pack_into('< II', objgeo, O[i]+0x80, lo, hi - lo)
+    return Simplified(bytearray(V[used].tobytes()), bytearray(S.astype(dtype).tobytes()),
+                      len(T), len(S))
+
+def simplify_objects(objgeo_chunks, vertex_buffers, index_buffers, ratio = None, max_error = None):
+    # Yields the Simplified buffers of every GeoDecl chunk of objgeo_chunks
+    # (bytearrays of ObjGeo containers, rewritten in place). The buffers are
+    # in the order of the GeoDecl chunks, as compact_vertices takes them.
+    B = iter(zip(vertex_buffers, index_buffers))
+    for objgeo in objgeo_chunks:
+        with ObjGeoParser(objgeo) as x:
+            for j in range(len(x.sub_container.chunks)):
+                yield simplify_geodecl(objgeo, x, j, *next(B), ratio, max_error)
@@ -0,0 +1,138 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module summarizes the structure of TMCs in databin: section sizes and
+# chunk counts, object, node, material and texture counts, vertex formats and
+# ldata sizes. Only the TMCs are decompressed, as the ldata sizes are in the
+# tables of LHeader, and sections are parsed lazily.
+
+from .tcmlib.ngs2 import TMCParser, D3DDECLTYPE
+from .databin import decompress, decompress_head
+from . import pool
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from fnmatch import fnmatchcase
+import warnings
+import struct
+
+_SECTIONS = {
+    0x8000_0001: 'MdlGeo',
+    0x8000_0002: 'TTDM',
+    0x8000_0003: 'VtxLay',
+    0x8000_0004: 'IdxLay',
+    0x8000_0005: 'MtrCol',
+    0x8000_0006: 'MdlInfo',
+    0x8000_0010: 'HieLay',
+    0x8000_0020: 'LHeader',
+    0x8000_0030: 'NodeLay',
+    0x8000_0040: 'GlblMtx',
+    0x8000_0050: 'BnOfsMtx',
+    0x8000_0060: 'CPF',
+    0x8000_0070: 'MCAPACK',
+    0x8000_0080: 'RENPACK',
+}
+
+def summarize_tmc(data):
+    # Returns a dict of the summary of a TMC, which can be dumped to JSON.
+    # Separated sections are parsed without their ldata, which warns.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with TMCParser(data, lazy=True) as tmc:
+            return _summarize_tmc(tmc)
+
+def _summarize_tmc(tmc):
+    types = tmc._metadata[0xc0:0xc0+4*len(tmc._chunks)].cast('I')
+    sections = {}
+    for t, c in zip(types, tmc._chunks):
+        name = _SECTIONS.get(t, f'{t:#x}')
+        n = int.from_bytes(c[0x14:0x18], 'little') if c.nbytes >= 0x30 else 0
+        sections[name] = dict(nbytes=c.nbytes, chunks=n)
+
+    L = tmc.lheader
+    ltypes = L._metadata[0x20:0x20+4*len(L._chunks)].cast('I')
+    ldata = { t == 0xC000_0002 and 'TTDL' or _SECTIONS.get(t ^ 0x4000_0000, f'{t:#x}'): n
+              for t, n in zip(ltypes, L._size_table) }
+
+    formats = Counter()
+    objects = tmc.mdlgeo.chunks if tmc.mdlgeo else ()
+    for o in objects:
+        for g in o.sub_container.chunks:
+            formats[vertex_format(g)] += g.vertex_count
+
+    return dict(
+        name = tmc.metadata.name.decode(errors='replace'),
+        nbytes = tmc._data.nbytes,
+        ldata_nbytes = int.from_bytes(L._data[0x44:0x48], 'little'),
+        objects = len(objects),
+        nodes = len(tmc.nodelay.chunks) if tmc.nodelay else 0,
+        materials = len(tmc.mtrcol._chunks) if tmc.mtrcol else 0,
+        textures = len(tmc.ttdm.metadata.chunks) if tmc.ttdm else 0,
+        sections = sections,
+        ldata = ldata,
+        # {format: number of vertices}
+        vertex_formats = dict(formats),
+    )
+
+def vertex_format(g):
+    # e.g. '36: POSITION0 FLOAT3, NORMAL0 FLOAT3, TEXCOORD0 FLOAT2'
+    E = ( f'{e.usage.name}{e.usage_index} {e.d3d_decl_type.name}'
+          for e in g.vertex_elements if e.d3d_decl_type != D3DDECLTYPE.UNUSED )
+    return f'{g.vertex_size}: ' + ', '.join(E)
+
+def _tmc_name(n):
+    # The name in the metadata of TMC n, or None if it's not a TMC.
+    x = decompress_head(pool.db.chunks[n], 0x100)
+    if x[:8] != pool.TMC_MAGIC or len(x) < 0x100:
+        return None
+    o = int.from_bytes(x[0xc:0x10], 'little') + 0x20
+    return struct.unpack_from('10s', x, o)[0].partition(b'\0')[0].decode(errors='replace')
+
+def _names(chunks):
+    return [ (n, x) for n in chunks if (x := _tmc_name(n)) is not None ]
+
+def _summarize(n):
+    if not pool.is_tmc(n):
+        return None
+    try:
+        return dict(chunk=n, **summarize_tmc(decompress(pool.db.chunks[n])))
+    except Exception as e:
+        return dict(chunk=n, error=f'{type(e).__name__}: {e}')
+
+def select_chunks(ex, specs, count, batch = 64):
+    # specs are chunk numbers (1090), ranges (1090-1100, inclusive) or name
+    # patterns (e_nin_*) matched against the names of every TMC. ex is a pool
+    # initialized by pool.open_databin.
+    chunks = []
+    patterns = []
+    for s in specs:
+        a, _, b = s.partition('-')
+        if a.isdigit() and (not b or b.isdigit()):
+            chunks.extend(range(int(a), int(b or a)+1))
+        else:
+            patterns.append(s)
+    if patterns:
+        batches = [ range(i, min(i+batch, count)) for i in range(0, count, batch) ]
+        for R in ex.map(_names, batches):
+            chunks.extend( n for n, x in R if any( fnmatchcase(x, p) for p in patterns ) )
+    return sorted(set(chunks))
+
+def summarize(databin, specs, jobs = None, overlay = None):
+    # Yields summaries of the TMCs selected by specs in chunk order. Chunks
+    # that aren't TMCs are skipped. overlay is a directory of chunks read
+    # instead of those in databin (see databin.OverlayParser).
+    with ProcessPoolExecutor(jobs, initializer=pool.open_databin, initargs=(databin, overlay)) as ex:
+        chunks = select_chunks(ex, specs, pool.chunk_count(databin))
+        yield from filter(None, ex.map(_summarize, chunks, chunksize=8))
+
+TABLE_COLUMNS = ('chunk', 'name', 'nbytes', 'ldata_nbytes', 'objects', 'nodes', 'materials', 'textures')
+
+def format_table(summaries):
+    # Vertex formats are listed under each TMC with their numbers of vertices.
+    yield ' '.join(f'{x:>12}' for x in TABLE_COLUMNS)
+    for s in summaries:
+        if 'error' in s:
+            yield f'{s["chunk"]:>12} {s["error"]}'
+            continue
+        yield ' '.join( f'{s[x]:>12}' for x in TABLE_COLUMNS )
+        for f, n in s['vertex_formats'].items():
+            yield f'{"":>12} {n:>12}  {f}'
@@ -1 +1,2 @@
 from .parser import *
+from .hierarchy import *
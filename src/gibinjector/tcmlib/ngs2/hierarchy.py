@@ -0,0 +1,201 @@
+# Ninja Gaiden Sigma 2 TMC Importer by Nozomi Miyamori is under the public domain
+# and also marked with CC0 1.0. This file is a part of Ninja Gaiden Sigma 2 TMC Importer.
+#
+# The node hierarchy of HieLay and NodeLay, whose i-th chunks are the same
+# node, as flat lists. Nodes are inserted, removed and reparented in bulk, and
+# every reference to them (parents, children and node groups) is renumbered
+# in one pass. The result is serialized back to both sections.
+
+from ..parser import ContainerParser
+from ..serializer import serialize_container, offset_table_of
+
+import struct
+
+__all__ = ['Hierarchy']
+
+class Hierarchy:
+    def __init__(self, hielay, nodelay):
+        self.parent = [ c.parent for c in hielay.chunks ]
+        self.children = [ list(c.children) for c in hielay.chunks ]
+        self.level = [ c.level for c in hielay.chunks ]
+        self.names = [ c.metadata.name for c in nodelay.chunks ]
+        self.obj_index = [ c.chunks[0].obj_index if c.chunks else -1 for c in nodelay.chunks ]
+        self.node_groups = [ list(c.chunks and c.chunks[0].node_group or ()) for c in nodelay.chunks ]
+        # The records the lists above are packed into
+        self._hielay = [ bytes(c) for c in hielay._chunks ]
+        self._nodelay = [ bytes(c) for c in nodelay._chunks ]
+        self._hielay_sub_container = bytes(hielay._sub_container)
+        self._nodelay_metadata = bytes(nodelay._metadata)
+        self._index = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def root(self):
+        return self.parent.index(-1)
+
+    def index(self, name):
+        # The first node named name (bytes).
+        return self._build_index()[0][name]
+
+    def prefix_range(self, prefix):
+        # The nodes whose names start with prefix (b'MOT', b'WGT', b'SUP',
+        # b'OPT', b'WPB', ...), which are contiguous. KeyError if there are
+        # none, as there is no place to tell where they would be.
+        first, last = self._build_index()[1][prefix[:3]]
+        return range(first, last+1)
+
+    def _build_index(self):
+        if self._index is None:
+            names = {}
+            prefixes = {}
+            for i, x in enumerate(self.names):
+                names.setdefault(x, i)
+                first, _ = prefixes.get(x[:3], (i, i))
+                prefixes[x[:3]] = (first, i)
+            self._index = (names, prefixes)
+        return self._index
+
+    def insert(self, i, other, nodes, parent = None, obj_index = None):
+        # Inserts nodes (a slice or range of the nodes of the Hierarchy other)
+        # at i. Nodes whose parent isn't inserted with them go under parent
+        # (the root by default). Node groups referring to nodes out of nodes
+        # are left as they are. If obj_index is given, the objects of the
+        # nodes are taken as inserted there in the same order, and the objects
+        # at or after it are shifted.
+        if isinstance(nodes, slice):
+            nodes = range(len(other))[nodes]
+        n = len(nodes)
+        parent = self.root() if parent is None else parent
+        m = { k: i+j for j, k in enumerate(nodes) }
+        shift = lambda k: k + n*(k >= i)
+        tops = [ k for k in nodes if other.parent[k] not in m ]
+        d = self.level[parent] + 1 - min(( other.level[k] for k in tops ), default=0)
+
+        P = [ p == -1 and -1 or shift(p) for p in self.parent ]
+        C = [ [ shift(k) for k in x ] for x in self.children ]
+        G = [ [ shift(k) for k in x ] for x in self.node_groups ]
+        O = self.obj_index
+        if obj_index is not None:
+            O = [ o + n*(o >= obj_index) for o in O ]
+        parent = shift(parent)
+
+        P[i:i] = ( m.get(other.parent[k], parent) for k in nodes )
+        C[i:i] = ( [ m[x] for x in other.children[k] if x in m ] for k in nodes )
+        G[i:i] = ( [ m.get(x, x) for x in other.node_groups[k] ] for k in nodes )
+        O[i:i] = ( other.obj_index[k] if obj_index is None else obj_index+j for j, k in enumerate(nodes) )
+        self.level[i:i] = ( other.level[k] + d for k in nodes )
+        C[parent] = sorted(C[parent] + [ m[k] for k in tops ])
+
+        self.parent, self.children, self.node_groups, self.obj_index = P, C, G, O
+        self.names[i:i] = ( other.names[k] for k in nodes )
+        self._hielay[i:i] = ( other._hielay[k] for k in nodes )
+        self._nodelay[i:i] = ( other._nodelay[k] for k in nodes )
+        self._index = None
+
+    def remove(self, nodes):
+        # Removes nodes. Their children that are left go under the nearest
+        # ancestor that is left, and node groups lose the removed nodes.
+        R = set(nodes)
+        m = []
+        n = 0
+        for k in range(len(self)):
+            m.append(k in R and -1 or n)
+            n += k not in R
+
+        def up(p):
+            while p != -1 and p in R:
+                p = self.parent[p]
+            return p
+
+        keep = [ k for k in range(len(self)) if k not in R ]
+        P = [ (p := up(self.parent[k])) == -1 and -1 or m[p] for k in keep ]
+        C = [ [ m[x] for x in self.children[k] if x not in R ] for k in keep ]
+        for k, (j, p) in zip(keep, enumerate(P)):
+            if self.parent[k] in R and p != -1:
+                C[p].append(j)
+
+        self.parent = P
+        self.children = [ sorted(x) for x in C ]
+        self.level = self._levels(P)
+        self.node_groups = [ [ m[x] for x in self.node_groups[k] if x not in R ] for k in keep ]
+        self.obj_index = [ self.obj_index[k] for k in keep ]
+        self.names = [ self.names[k] for k in keep ]
+        self._hielay = [ self._hielay[k] for k in keep ]
+        self._nodelay = [ self._nodelay[k] for k in keep ]
+        self._index = None
+
+    def reparent(self, node, parent):
+        # Moves node and its descendants under parent, which must not be one
+        # of them.
+        k = parent
+        while k != -1:
+            if k == node:
+                raise ValueError(f'{parent} is {node} or a descendant of it')
+            k = self.parent[k]
+        p = self.parent[node]
+        if p != -1:
+            self.children[p].remove(node)
+        self.parent[node] = parent
+        if parent != -1:
+            self.children[parent] = sorted(self.children[parent] + [node])
+        d = (parent != -1 and self.level[parent] + 1 or 0) - self.level[node]
+        self._shift_levels(self.level, self.children, node, d)
+
+    @staticmethod
+    def _levels(parent):
+        # The depth of each node, from its ancestors in parent.
+        levels = [None] * len(parent)
+        for k in range(len(parent)):
+            path = []
+            while k != -1 and levels[k] is None:
+                path.append(k)
+                k = parent[k]
+            l = k == -1 and -1 or levels[k]
+            for k in reversed(path):
+                l += 1
+                levels[k] = l
+        return levels
+
+    @staticmethod
+    def _shift_levels(levels, children, node, d):
+        stack = [node]
+        while d and stack:
+            k = stack.pop()
+            levels[k] += d
+            stack += children[k]
+
+    def hielay_chunks(self):
+        for r, p, C, l in zip(self._hielay, self.parent, self.children, self.level):
+            c = bytearray(r[:0x50].ljust(0x50, b'\0'))
+            struct.pack_into('< iII', c, 0x40, p, len(C), l)
+            c += struct.pack(f'< {len(C)}i', *C)
+            yield c
+
+    def nodelay_chunks(self):
+        for i, (r, o, G) in enumerate(zip(self._nodelay, self.obj_index, self.node_groups)):
+            c = bytearray(r)
+            # node index
+            struct.pack_into('< i', c, 0x38, i)
+            T = offset_table_of(c)
+            if not T:
+                yield c
+                continue
+            p, = T
+            n, = struct.unpack_from('< 4xI', c, p)
+            if n != len(G):
+                # The node group doesn't fit, so the NodeObj is rebuilt.
+                x = ContainerParser(b'NodeObj', r)
+                chunk = bytearray(x._chunks[0][:0x50]) + struct.pack(f'< {len(G)}i', *G)
+                c = serialize_container(b'NodeObj', [chunk], x._metadata)
+                struct.pack_into('< i', c, 0x38, i)
+                p, = offset_table_of(c)
+            # obj index, node count, node index and node group
+            struct.pack_into('< iIi', c, p, o, len(G), i)
+            struct.pack_into(f'< {len(G)}i', c, p+0x50, *G)
+            yield c
+
+    def serialize(self):
+        # Returns HieLay and NodeLay.
+        return ( serialize_container(b'HieLay', self.hielay_chunks(), b'', self._hielay_sub_container),
+                 serialize_container(b'NodeLay', self.nodelay_chunks(), self._nodelay_metadata) )
@@ -0,0 +1,66 @@
+# Ninja Gaiden Sigma 2 TMC Importer by Nozomi Miyamori is under the public domain
+# and also marked with CC0 1.0. This file is a part of Ninja Gaiden Sigma 2 TMC Importer.
+#
+# Columnar access to the 0xd0 bytes material records of MtrCol and MTRLCHNG.
+# This module requires NumPy.
+
+import numpy as np
+
+MATERIAL_DTYPE = np.dtype(dict(
+    names = ['mix', 'diffuse', 'specular',
+             'specular_emission_power', 'diffuse_emission_power', 'coat', 'sheen'],
+    formats = ['<4f4', '<4f4', '<4f4', '<f4', '<f4', '<4f4', '<4f4'],
+    offsets = [0x0, 0x10, 0x20, 0x68, 0x6c, 0x80, 0x90],
+    itemsize = 0xd0,
+))
+
+class MaterialTable:
+    # records is an array of MATERIAL_DTYPE; for MTRLCHNG it's shaped
+    # (variant_count, element_count). Fields are accessed by name, e.g.
+    # table['diffuse'][..., :3] *= (1.0, 0.2, 0.2)
+    def __init__(self, records):
+        self.records = records
+
+    @classmethod
+    def from_mtrcol(cls, mtrcol):
+        # MtrCol chunks have xrefs after each record, so they're copied. The
+        # bytes are copied rather than the array, whose copy would zero those
+        # out of the fields.
+        return cls(np.frombuffer(bytearray(b''.join( c[:0xd0] for c in mtrcol._chunks )), MATERIAL_DTYPE))
+
+    @classmethod
+    def from_mtrlchng(cls, mtrlchng, copy = True):
+        # Without copy, records are a read-only view over the chunk.
+        m = mtrlchng.metadata.variant_count
+        n = mtrlchng.metadata.element_count
+        c = mtrlchng._chunks[2][:0xd0*m*n]
+        return cls(np.frombuffer(bytearray(c) if copy else c, MATERIAL_DTYPE).reshape(m, n))
+
+    def __getitem__(self, key):
+        return self.records[key]
+
+    def __setitem__(self, key, value):
+        self.records[key] = value
+
+    def __len__(self):
+        return len(self.records)
+
+    def tobytes(self):
+        # Records back to back, which is the layout of MTRLCHNG chunk 2.
+        return self.records.tobytes()
+
+    def mtrcol_chunks(self, mtrcol):
+        # MtrCol chunks of mtrcol with the records replaced, for serialize_container.
+        C = [ bytearray(c) for c in mtrcol._chunks ]
+        b = memoryview(self.tobytes())
+        for i, c in enumerate(C):
+            c[:0xd0] = b[0xd0*i:0xd0*(i+1)]
+        return C
+
+    def mtrlchng_chunks(self, mtrlchng):
+        # MTRLCHNG chunks of mtrlchng with the records replaced, for serialize_container.
+        C = list(mtrlchng._chunks)
+        c = C[2] = bytearray(C[2])
+        b = self.tobytes()
+        c[:len(b)] = b
+        return C
@@ -9,10 +9,16 @@ from typing import NamedTuple
 from enum import IntEnum
 from operator import indexOf
 import struct
+import threading
+import ctypes
 
 class TMCParser(ContainerParser):
-    def __init__(self, data, ldata = b''):
+    # With lazy, sections are parsed on first access.
+    def __init__(self, data, ldata = b'', lazy = False):
         super().__init__(b'TMC', data)
+        self._lazy = lazy
+        self._pending = {}
+        self._lock = threading.Lock()
 
         (
                 _, _, _,
@@ -31,25 +37,25 @@ class TMCParser(ContainerParser):
         for t, c in zip(tbl, self._chunks):
             match t:
                 case 0x8000_0001:
-                    self.mdlgeo = c and MdlGeoParser(c, getattr(self.lheader, 'mdlgeo', b''))
+                    self._add_section('mdlgeo', MdlGeoParser, c)
                 case 0x8000_0002:
-                    self.ttdm = c and TTDMParser(c, getattr(self.lheader, 'ttdl', b''))
+                    self._add_section('ttdm', TTDMParser, c, 'ttdl')
                 case 0x8000_0003:
-                    self.vtxlay = c and VtxLayParser(c, getattr(self.lheader, 'vtxlay', b''))
+                    self._add_section('vtxlay', VtxLayParser, c)
                 case 0x8000_0004:
-                    self.idxlay = c and IdxLayParser(c, getattr(self.lheader, 'idxlay', b''))
+                    self._add_section('idxlay', IdxLayParser, c)
                 case 0x8000_0005:
-                    self.mtrcol = c and MtrColParser(c, getattr(self.lheader, 'mtrcol', b''))
+                    self._add_section('mtrcol', MtrColParser, c)
                 case 0x8000_0006:
-                    self.mdlinfo = c and MdlInfoParser(c, getattr(self.lheader, 'mdlinfo', b''))
+                    self._add_section('mdlinfo', MdlInfoParser, c)
                 case 0x8000_0010:
-                    self.hielay = c and HieLayParser(c, getattr(self.lheader, 'hielay', b''))
+                    self._add_section('hielay', HieLayParser, c)
                 case 0x8000_0030:
-                    self.nodelay = c and NodeLayParser(c, getattr(self.lheader, 'nodelay', b''))
+                    self._add_section('nodelay', NodeLayParser, c)
                 case 0x8000_0040:
-                    self.glblmtx = c and GlblMtxParser(c, getattr(self.lheader, 'glblmtx', b''))
+                    self._add_section('glblmtx', GlblMtxParser, c)
                 case 0x8000_0050:
-                    self.bnofsmtx = c and BnOfsMtxParser(c, getattr(self.lheader, 'bnofsmtx', b''))
+                    self._add_section('bnofsmtx', BnOfsMtxParser, c)
                 case 0x8000_0060:
                     self.cpf = c
                 case 0x8000_0070:
@@ -57,19 +63,61 @@ class TMCParser(ContainerParser):
                 case 0x8000_0080:
                     self.renpack = c
 
+    def _add_section(self, name, parser, c, lname = None):
+        if not c:
+            setattr(self, name, c)
+            return
+        f = lambda: parser(c, getattr(self.lheader, lname or name, b''))
+        if self._lazy:
+            self._pending[name] = f
+        else:
+            setattr(self, name, f())
+
+    def __getattr__(self, name):
+        # Only called for attributes not set yet, i.e. pending sections. The
+        # lock keeps threads sharing the parser from parsing a section twice.
+        if '_lock' not in self.__dict__:
+            raise AttributeError(name)
+        with self._lock:
+            if name in self.__dict__:
+                return self.__dict__[name]
+            f = self._pending.pop(name, None)
+            if f is None:
+                raise AttributeError(name)
+            x = f()
+            setattr(self, name, x)
+            return x
+
+    def ldata_range(self, section, i):
+        # (offset, size) of chunk i of section ('ttdl', 'vtxlay' or 'idxlay')
+        # in the TMCL. It only needs the TMC, so that the chunk can be read
+        # without decompressing the whole TMCL.
+        L = self.lheader
+        n = len(L._offset_table)
+        k = indexOf(L._metadata[0x20:0x20+4*n].cast('I'), _LDATA_TYPES[section])
+        p = section == 'ttdl' and self.ttdm.sub_container or getattr(self, section)
+        return L._offset_table[k] + p._offset_table[i], p._size_table[i]
+
     def close(self):
         super().close()
         self.lheader.close()
-        (x := getattr(self, 'mdlgeo', None)) and x.close()
-        (x := getattr(self, 'ttdm', None)) and x.close()
-        (x := getattr(self, 'vtxlay', None)) and x.close()
-        (x := getattr(self, 'idxlay', None)) and x.close()
-        (x := getattr(self, 'mtrcol', None)) and x.close()
-        (x := getattr(self, 'mdlinfo', None)) and x.close()
-        (x := getattr(self, 'hielay', None)) and x.close()
-        (x := getattr(self, 'nodelay', None)) and x.close()
-        (x := getattr(self, 'glblmtx', None)) and x.close()
-        (x := getattr(self, 'bnofsmtx', None)) and x.close()
+        self._pending.clear()
+        (x := self.__dict__.get('mdlgeo', None)) and x.close()
+        (x := self.__dict__.get('ttdm', None)) and x.close()
+        (x := self.__dict__.get('vtxlay', None)) and x.close()
+        (x := self.__dict__.get('idxlay', None)) and x.close()
+        (x := self.__dict__.get('mtrcol', None)) and x.close()
+        (x := self.__dict__.get('mdlinfo', None)) and x.close()
+        (x := self.__dict__.get('hielay', None)) and x.close()
+        (x := self.__dict__.get('nodelay', None)) and x.close()
+        (x := self.__dict__.get('glblmtx', None)) and x.close()
+        (x := self.__dict__.get('bnofsmtx', None)) and x.close()
+
+_LDATA_TYPES = {
+    'ttdl': 0xC000_0002,
+    'vtxlay': 0xC000_0003,
+    'idxlay': 0xC000_0004,
+}
 
 class TMCMetaData(NamedTuple):
     #unknown0x0: int
@@ -152,7 +200,8 @@ class ObjGeoChunk(NamedTuple):
 
     #address0x60
     unknown0x68: int # 1
-    unknown0x6c: int # 5
+    # D3DPRIMITIVETYPE (4, list; 5, strip), as the game draws the range
+    primitive_type: int # 5
 
     unknown0x70: int # 1
     show_backface: bool
@@ -329,6 +378,9 @@ class TTDMParser(ContainerParser):
         super().__init__(b'TTDM', data)
         self.metadata = TTDHParser(self._metadata)
         self.sub_container = TTDLParser(self._sub_container, ldata)
+        # Texture slots resolved through TTDH.
+        self.textures = tuple( (c.in_ttdl and self.sub_container or self)._chunks[c.chunk_index]
+                               for c in self.metadata.chunks )
 
     def close(self):
         super().close()
@@ -442,6 +494,9 @@ class HieLayParser(ContainerParser):
             children = struct.unpack_from(f'< {children_count}i', c, 0x50)
             yield HieLayChunk(matrix, parent, level, children)
 
+    def matrices(self):
+        return matrix_array(self, 0)
+
 class HieLaySubContainer(NamedTuple):
     #unknown0x0: int # 1
     #unknown0x10: int # 2
@@ -499,6 +554,13 @@ class NodeLayParser(ContainerParser):
         for c in self.chunks:
             c.close()
 
+    def matrices(self):
+        # The NodeObj containers differ in size, so their matrices are at no
+        # fixed stride and are gathered into a new buffer; NodeObjParser.matrix
+        # is the view of one. Nodes without a chunk have a zero matrix.
+        z = bytes(0x40)
+        return _cast_matrices(b''.join( c._chunks and c._chunks[0][0x10:0x50] or z for c in self.chunks ))
+
 class NodeLayMetaData(NamedTuple):
     #unknown0x0: int # 1
     #unknown0x2: int # 2
@@ -518,6 +580,11 @@ class NodeObjParser(ContainerParser):
             node_group = struct.unpack_from(f'< {node_count}i', c, 0x50)
             self.chunks = (NodeObjChunk(obj_index, node_index, matrix, node_group),)
 
+    def matrix(self):
+        # The float32 memoryview shaped (4, 4) of the matrix in the container,
+        # or None without a chunk.
+        return self._chunks and self._chunks[0][0x10:0x50].cast('f', (4, 4)) or None
+
 class NodeObjMetaData(NamedTuple):
     #unknown0x0: int
     master: int
@@ -535,11 +602,40 @@ class GlblMtxParser(ContainerParser):
         super().__init__(b'GlblMtx', data)
         self.chunks = tuple( struct.unpack_from('< 16f', c) for c in self._chunks )
 
+    def matrices(self):
+        return matrix_array(self, 0)
+
 class BnOfsMtxParser(ContainerParser):
     def __init__(self, data, ldata = b''):
         super().__init__(b'BnOfsMtx', data)
         self.chunks = tuple( struct.unpack_from('< 16f', c) for c in self._chunks )
 
+    def matrices(self):
+        return matrix_array(self, 0)
+
+def matrix_array(parser, offset):
+    # Returns the 4x4 matrices at offset of each chunk of parser as one
+    # float32 memoryview shaped (N, 4, 4), e.g. numpy.asarray() takes it as is.
+    # When the matrices are packed back to back, e.g. GlblMtx and BnOfsMtx, the
+    # view refers to the container without copying; otherwise the matrices are
+    # gathered into a new buffer.
+    C = parser._chunks
+    T = parser._offset_table
+    n = len(C)
+    if ( n and not parser._ldata and len(T) == n and all( c.nbytes >= offset+0x40 for c in C )
+         and all( T[i] == T[0] + 0x40*i for i in range(n) ) ):
+        o = T[0] + offset
+        return _cast_matrices(parser._data[o:o+0x40*n])
+    return _cast_matrices(b''.join( c[offset:offset+0x40] for c in C ))
+
+def _cast_matrices(data):
+    data = memoryview(data)
+    if not data.nbytes:
+        # memoryview can't be cast to a shape with zeros, but ctypes arrays
+        # can have one.
+        return memoryview((ctypes.c_float * 4 * 4 * 0)())
+    return data.cast('f', (data.nbytes // 0x40, 4, 4))
+
 # NGS2 specific data parsers below
 
 class MTRLCHNGParser(ContainerParser):
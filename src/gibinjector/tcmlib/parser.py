@@ -1,6 +1,7 @@
 # Ninja Gaiden Sigma 2 TMC Importer by Nozomi Miyamori is under the public domain
 # and also marked with CC0 1.0. This file is a part of Ninja Gaiden Sigma 2 TMC Importer.
 
+from typing import NamedTuple
 import warnings
 import struct
 
@@ -37,20 +38,32 @@ class ContainerParser:
 
         o = offset_table_pos
         p = o + 4*chunk_count*(o > 0)
-        offset_table = data[o:p].cast('I')
+        self._offset_table = offset_table = data[o:p].cast('I')
 
         o = size_table_pos
         p = o + 4*chunk_count*(o > 0)
-        size_table = data[o:p].cast('I')
+        self._size_table = size_table = data[o:p].cast('I')
 
         o = sub_container_pos
         p = ( offset_table and offset_table[0] or container_nbytes )*(o > 0)
         self.sub_container = self._sub_container = data[o:p]
 
         self.chunks = self._chunks = tuple(ContainerParser._gen_chunks(
-            ldata or data, offset_table, size_table
+            ldata if header_nbytes == 0x50 else data, offset_table, size_table
         ))
 
+        # The layout the container was parsed with, for reserialize. The
+        # alignment is the largest power of two that every chunk is at and
+        # padded to.
+        if header_nbytes == 0x50:
+            end, = struct.unpack_from('< 4xI', data, 0x40)
+        else:
+            end = container_nbytes
+        a = end
+        for o in offset_table:
+            a |= o
+        self.layout = Layout(header_nbytes, size_table_pos > 0, offset_table and a & -a or 0x10)
+
     @staticmethod
     def _gen_chunks(data, offset_table, size_table):
         if size_table:
@@ -72,6 +85,8 @@ class ContainerParser:
         for c in self._chunks:
             c.release()
         self._sub_container.release()
+        self._offset_table.release()
+        self._size_table.release()
         self._metadata.release()
         self._ldata.release()
         self._data.release()
@@ -82,5 +97,11 @@ class ContainerParser:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+class Layout(NamedTuple):
+    # 0x50 if the body is separated into ldata
+    header_nbytes: int
+    size_table: bool
+    aligned: int
+
 class ParserError(Exception):
     pass
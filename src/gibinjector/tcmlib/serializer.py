@@ -0,0 +1,183 @@
+# Ninja Gaiden Sigma 2 TMC Importer by Nozomi Miyamori is under the public domain
+# and also marked with CC0 1.0. This file is a part of Ninja Gaiden Sigma 2 TMC Importer.
+
+from itertools import accumulate
+import struct
+import sys
+
+def serialize_container(magic, chunks = (), metadata = b'', sub_container = b'', *, separating_body = False, aligned = 0x10, ldata_file = None, size_table = None):
+    # A size table is written if size_table, or by default if the body is
+    # separated or the chunks aren't aligned to 0x10. With ldata_file, the separated body is written to it chunk by chunk
+    # instead of being returned, and its size is returned in its place.
+    # Chunks may be Gathers, whose buffers are written one after another.
+    chunks = tuple( c if isinstance(c, Gather) else memoryview(c) for c in chunks )
+    tuple_of_chunk_nbytes = tuple( c.nbytes for c in chunks )
+    metadata = memoryview(metadata)
+    sub_container = memoryview(sub_container)
+    separating_body = bool(separating_body)
+
+    # We calculate sizes and offsets first.
+    valid_chunk_count = sum( i > 0 for i in tuple_of_chunk_nbytes )
+    offset_table_nbytes = 4*len(chunks)
+    offset_table_nbytes += -offset_table_nbytes % 0x10
+    if size_table is None:
+        size_table = separating_body or aligned % 0x10
+    size_table_nbytes = offset_table_nbytes * bool(size_table)
+    chunks_nbytes = sum( i + -i % aligned for i in tuple_of_chunk_nbytes )
+    metadata_nbytes = metadata.nbytes + -metadata.nbytes % 0x10
+    sub_container_nbytes = sub_container.nbytes + -sub_container.nbytes % 0x10
+    header_nbytes = separating_body and 0x50 or 0x30
+    offset_table_pos0 = header_nbytes + metadata_nbytes
+    size_table_pos0 = offset_table_pos0 + offset_table_nbytes
+    sub_container_pos0 = size_table_pos0 + size_table_nbytes
+
+    i0 = ( 0x10 * separating_body
+          or sub_container_pos0 * (sub_container_nbytes > 0) + sub_container_nbytes
+          or size_table_pos0 * (size_table_nbytes > 0) + size_table_nbytes
+          or offset_table_pos0 * (offset_table_nbytes > 0) + offset_table_nbytes )
+    i0 += -i0 % aligned
+    I = accumulate(( i + -i % aligned for i in tuple_of_chunk_nbytes[:-1] ), initial=i0)
+    offset_table = (offset_table_nbytes > 0) * tuple( i*(j > 0) for i,j in zip(I, tuple_of_chunk_nbytes) )
+    size_table = (size_table_nbytes > 0) * tuple( i for i in tuple_of_chunk_nbytes )
+
+    n = (
+            header_nbytes
+            + metadata_nbytes
+            + offset_table_nbytes
+            + size_table_nbytes
+            + sub_container_nbytes
+            + chunks_nbytes * (not separating_body)
+    )
+    data = bytearray(n + -n%0x10)
+
+    # Let's pack the data.
+    struct.pack_into(
+            '< 8sII III4x III', data, 0,
+            magic, 0x01010000, header_nbytes,
+            len(data), len(chunks), valid_chunk_count,
+            offset_table_pos0 * (offset_table_nbytes > 0),
+            size_table_pos0 * (size_table_nbytes > 0),
+            sub_container_pos0 * (sub_container_nbytes > 0)
+    )
+
+    if separating_body:
+        n = 0x10 + chunks_nbytes
+        ldata_nbytes = n + -n%aligned
+        struct.pack_into(
+                '< III', data, 0x40,
+                valid_chunk_count, ldata_nbytes, 0x01234567
+        )
+        if ldata_file is None:
+            ldata = bytearray(ldata_nbytes)
+            ldata[:0x10] = data[0x40:0x50]
+
+    struct.pack_into(f'< {metadata.nbytes}s', data, header_nbytes, metadata.tobytes())
+    struct.pack_into(f'< {len(offset_table)}I', data, offset_table_pos0, *offset_table)
+    struct.pack_into(f'< {len(size_table)}I', data, size_table_pos0, *size_table)
+    struct.pack_into(f'< {sub_container.nbytes}s', data, sub_container_pos0, sub_container.tobytes())
+
+    if separating_body and ldata_file is not None:
+        ldata_file.write(data[0x40:0x50])
+        p = 0x10
+        for o, c in zip(offset_table, chunks):
+            if c.nbytes:
+                ldata_file.write(bytes(o - p))
+                for b in _buffers(c):
+                    ldata_file.write(b)
+                p = o + c.nbytes
+        ldata_file.write(bytes(ldata_nbytes - p))
+        return data, ldata_nbytes
+
+    A = separating_body and ldata or data
+    for o, c in zip(offset_table, chunks):
+        for b in _buffers(c):
+            b = memoryview(b).cast('B')
+            A[o:o+b.nbytes] = b
+            o += b.nbytes
+
+    return separating_body and (data, ldata) or data
+
+def reserialize(x, chunks = None, metadata = None, sub_container = None, *, aligned = None, ldata_file = None):
+    # Serializes the ContainerParser x with its chunks, metadata or sub
+    # container replaced, in the layout x was parsed with (or aligned). If
+    # they are the same bytes as those of x, the buffers of x are returned as
+    # they are (and its body is written to ldata_file) instead of being rebuilt.
+    chunks = x._chunks if chunks is None else chunks
+    metadata = x._metadata if metadata is None else metadata
+    sub_container = x._sub_container if sub_container is None else sub_container
+    separating_body = x.layout.header_nbytes == 0x50
+    if same_chunks(chunks, x._chunks) and same_chunks((metadata, sub_container), (x._metadata, x._sub_container)):
+        if not separating_body:
+            return x._data
+        if ldata_file is None:
+            return x._data, x._ldata
+        ldata_file.write(x._ldata)
+        return x._data, x._ldata.nbytes
+    return serialize_container(bytes(x._data[:8]), chunks, metadata, sub_container, separating_body = separating_body,
+                               aligned = aligned or x.layout.aligned, ldata_file = ldata_file,
+                               size_table = x.layout.size_table)
+
+def reproduces(x):
+    # Whether serialize_container gives back the bytes of the ContainerParser
+    # x from its parts and layout, i.e. x round-trips.
+    y = serialize_container(bytes(x._data[:8]), x._chunks, x._metadata, x._sub_container,
+                            separating_body = x.layout.header_nbytes == 0x50, aligned = x.layout.aligned,
+                            size_table = x.layout.size_table)
+    if x.layout.header_nbytes == 0x50:
+        return y[0] == x._data and y[1] == x._ldata
+    return y == x._data
+
+def same_chunks(a, b):
+    return len(a) == len(b) and all( x is y or _bytes_view(x) == _bytes_view(y) for x, y in zip(a, b) )
+
+def _bytes_view(x):
+    return memoryview(bytes(x)) if isinstance(x, Gather) else memoryview(x).cast('B')
+
+class Gather(list):
+    # A list of buffers which serialize_container can take as ldata_file. The
+    # separated body is then gathered as views of its chunks and padding
+    # without copying, and is written with writelines. It can also be a chunk
+    # made of several buffers.
+    def write(self, b):
+        if len(b):
+            self.append(b)
+
+    def __bytes__(self):
+        return b''.join(self)
+
+    @property
+    def nbytes(self):
+        return sum( memoryview(b).nbytes for b in self )
+
+def _buffers(c):
+    return c if isinstance(c, Gather) else (c,)
+
+def offset_table_of(x):
+    n, = struct.unpack_from('< I', x, 0x14)
+    o, = struct.unpack_from('< I', x, 0x20)
+    return struct.unpack_from(f' {n}I', x, o)
+
+def matrix_chunks(matrices):
+    # Splits (N, 4, 4) float32 matrices (memoryview, array, etc.) into 0x40 bytes
+    # chunks for serialize_container, without copying them if they're C
+    # contiguous little endian float32 already. Others are converted by NumPy.
+    m = memoryview(matrices)
+    if m.format not in ('f', '<f', '=f') or not m.c_contiguous or sys.byteorder != 'little':
+        import numpy as np
+        m = memoryview(np.ascontiguousarray(matrices, '<f4'))
+    if m.shape[1:] != (4, 4):
+        raise ValueError(f'Matrices must be shaped (N, 4, 4), not {m.shape}')
+    if not m.nbytes:
+        # Views shaped (0, 4, 4) can't be cast.
+        return ()
+    m = m.cast('B')
+    return tuple( m[o:o+0x40] for o in range(0, m.nbytes, 0x40) )
+
+def pack_matrices(chunks, matrices, offset = 0):
+    # Writes (N, 4, 4) float32 matrices into N writable chunks at offset, e.g.
+    # 0x0 of HieLay chunks or 0x10 of NodeObj chunks.
+    M = matrix_chunks(matrices)
+    if len(M) != len(chunks):
+        raise ValueError(f'{len(M)} matrices for {len(chunks)} chunks')
+    for c, m in zip(chunks, M):
+        c[offset:offset+0x40] = m
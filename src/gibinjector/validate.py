@@ -0,0 +1,157 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module checks cross references inside TMC/TMCL pairs, so that
+# broken outputs of inject_gibs are found before they reach the game.
+
+from .tcmlib.ngs2 import TMCParser
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+import struct
+import os
+
+def validate_tmc(data, ldata):
+    # Returns a list of problems found in the TMC and its TMCL. Sections are
+    # parsed as they're checked, so an error of parsing one ends the checks
+    # with the problems found so far and the error.
+    P = []
+    try:
+        with TMCParser(data, ldata) as tmc:
+            P += _check(tmc, memoryview(ldata).nbytes)
+    except Exception as e:
+        P.append(f'TMC: {type(e).__name__}: {e}')
+    return P
+
+def _check(tmc, ldata_nbytes):
+    objects = tmc.mdlgeo.chunks
+    mtrcols = tmc.mtrcol.chunks
+    ttdl = tmc.ttdm.sub_container.chunks
+    textures = tmc.ttdm.textures
+    vtxlay = tmc.vtxlay.chunks
+    idxlay = tmc.idxlay.chunks
+    hielay = tmc.hielay.chunks
+    nodelay = tmc.nodelay.chunks
+
+    # LHeader and its ldata
+    _, lcontainer_nbytes, _ = struct.unpack_from('< III', tmc.lheader._data, 0x40)
+    if lcontainer_nbytes > ldata_nbytes:
+        yield f'LHeader: ldata size {lcontainer_nbytes:#x} exceeds TMCL size {ldata_nbytes:#x}'
+    for i, c in enumerate(tmc.lheader._chunks):
+        if c.nbytes < 0x10:
+            yield f'LHeader[{i}]: ldata is too small ({c.nbytes:#x})'
+            continue
+        _, n, magic = struct.unpack_from('< III', c)
+        if magic != 0x01234567 or n > c.nbytes:
+            yield f'LHeader[{i}]: bad ldata head (size {n:#x}, chunk {c.nbytes:#x})'
+
+    for i, c in enumerate(tmc.ttdm.metadata.chunks):
+        if not 0 <= c.chunk_index < len(c.in_ttdl and ttdl or tmc.ttdm._chunks):
+            yield f'TTDH[{i}]: chunk {c.chunk_index} out of range'
+
+    # ObjGeo -> MtrCol, TTDL, GeoDecl -> VtxLay, IdxLay
+    uses = Counter()
+    for i, objgeo in enumerate(objects):
+        if objgeo.metadata.obj_index != i:
+            yield f'ObjGeo[{i}]: obj_index is {objgeo.metadata.obj_index}'
+        geodecls = objgeo.sub_container.chunks
+        for j, c in enumerate(objgeo.chunks):
+            p = f'ObjGeo[{i}][{j}]'
+            if not 0 <= c.mtrcol_index < len(mtrcols):
+                yield f'{p}: mtrcol {c.mtrcol_index} out of range'
+            uses[c.mtrcol_index, i] += 1
+            for t in c.texture_info_table:
+                if not 0 <= t.texture_index < len(textures):
+                    yield f'{p}: texture {t.texture_index} ({t.usage.name}) out of range'
+            if not 0 <= c.geodecl_chunk_index < len(geodecls):
+                yield f'{p}: geodecl {c.geodecl_chunk_index} out of range'
+                continue
+            g = geodecls[c.geodecl_chunk_index]
+            if c.first_index_index + c.index_count > g.index_count:
+                yield f'{p}: indices exceed GeoDecl index count {g.index_count}'
+            if c.first_vertex_index + c.vertex_count > g.vertex_count:
+                yield f'{p}: vertices exceed GeoDecl vertex count {g.vertex_count}'
+
+        for j, g in enumerate(geodecls):
+            p = f'ObjGeo[{i}] GeoDecl[{j}]'
+            if not 0 <= g.vertex_buffer_index < len(vtxlay):
+                yield f'{p}: vertex buffer {g.vertex_buffer_index} out of range'
+            elif g.vertex_count * g.vertex_size > vtxlay[g.vertex_buffer_index].nbytes:
+                yield f'{p}: vertex buffer {g.vertex_buffer_index} is too small'
+            if not 0 <= g.index_buffer_index < len(idxlay):
+                yield f'{p}: index buffer {g.index_buffer_index} out of range'
+            elif g.index_count * (g.vertex_count < 1<<16 and 2 or 4) > idxlay[g.index_buffer_index].nbytes:
+                yield f'{p}: index buffer {g.index_buffer_index} is too small'
+            if any( e.stream == 0 and e.offset >= g.vertex_size for e in g.vertex_elements ):
+                yield f'{p}: vertex element offset exceeds vertex size {g.vertex_size}'
+
+    # MtrCol xrefs
+    U = {}
+    for (k, o), n in uses.items():
+        U.setdefault(k, {})[o] = n
+    for i, m in enumerate(mtrcols):
+        xrefs = dict(m.xrefs)
+        if len(xrefs) != len(m.xrefs):
+            yield f'MtrCol[{i}]: duplicate xrefs'
+        expected = U.get(i, {})
+        if xrefs != expected:
+            yield f'MtrCol[{i}]: xrefs {sorted(xrefs.items())} != uses {sorted(expected.items())}'
+
+    for i, c in enumerate(tmc.mdlinfo.chunks):
+        if c.metadata.obj_index != i:
+            yield f'ObjInfo[{i}]: obj_index is {c.metadata.obj_index}'
+
+    # HieLay
+    roots = 0
+    for i, c in enumerate(hielay):
+        if c.parent == -1:
+            roots += 1
+        elif not 0 <= c.parent < len(hielay):
+            yield f'HieLay[{i}]: parent {c.parent} out of range'
+        elif i not in hielay[c.parent].children:
+            yield f'HieLay[{i}]: not a child of its parent {c.parent}'
+        for k in c.children:
+            if not 0 <= k < len(hielay):
+                yield f'HieLay[{i}]: child {k} out of range'
+            elif hielay[k].parent != i:
+                yield f'HieLay[{i}]: child {k} has parent {hielay[k].parent}'
+    if hielay and roots != 1:
+        yield f'HieLay: {roots} roots'
+
+    # NodeLay
+    for i, c in enumerate(nodelay):
+        if c.metadata.node_index != i:
+            yield f'NodeObj[{i}]: node_index is {c.metadata.node_index}'
+        for n in c.chunks:
+            if not -1 <= n.obj_index < len(objects):
+                yield f'NodeObj[{i}]: object {n.obj_index} out of range'
+            if any( not 0 <= k < len(nodelay) for k in n.node_group ):
+                yield f'NodeObj[{i}]: node group {n.node_group} out of range'
+
+def validate_file(path, lpath = None):
+    # lpath defaults to the next chunk number next to path (e.g. 01090.dat ->
+    # 01091.dat). A file that can't be read is a problem of its own.
+    try:
+        if lpath is None:
+            d, f = os.path.split(path)
+            n, ext = os.path.splitext(f)
+            lpath = os.path.join(d, f'{int(n)+1:0{len(n)}}{ext}')
+        with open(path, 'rb') as f, open(lpath, 'rb') as g:
+            data, ldata = f.read(), g.read()
+    except (OSError, ValueError) as e:
+        return [f'{type(e).__name__}: {e}']
+    return validate_tmc(data, ldata)
+
+def validate_files(paths, jobs = None):
+    # Yields (path, problems) in the order of paths.
+    with ProcessPoolExecutor(jobs) as ex:
+        yield from zip(paths, ex.map(validate_file, paths))
+
+def find_tmc_files(directory):
+    # TMCs among the regular files named as outputs are (e.g. 01090.dat).
+    for e in sorted(os.scandir(directory), key=lambda e: e.name):
+        n, ext = os.path.splitext(e.name)
+        if ext != '.dat' or len(n) != 5 or not n.isdigit() or not e.is_file():
+            continue
+        with open(e.path, 'rb') as f:
+            if f.read(8) == b'TMC\0\0\0\0\0':
+                yield e.path
@@ -0,0 +1,121 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module checks the integrity of databin: the header and directory, the
+# bounds of every chunk in the file, its inflated size against the directory
+# (zlib checks the Adler-32 of the stream), and linked chunk indices. With
+# deep, the container header of each chunk that has one is checked against
+# the inflated size as well.
+#
+# Chunks are inflated on threads, as zlib releases the GIL, in file order with
+# ReadAhead keeping the disk busy. The inflated data is counted and dropped.
+
+from .databin import DatabinParser, ReadAhead, mmap_open
+from . import metrics
+
+from concurrent.futures import ThreadPoolExecutor
+import struct
+import zlib
+
+def check_directory(data):
+    # Problems of the header and directory of databin, which DatabinParser
+    # trusts. If there are any, the chunks can't be walked.
+    if len(data) < 0x20:
+        return ['The header is out of the file']
+    chunk_info_size, = struct.unpack_from('< I', data, 0x4)
+    head_size, directory_size = struct.unpack_from('< II', data, 0x10)
+    if head_size + directory_size > len(data) or directory_size < 0x10:
+        return [f'The directory ({head_size:#x}, {directory_size:#x}) is out of the file']
+    if chunk_info_size < 0x18:
+        return [f'The chunk info size {chunk_info_size:#x} is too small']
+    n, = struct.unpack_from('< I', data, head_size)
+    if 0x10 + 4*n > directory_size:
+        return [f'The offset table of {n} chunks is out of the directory']
+    T = struct.unpack_from(f'< {n}I', data, head_size+0x10)
+    return [ f'{i:05}: the chunk info at {o:#x} is out of the directory'
+             for i, o in enumerate(T) if o + chunk_info_size > directory_size ]
+
+def check_chunk(db, c, size, deep = False, block = 1<<20):
+    # Returns the problems of Chunk c of DatabinParser db; size is that of
+    # the file.
+    P = []
+    if c.offset + c.compressed_size > size:
+        return [f'Its data ({c.offset:#x}, {c.compressed_size:#x}) is out of the file']
+    if not 0 <= c.linked_chunk_index < len(db.chunks) and c.linked_chunk_index != -1:
+        P.append(f'The linked chunk {c.linked_chunk_index} is not in databin')
+    elif c.linked_chunk_index == c.index:
+        P.append('It is linked to itself')
+    if not c.compressed_size:
+        if c.decompressed_size:
+            P.append(f'It is empty but its size is {c.decompressed_size:#x}')
+        return P
+
+    d = zlib.decompressobj()
+    n = 0
+    head = b''
+    try:
+        for i in range(0, c.compressed_size, block):
+            x = d.decompress(c.data[i:i+block])
+            head += x[:0x30-len(head)]
+            n += len(x)
+            if d.eof:
+                break
+        n += len(d.flush())
+    except zlib.error as e:
+        return P + [f'It does not inflate after {n:#x} bytes: {e}']
+    if not d.eof:
+        P.append(f'Its stream is truncated after {n:#x} bytes')
+    elif n != c.decompressed_size:
+        P.append(f'It inflates to {n:#x} bytes, not {c.decompressed_size:#x}')
+    if deep:
+        P += check_container_header(head, n)
+    return P
+
+def check_container_header(head, size):
+    # Problems of the container header at the start of a chunk of size bytes.
+    # Chunks that aren't containers have none.
+    if len(head) < 0x30 or head[8:12] != b'\0\0\1\1':
+        return []
+    magic = head[:8].rstrip(b'\0')
+    if not magic.isalnum():
+        return [f'Its magic bytes {magic} are not alphanumeric']
+    (
+            header_nbytes, container_nbytes, chunk_count, _,
+            offset_table_pos, size_table_pos, sub_container_pos,
+    ) = struct.unpack_from('< I III4x III', head, 0xc)
+    name = magic.decode()
+    if header_nbytes not in (0x30, 0x50):
+        return [f'The header size of {name} is {header_nbytes:#x}']
+    if container_nbytes > size:
+        return [f'{name} ({container_nbytes:#x} bytes) is out of the chunk ({size:#x} bytes)']
+    P = []
+    for x, o, n in ( ('offset table', offset_table_pos, 4*chunk_count),
+                     ('size table', size_table_pos, 4*chunk_count),
+                     ('sub container', sub_container_pos, 0) ):
+        if o and not header_nbytes <= o <= o + n <= container_nbytes:
+            P.append(f'The {x} of {name} at {o:#x} is out of it')
+    return P
+
+def verify(databin, deep = False, jobs = None, progress = None):
+    # Yields (chunk index, problems) of the chunks with problems, or (None,
+    # problems) if the directory is broken, in file order. The Metrics of
+    # the run are metrics.current.
+    with mmap_open(databin) as data:
+        P = check_directory(data)
+        if P:
+            yield None, P
+            return
+        with DatabinParser(data) as db:
+            ra = ReadAhead(db)
+            C = ra.schedule(db.chunks, lambda c: (c.index,))
+            run = metrics.start(len(C), progress, 'read')
+
+            def job(c):
+                P = check_chunk(db, c, len(data), deep)
+                ra.done(c.index)
+                run.target_done(c.index, c.compressed_size)
+                run.count(compressed_bytes_read=c.compressed_size, decompressed_bytes_read=c.decompressed_size)
+                return c.index, P
+
+            with ThreadPoolExecutor(jobs) as ex:
+                yield from ( x for x in ex.map(job, C) if x[1] )
+            run.finish()
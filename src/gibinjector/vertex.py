@@ -0,0 +1,149 @@
+# This program is by Nozomi Miyamori, under the public domain and marked with CC0 1.0.
+#
+# This module decodes and encodes vertex buffers described by GeoDecl
+# vertex elements (D3DVERTEXELEMENT9). It requires NumPy.
+
+from .tcmlib import offset_table_of
+from .tcmlib.ngs2 import D3DDECLTYPE, D3DDECLUSAGE, D3DVERTEXELEMENT9
+
+import struct
+import numpy as np
+
+# d3d_decl_type: (dtype, count, scale)
+# scale is what the stored integers are divided by, or None when they are not normalized.
+DECL_FORMATS = {
+    D3DDECLTYPE.FLOAT1:    ('<f4', 1, None),
+    D3DDECLTYPE.FLOAT2:    ('<f4', 2, None),
+    D3DDECLTYPE.FLOAT3:    ('<f4', 3, None),
+    D3DDECLTYPE.FLOAT4:    ('<f4', 4, None),
+    D3DDECLTYPE.D3DCOLOR:  ('u1', 4, 255),
+    D3DDECLTYPE.UBYTE4:    ('u1', 4, None),
+    D3DDECLTYPE.SHORT2:    ('<i2', 2, None),
+    D3DDECLTYPE.SHORT4:    ('<i2', 4, None),
+    D3DDECLTYPE.UBYTE4N:   ('u1', 4, 255),
+    D3DDECLTYPE.SHORT2N:   ('<i2', 2, 32767),
+    D3DDECLTYPE.SHORT4N:   ('<i2', 4, 32767),
+    D3DDECLTYPE.USHORT2N:  ('<u2', 2, 65535),
+    D3DDECLTYPE.USHORT4N:  ('<u2', 4, 65535),
+    D3DDECLTYPE.UDEC3:     ('<u4', 1, None),
+    D3DDECLTYPE.DEC3N:     ('<u4', 1, 511),
+    D3DDECLTYPE.FLOAT16_2: ('<f2', 2, None),
+    D3DDECLTYPE.FLOAT16_4: ('<f2', 4, None),
+}
+
+def decl_type_nbytes(t):
+    dtype, n, _ = DECL_FORMATS[t]
+    return np.dtype(dtype).itemsize * n
+
+def decode_element(vertices, e):
+    # vertices is an (N, vertex_size) uint8 array. The result is (N, k) float32
+    # where k is the number of components the type carries.
+    dtype, n, scale = DECL_FORMATS[e.d3d_decl_type]
+    nbytes = np.dtype(dtype).itemsize * n
+    a = np.ascontiguousarray(vertices[:, e.offset:e.offset+nbytes]).view(dtype)
+    match e.d3d_decl_type:
+        case D3DDECLTYPE.D3DCOLOR:
+            # Stored as BGRA
+            return a[:, [2, 1, 0, 3]].astype(np.float32) / scale
+        case D3DDECLTYPE.UDEC3:
+            a = a[:, 0]
+            return np.stack([ (a >> s) & 0x3ff for s in (0, 10, 20) ], 1).astype(np.float32)
+        case D3DDECLTYPE.DEC3N:
+            a = a[:, 0].astype(np.int32)
+            x = np.stack([ (a >> s) & 0x3ff for s in (0, 10, 20) ], 1)
+            x -= (x >= 0x200) * 0x400
+            return np.maximum(x / np.float32(scale), -1, dtype=np.float32)
+    a = a.astype(np.float32)
+    return a / np.float32(scale) if scale else a
+
+def encode_element(values, t):
+    # The inverse of decode_element. values is (N, k); missing components are
+    # filled with 1.0 for w and 0.0 for the others, as D3D9 does on reading.
+    dtype, n, scale = DECL_FORMATS[t]
+    values = np.asarray(values, dtype=np.float64)
+    k = t in (D3DDECLTYPE.UDEC3, D3DDECLTYPE.DEC3N) and 3 or n
+    x = np.zeros((len(values), k))
+    if k == 4:
+        x[:, 3] = 1
+    x[:, :min(k, values.shape[1])] = values[:, :k]
+    match t:
+        case D3DDECLTYPE.D3DCOLOR:
+            x = x[:, [2, 1, 0, 3]]
+        case D3DDECLTYPE.UDEC3:
+            x = np.clip(np.rint(x), 0, 0x3ff).astype(np.int64)
+            x = x[:, 0] | x[:, 1] << 10 | x[:, 2] << 20
+            return x.astype(dtype).view(np.uint8).reshape(len(values), -1)
+        case D3DDECLTYPE.DEC3N:
+            x = np.clip(np.rint(x * scale), -scale, scale).astype(np.int64) & 0x3ff
+            x = x[:, 0] | x[:, 1] << 10 | x[:, 2] << 20
+            return x.astype(dtype).view(np.uint8).reshape(len(values), -1)
+    if scale:
+        lo = np.iinfo(dtype).min
+        x = np.clip(np.rint(x * scale), max(lo, -scale), scale)
+    return x.astype(dtype).view(np.uint8).reshape(len(values), -1)
+
+# Candidates are tried in order and the first one within tolerance is taken.
+_COMPACT_CANDIDATES = {
+    D3DDECLTYPE.FLOAT2: (D3DDECLTYPE.SHORT2N, D3DDECLTYPE.FLOAT16_2),
+    D3DDECLTYPE.FLOAT3: (D3DDECLTYPE.DEC3N, D3DDECLTYPE.SHORT4N, D3DDECLTYPE.FLOAT16_4),
+    D3DDECLTYPE.FLOAT4: (D3DDECLTYPE.SHORT4N, D3DDECLTYPE.FLOAT16_4),
+}
+
+def compact_decl_type(values, t, tolerance):
+    for u in _COMPACT_CANDIDATES.get(t, ()):
+        if decl_type_nbytes(u) >= decl_type_nbytes(t):
+            continue
+        e = encode_element(values, u)
+        y = decode_element(e, _element(0, u))
+        k = min(values.shape[1], y.shape[1])
+        # A type with fewer components than the source can only drop w when
+        # it's the default 1.0.
+        if not np.all(values[:, k:] == 1):
+            continue
+        if not len(values) or np.abs(y[:, :k] - values[:, :k]).max() <= tolerance:
+            return u, e
+    return t, None
+
+def _element(offset, d3d_decl_type):
+    return D3DVERTEXELEMENT9(0, offset, d3d_decl_type, 0, D3DDECLUSAGE.POSITION, 0)
+
+def compact_vertex_buffer(geodecl_chunk, vertex_buffer, tolerance):
+    # Re-encode the vertex buffer with smaller declared types and rewrite the
+    # vertex elements and the vertex size of geodecl_chunk in place.
+    vertex_info_offset, = struct.unpack_from('< 4xI', geodecl_chunk)
+    _, vertex_size, elements_count = struct.unpack_from('< III', geodecl_chunk, vertex_info_offset)
+    o = vertex_info_offset + 0x18
+    elements = [ list(struct.unpack_from('< hhBBBB', geodecl_chunk, o+8*i)) for i in range(elements_count) ]
+    # D3DDECL_END() has stream 0xff.
+    E = [ e for e in elements if e[0] != 0xff ]
+    if any( e[0] != 0 for e in E ):
+        return vertex_buffer
+
+    n = len(vertex_buffer) // vertex_size
+    vertices = np.frombuffer(vertex_buffer, np.uint8, n*vertex_size).reshape(n, vertex_size)
+    columns = []
+    offset = 0
+    for e in sorted(E, key=lambda e: e[1]):
+        t = D3DDECLTYPE(e[2])
+        x = vertices[:, e[1]:e[1]+decl_type_nbytes(t)]
+        if e[4] != D3DDECLUSAGE.BLENDINDICES and t in _COMPACT_CANDIDATES:
+            t, y = compact_decl_type(decode_element(vertices, _element(e[1], t)), t, tolerance)
+            x = x if y is None else y
+        e[1] = offset
+        e[2] = t
+        columns.append(x)
+        offset += x.shape[1]
+
+    for i, e in enumerate(elements):
+        struct.pack_into('< hhBBBB', geodecl_chunk, o+8*i, *e)
+    struct.pack_into('< I', geodecl_chunk, vertex_info_offset+4, offset)
+    return bytearray(np.hstack(columns).tobytes())
+
+def compact_vertices(objgeo_chunks, vertex_buffers, tolerance):
+    # vertex_buffers are in the order of the GeoDecl chunks of objgeo_chunks.
+    V = iter(vertex_buffers)
+    for objgeo in objgeo_chunks:
+        o, = struct.unpack_from('< I', objgeo, 0x28)
+        geodecl = memoryview(objgeo)[o:]
+        for o in offset_table_of(geodecl):
+            yield compact_vertex_buffer(geodecl[o:], next(V), tolerance)
@@ -0,0 +1,46 @@
+# Synthetic ObjGeo containers and buffers for the tests of simplify and pack.
+
+from gibinjector.tcmlib import serialize_container
+
+import struct
+
+# D3DVERTEXELEMENT9: a FLOAT3 position and the end
+ELEMENTS = [ (0, 0, 2, 0, 0, 0), (0xff, 0, 17, 0, 0, 0) ]
+
+def geodecl(vertex_buffer_index, index_buffer_index, vertex_count, index_count, vertex_size = 12):
+    c = bytearray(0x38 + 8*len(ELEMENTS))
+    struct.pack_into('< IIII III', c, 0, 0, 0x20, 1, index_buffer_index, index_count, vertex_count, 0)
+    struct.pack_into('< III', c, 0x20, vertex_buffer_index, vertex_size, len(ELEMENTS))
+    for i, e in enumerate(ELEMENTS):
+        struct.pack_into('< hhBBBB', c, 0x38+8*i, *e)
+    return c
+
+def objgeo(geodecls, primitives):
+    # primitives: (GeoDecl chunk index, primitive type, first index, index
+    # count, first vertex, vertex count) of each ObjGeo chunk
+    chunks = []
+    for i, (j, mode, first_index, index_count, first_vertex, vertex_count) in enumerate(primitives):
+        c = bytearray(0xe0)
+        struct.pack_into('< ii4xI', c, 0, i, 0, 0)
+        struct.pack_into('< I', c, 0x38, j)
+        struct.pack_into('< II', c, 0x68, 1, mode)
+        struct.pack_into('< I?3xII II', c, 0x70, 1, False, first_index, index_count, first_vertex, vertex_count)
+        chunks.append(c)
+    metadata = struct.pack('< HHi8x 8x8x 10s', 3, 1, 0, b'obj')
+    return bytearray(serialize_container(b'ObjGeo', chunks, metadata, serialize_container(b'GeoDecl', geodecls)))
+
+def grid(n, z = 0):
+    # Positions and the triangle list of an n x n grid of quads
+    P = [ (x, y, z) for y in range(n+1) for x in range(n+1) ]
+    T = []
+    for y in range(n):
+        for x in range(n):
+            a = y*(n+1) + x
+            T += [ (a, a+1, a+n+1), (a+1, a+n+2, a+n+1) ]
+    return P, T
+
+def vertex_buffer(P):
+    return bytearray(b''.join( struct.pack('< 3f', *p) for p in P ))
+
+def index_buffer(I, vertex_count):
+    return bytearray(struct.pack(f'< {len(I)}{vertex_count < 1<<16 and "H" or "I"}', *I))
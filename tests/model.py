@@ -0,0 +1,122 @@
+# Synthetic TMC/TMCL pairs: a root node and one object of a quad per node,
+# with every section inject_gibs and the validator go through.
+
+from gibinjector.tcmlib import serialize_container as S
+
+import struct
+import random
+
+ELEMENTS = [ (0, 0, 2, 0, 0, 0), (0, 12, 2, 0, 3, 0), (0, 24, 1, 0, 5, 0), (0, 32, 5, 0, 2, 0), (0xff, 0, 17, 0, 0, 0) ]
+
+def vertex_buffer(n, seed):
+    r = random.Random(seed)
+    B = bytearray()
+    for _ in range(n):
+        B += struct.pack('< 3f 3f 2f 4B', *( r.uniform(-1, 1) for _ in range(3) ), 0, 0, 1, r.random(), r.random(), 0, 0, 0, 0)
+    return B
+
+def geodecl(i, vertex_count, index_count):
+    c = bytearray(0x38 + 8*len(ELEMENTS))
+    struct.pack_into('< IIII III', c, 0, 0, 0x20, 1, i, index_count, vertex_count, 0)
+    struct.pack_into('< III', c, 0x20, i, 36, len(ELEMENTS))
+    for k, e in enumerate(ELEMENTS):
+        struct.pack_into('< hhBBBB', c, 0x38+8*k, *e)
+    return S(b'GeoDecl', [c])
+
+def objgeo(i, name, vertex_count, index_count, mtrcol_index):
+    c = bytearray(0x260)
+    struct.pack_into('< ii4xI', c, 0, 0, mtrcol_index, 3)
+    struct.pack_into('< 3I', c, 0x10, 0xe0, 0xe0+0x80, 0xe0+0x100)
+    struct.pack_into('< II', c, 0x68, 1, 4)
+    struct.pack_into('< I?3xII II', c, 0x70, 1, False, 0, index_count, 0, vertex_count)
+    for k in range(3):
+        # info index, usage, texture index
+        struct.pack_into('< III', c, 0xe0+0x80*k, k, k, k)
+    metadata = struct.pack('< HHi8x 8x8x 10s', 3, 1, i, name)
+    return S(b'ObjGeo', [c], metadata, geodecl(i, vertex_count, index_count))
+
+def mtrcol(i, xrefs):
+    c = bytearray(0xd8 + 8*len(xrefs))
+    struct.pack_into('< 4f', c, 0, 1, 0.5, 0.25, 1)
+    struct.pack_into('< iI', c, 0xd0, i, len(xrefs))
+    for k, x in enumerate(xrefs):
+        struct.pack_into('< iI', c, 0xd8+8*k, *x)
+    return c
+
+def hielay(i, parent, children):
+    m = [ float(k % 5 == 0) for k in range(16) ]
+    m[12] = float(i)
+    return struct.pack(f'< 16f iII4x {len(children)}i', *m, parent, len(children), parent != -1, *children)
+
+def nodeobj(i, name, node_index):
+    m = [ float(k % 5 == 0) for k in range(16) ]
+    c = struct.pack('< iIi4x 16f i', i, 1, node_index, *m, node_index).ljust(0x60, b'\0')
+    return S(b'NodeObj', [c], struct.pack('< 4xii4x 16s', -1, node_index, name))
+
+def model(names, seed = 0, textures = 3, mtrcol_index = 0, xrefs = None, children = None, node_index = None):
+    # Returns the TMC and the TMCL. The keyword arguments break the
+    # references of the model for the validator to find: the MtrCol of
+    # object 0, the xrefs of MtrCol 0, the children of the root and the
+    # node_index of each NodeObj.
+    n = len(names)
+    V = [ vertex_buffer(4+i, seed+i) for i in range(n) ]
+    I = [ struct.pack('< 6H', 0, 1, 2, 2, 3, 0) for i in range(n) ]
+    mdlgeo = S(b'MdlGeo', [ objgeo(i, names[i], len(V[i])//36, 6, mtrcol_index if i == 0 else 0) for i in range(n) ])
+    T = [ b'DDS ' + bytes([seed+k])*0x7c + bytes(0x40*(k+1)) for k in range(textures) ]
+    ttdl, ttdl_ldata = S(b'TTDL', T, separating_body = True, aligned = 0x40)
+    ttdh = S(b'TTDH', [ struct.pack('< IIqqq', 1, i, 0, 0, 0) for i in range(textures) ], (1).to_bytes(4, 'little'))
+    ttdm = S(b'TTDM', (), ttdh, ttdl)
+    vtxlay, vtxlay_ldata = S(b'VtxLay', V, separating_body = True)
+    idxlay, idxlay_ldata = S(b'IdxLay', I, separating_body = True)
+    xrefs = [ (i, 1) for i in range(n) ] if xrefs is None else xrefs
+    mc = S(b'MtrCol', [ mtrcol(0, xrefs), mtrcol(1, []) ])
+    mdlinfo = S(b'MdlInfo', [ S(b'ObjInfo', [bytes(0x10)], struct.pack('< Ii4xI', 3, i, 0)) for i in range(n) ])
+    children = list(range(1, n)) if children is None else children
+    hl = S(b'HieLay', [ hielay(0, -1, children) ] + [ hielay(i, 0, []) for i in range(1, n) ], b'', bytes(0x20))
+    node_index = range(n) if node_index is None else node_index
+    nl = S(b'NodeLay', [ nodeobj(i, names[i], k) for i, k in enumerate(node_index) ], bytes(0x10))
+    glblmtx = S(b'GlblMtx', [ struct.pack('< 16f', *[float(i)]*16) for i in range(n) ])
+    bnofsmtx = S(b'BnOfsMtx', [ struct.pack('< 16f', *[float(-i)]*16) for i in range(n) ])
+    lheader_metadata = bytes(0x20) + struct.pack('< 3I', 0xC000_0002, 0xC000_0003, 0xC000_0004)
+    lheader, lheader_ldata = S(b'LHeader', [ttdl_ldata, vtxlay_ldata, idxlay_ldata], lheader_metadata, separating_body = True, aligned = 0x80)
+    # The first index and the number of the nodes of each type
+    node_types = bytearray(0x20)
+    struct.pack_into('< HH', node_types, 0x4, 0, 1)
+    for o, prefix in ((0x14, b'OPT'), (0x1c, b'WPB')):
+        K = [ i for i, x in enumerate(names) if x.startswith(prefix) ]
+        struct.pack_into('< HH', node_types, o, K and K[0] or 0, len(K))
+    m = n + -n%8
+    c14 = bytearray(4*m + 0x60*n)
+    for i in range(n):
+        struct.pack_into('< I', c14, 4*i, 4*m + 0x60*i)
+        struct.pack_into('< III', c14, 4*m + 0x60*i, 7, 7, i)
+    types = [ 1, 2, 3, 4, 5, 6, 0x10, 0x20, 0x30, 0x40, 0x50, 0x60, 0x70, 0, 0, 0x80 ]
+    chunks = [ mdlgeo, ttdm, vtxlay, idxlay, mc, mdlinfo, hl, lheader, nl, glblmtx, bnofsmtx, b'CPF', b'', node_types, c14, b'' ]
+    metadata = bytearray(0xc0 + 4*len(chunks))
+    struct.pack_into('< HH4xI4x I4x8x 10s', metadata, 0, 0, 0, 0, 0, b'model%d' % seed)
+    struct.pack_into(f'< {len(types)}I', metadata, 0xc0, *( t and 0x8000_0000 | t for t in types ))
+    return bytes(S(b'TMC', chunks, metadata)), bytes(lheader_ldata)
+
+# A source with the 0x11 gib objects from 3, and a target
+SRC_NAMES = [ b'MOT00', b'MOT01', b'SUP00' ] + [ b'OPTscat%02d' % i for i in range(0x11) ] + [ b'WPB00' ]
+DST_NAMES = [ b'MOT00', b'MOT01', b'SUP00', b'WPB00', b'WPB01' ]
+
+def databin(path, chunks):
+    # Writes chunks (bytes) compressed to a databin at path.
+    import zlib
+    Z = [ zlib.compress(c) for c in chunks ]
+    n = len(chunks)
+    directory = bytearray(0x10 + 4*n + 0x18*n)
+    struct.pack_into('< I', directory, 0, n)
+    o = 0
+    for i, (c, z) in enumerate(zip(chunks, Z)):
+        p = 0x10 + 4*n + 0x18*i
+        struct.pack_into('< I', directory, 0x10+4*i, p)
+        # offset, decompressed size, compressed size, linked chunk
+        struct.pack_into('< QIIIh', directory, p, o, len(c), len(z), 0, -1)
+        o += len(z) + -len(z)%0x10
+    head = struct.pack('< II8x II8x', 1, 0x18, 0x20, len(directory))
+    with open(path, 'wb') as f:
+        f.write(head + directory)
+        for z in Z:
+            f.write(z + bytes(-len(z)%0x10))
@@ -0,0 +1,19 @@
+# Every TMC in databin must be cataloged or reported as skipped.
+
+from gibinjector.catalog import build_catalog
+
+from model import model, databin, SRC_NAMES, DST_NAMES
+import sqlite3
+
+def test_catalog(tmp_path):
+    src = model(SRC_NAMES, 10)
+    dst = model(DST_NAMES, 20, 4)
+    # The TMC of chunk 6 is cut short.
+    databin(tmp_path / 'databin', [ b'junk', *src, b'x'*100, *dst, src[0][:0x200], src[1] ])
+    count, skipped = build_catalog(str(tmp_path / 'databin'), str(tmp_path / 'c.sqlite'), 2, batch = 2)
+    assert count == 2
+    assert [ n for n, _ in skipped ] == [6]
+    con = sqlite3.connect(tmp_path / 'c.sqlite')
+    assert con.execute('SELECT chunk, objects, nodes, has_gibs FROM models ORDER BY chunk').fetchall() == \
+        [ (1, len(SRC_NAMES), len(SRC_NAMES), 1), (4, len(DST_NAMES), len(DST_NAMES), 0) ]
+    con.close()
@@ -0,0 +1,54 @@
+# Reads of ranges of chunks through ChunkIndex checkpoints must give the same
+# bytes as inflating the chunk whole, and saved indices must load back.
+
+from gibinjector.databin import Chunk, ChunkIndex, decompress_range, _libz
+
+import random
+import zlib
+import os
+import pytest
+
+def chunk(level = 6):
+    rng = random.Random(level)
+    words = [ rng.randbytes(rng.randrange(3, 12)) for _ in range(500) ]
+    raw = b''.join( rng.choice(words) for _ in range(150_000) )
+    data = zlib.compress(raw, level)
+    return raw, Chunk(7, len(raw), len(data), -1, 0, 0, memoryview(data), 0x1000)
+
+def ranges(raw):
+    rng = random.Random(0)
+    return [ (0, 100), (len(raw)-50, 100), (len(raw)//2, 1<<16), (len(raw), 10) ] + \
+           [ (rng.randrange(len(raw)), rng.randrange(1, 1<<16)) for _ in range(40) ]
+
+def test_decompress_range():
+    raw, c = chunk()
+    for offset, size in ranges(raw):
+        assert decompress_range(c, offset, size) == raw[offset:offset+size]
+    # The inflated buffer itself, not a copy of it
+    assert isinstance(decompress_range(c, 0, 100).obj, bytearray)
+
+needs_libz = pytest.mark.skipif(_libz() is None, reason='zlib can\'t be loaded by ctypes')
+
+@needs_libz
+@pytest.mark.parametrize('level', [1, 6, 9])
+def test_read(level):
+    raw, c = chunk(level)
+    x = ChunkIndex.build(c, 1<<16)
+    assert len(x.checkpoints) > 4
+    # Blocks start at any bit, which reads must handle.
+    assert len({ b for _, _, b, _ in x.checkpoints }) > 1
+    for offset, size in ranges(raw):
+        assert x.read(c, offset, size) == raw[offset:offset+size]
+
+@needs_libz
+def test_save(tmp_path):
+    raw, c = chunk()
+    x = ChunkIndex.open(c, tmp_path, 1<<16)
+    assert os.listdir(tmp_path) == ['00007.idx']
+    y = ChunkIndex.open(c, tmp_path, 1<<16)
+    assert y.checkpoints == x.checkpoints
+    # The index of another chunk at the same number is rebuilt.
+    raw2, c2 = chunk(1)
+    z = ChunkIndex.open(c2._replace(index=7), tmp_path, 1<<16)
+    offset = len(raw2) * 3 // 4
+    assert z.read(c2, offset, 100) == raw2[offset:offset+100]
@@ -0,0 +1,51 @@
+# Reduced textures must be DDS files whose header describes the levels kept,
+# which are those of the original byte for byte.
+
+from gibinjector.dds import DDSD_LINEARSIZE, DDSD_MIPMAPCOUNT, DDSCAPS_COMPLEX, DDSCAPS_MIPMAP, DDSError, DDSHeader, mip_sizes, parse_dds, reduce_dds
+
+import struct
+import pytest
+
+def dds(width, height, mip_count, fourcc = b'DXT5'):
+    header = bytearray(0x80)
+    header[:4] = b'DDS '
+    struct.pack_into('< 7I', header, 0x4, 124, 0x1007 | DDSD_MIPMAPCOUNT | DDSD_LINEARSIZE,
+                     height, width, 0, 0, mip_count)
+    struct.pack_into('< II4s', header, 0x4c, 32, 0x4, fourcc)
+    struct.pack_into('< I', header, 0x6c, 0x1000 | DDSCAPS_COMPLEX | DDSCAPS_MIPMAP)
+    S = mip_sizes(DDSHeader(0, height, width, 0, 0, mip_count, 0x4, fourcc, 0, 0, 0, 0, 0))
+    struct.pack_into('< I', header, 0x14, S[0])
+    # Every level is filled with its number.
+    body = b''.join( bytes([i]) * n for i, n in enumerate(S) )
+    return bytes(header) + body
+
+def test_parse():
+    x = parse_dds(dds(256, 128, 9))
+    assert (x.header.width, x.header.height, x.header.mip_count) == (256, 128, 9)
+    assert [ m.nbytes for m in x.mips ] == [ 0x8000, 0x2000, 0x800, 0x200, 0x80, 0x20, 0x10, 0x10, 0x10 ]
+    with pytest.raises(DDSError):
+        parse_dds(dds(256, 128, 9)[:-1])
+
+@pytest.mark.parametrize('max_size, max_mips, k, n', [
+    (64, None, 2, 7), (None, 3, 0, 3), (100, 2, 2, 2), (1, None, 8, 1), (256, 9, 0, 9),
+])
+def test_reduce(max_size, max_mips, k, n):
+    data = dds(256, 128, 9)
+    x = parse_dds(data)
+    y, saved = reduce_dds(data, max_size, max_mips)
+    if n == 9:
+        assert y is data and saved == 0
+        return
+    y = bytes(y)
+    assert len(data) - len(y) == saved
+    z = parse_dds(y)
+    assert (z.header.width, z.header.height, z.header.mip_count) == (max(1, 256 >> k), max(1, 128 >> k), n)
+    assert z.mips == x.mips[k:k+n]
+    assert z.header.pitch_or_linear_size == x.mips[k].nbytes
+    assert bool(z.header.flags & DDSD_MIPMAPCOUNT) == (n > 1)
+    assert bool(z.header.caps & DDSCAPS_MIPMAP) == (n > 1)
+
+@pytest.mark.parametrize('max_size, max_mips', [(0, None), (-1, None), (None, 0), (None, -2)])
+def test_reduce_invalid(max_size, max_mips):
+    with pytest.raises(ValueError):
+        reduce_dds(dds(64, 64, 7), max_size, max_mips)
@@ -0,0 +1,117 @@
+# Hierarchy edits must renumber every reference to the nodes (parents,
+# children, levels, node groups and node indices) and serialize to HieLay and
+# NodeLay that parse back to the same hierarchy.
+
+from gibinjector.tcmlib import serialize_container
+from gibinjector.tcmlib.ngs2 import Hierarchy, HieLayParser, NodeLayParser
+
+import struct
+import pytest
+
+def hielay_chunk(parent, children, level):
+    return bytes(0x40) + struct.pack(f'< iII4x {len(children)}i', parent, len(children), level, *children)
+
+def nodeobj(i, name, obj_index, node_group):
+    metadata = struct.pack('< 4xii4x', -1, i) + name.ljust(0x10, b'\0')
+    chunk = struct.pack('< iIi4x', obj_index, len(node_group), i) + bytes(0x40) + struct.pack(f'< {len(node_group)}i', *node_group)
+    return serialize_container(b'NodeObj', [chunk], metadata)
+
+def containers(names, parent, node_groups = None):
+    # HieLay and NodeLay; objects are numbered in the order of the nodes.
+    n = len(names)
+    children = [ [ k for k in range(n) if parent[k] == i ] for i in range(n) ]
+    level = Hierarchy._levels(parent)
+    node_groups = node_groups or [ [i] for i in range(n) ]
+    return ( serialize_container(b'HieLay', [ hielay_chunk(*x) for x in zip(parent, children, level) ], b'', bytes(0x10)),
+             serialize_container(b'NodeLay', [ nodeobj(i, *x) for i, x in enumerate(zip(names, range(n), node_groups)) ]) )
+
+def parse(hielay, nodelay):
+    return Hierarchy(HieLayParser(hielay), NodeLayParser(nodelay))
+
+def check(h):
+    # The lists of h are consistent, and serialized as they are.
+    for k, p in enumerate(h.parent):
+        assert p == -1 or k in h.children[p]
+        assert h.level[k] == (p != -1 and h.level[p] + 1 or 0)
+    for k, C in enumerate(h.children):
+        assert all( h.parent[x] == k for x in C )
+    x = parse(*h.serialize())
+    assert (x.parent, x.children, x.level) == (h.parent, h.children, h.level)
+    assert (x.names, x.obj_index, x.node_groups) == (h.names, h.obj_index, h.node_groups)
+    hielay, nodelay = h.serialize()
+    assert [ c.metadata.node_index for c in NodeLayParser(nodelay).chunks ] == list(range(len(h)))
+    assert [ c.chunks[0].node_index for c in NodeLayParser(nodelay).chunks ] == list(range(len(h)))
+
+DST = containers([ b'MOT00', b'MOT01', b'OPT00', b'WGT00' ], [ -1, 0, 0, 1 ], [ [0], [1, 3], [2], [3, 1] ])
+SRC = containers([ b'MOT00', b'OPT10', b'OPT11', b'OPT12' ], [ -1, 0, 1, 1 ])
+
+def dst():
+    return parse(*DST)
+
+def src():
+    return parse(*SRC)
+
+def test_unchanged():
+    h = dst()
+    check(h)
+    assert [ bytes(x) for x in h.serialize() ] == [ bytes(x) for x in DST ]
+
+def test_prefix_range():
+    h = dst()
+    assert h.prefix_range(b'OPT') == range(2, 3)
+    assert h.prefix_range(b'MOT01') == range(0, 2)
+    assert h.index(b'WGT00') == 3
+    with pytest.raises(KeyError):
+        h.prefix_range(b'SUP')
+
+def test_insert():
+    h = dst()
+    h.insert(3, src(), slice(1, 4), obj_index = 3)
+    check(h)
+    assert h.names == [ b'MOT00', b'MOT01', b'OPT00', b'OPT10', b'OPT11', b'OPT12', b'WGT00' ]
+    # OPT10 goes under the root, with its children.
+    assert h.parent == [ -1, 0, 0, 0, 3, 3, 1 ]
+    assert h.children[0] == [1, 2, 3] and h.children[1] == [6] and h.children[3] == [4, 5]
+    assert h.level == [ 0, 1, 1, 1, 2, 2, 2 ]
+    # References to WGT00 are shifted, those to the inserted nodes renumbered.
+    assert h.node_groups == [ [0], [1, 6], [2], [3], [4], [5], [6, 1] ]
+    assert h.obj_index == [ 0, 1, 2, 3, 4, 5, 6 ]
+    assert h.prefix_range(b'OPT') == range(2, 6)
+
+def test_insert_parent():
+    h = dst()
+    h.insert(4, src(), range(2, 4), parent = 3)
+    check(h)
+    assert h.parent == [ -1, 0, 0, 1, 3, 3 ]
+    assert h.level[4:] == [3, 3]
+    # Their objects are those of src.
+    assert h.obj_index == [ 0, 1, 2, 3, 2, 3 ]
+
+def test_remove():
+    h = dst()
+    h.remove([1])
+    check(h)
+    # WGT00 goes up to the root.
+    assert h.names == [ b'MOT00', b'OPT00', b'WGT00' ]
+    assert h.parent == [ -1, 0, 0 ]
+    assert h.children[0] == [1, 2]
+    assert h.node_groups == [ [0], [1], [2] ]
+
+def test_remove_inserted():
+    h = dst()
+    h.insert(3, src(), slice(1, 4), obj_index = 3)
+    h.remove(range(3, 6))
+    check(h)
+    assert h.parent == dst().parent and h.node_groups == dst().node_groups
+
+def test_reparent():
+    h = dst()
+    h.reparent(1, 2)
+    check(h)
+    assert h.parent == [ -1, 2, 0, 1 ]
+    assert h.level == [ 0, 2, 1, 3 ]
+    with pytest.raises(ValueError):
+        h.reparent(2, 3)
+    with pytest.raises(ValueError):
+        h.reparent(1, 1)
+    check(h)
@@ -0,0 +1,48 @@
+# Material records must be written back byte for byte, including the bytes
+# out of the fields of MATERIAL_DTYPE.
+
+from gibinjector.tcmlib import serialize_container
+from gibinjector.tcmlib.ngs2 import MtrColParser, MTRLCHNGParser
+
+import struct
+import pytest
+
+np = pytest.importorskip('numpy')
+from gibinjector.tcmlib.ngs2.material import MaterialTable
+
+def records(n, seed = 0):
+    return np.random.default_rng(seed).integers(0, 256, (n, 0xd0), np.uint8).tobytes()
+
+def mtrcol(n):
+    R = records(n)
+    # record, mtrcol_index, xrefs
+    return [ R[0xd0*i:0xd0*(i+1)] + struct.pack('< iI iI', i, 1, 0, i) for i in range(n) ]
+
+def test_mtrcol_unchanged():
+    C = mtrcol(4)
+    x = MtrColParser(serialize_container(b'MtrCol', C))
+    t = MaterialTable.from_mtrcol(x)
+    assert t.tobytes() == b''.join( c[:0xd0] for c in C )
+    assert [ bytes(c) for c in t.mtrcol_chunks(x) ] == C
+
+def test_mtrcol_edit():
+    C = mtrcol(4)
+    x = MtrColParser(serialize_container(b'MtrCol', C))
+    t = MaterialTable.from_mtrcol(x)
+    t['diffuse'][1] = (1, 2, 3, 4)
+    D = t.mtrcol_chunks(x)
+    assert MtrColParser(serialize_container(b'MtrCol', D)).chunks[1].diffuse == (1, 2, 3, 4)
+    for i, (c, d) in enumerate(zip(C, D)):
+        if i != 1:
+            assert bytes(d) == c
+    # Only the field written changed.
+    assert D[1][:0x10] == C[1][:0x10] and D[1][0x20:] == C[1][0x20:]
+
+def test_mtrlchng_unchanged():
+    m, n = 2, 3
+    C = [ b'\1' * 0x10, b'\2' * 0x20, records(m*n, 1) ]
+    x = MTRLCHNGParser(serialize_container(b'MTRLCHNG', C, struct.pack('< HHIII', 1, 2, 3, m, n)))
+    t = MaterialTable.from_mtrlchng(x)
+    assert t.records.shape == (m, n)
+    assert [ bytes(c) for c in t.mtrlchng_chunks(x) ] == C
+    assert MaterialTable.from_mtrlchng(x, copy = False).tobytes() == C[2]
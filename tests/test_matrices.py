@@ -0,0 +1,73 @@
+# The (N, 4, 4) matrix views of HieLay, NodeLay, GlblMtx and BnOfsMtx, and
+# writing matrices back into chunks.
+
+from gibinjector.tcmlib import serialize_container, matrix_chunks, pack_matrices
+from gibinjector.tcmlib.ngs2 import GlblMtxParser, HieLayParser, NodeLayParser
+
+import struct
+import pytest
+
+np = pytest.importorskip('numpy')
+
+def matrices(n):
+    return np.arange(16*n, dtype='<f4').reshape(n, 4, 4)
+
+def hielay_chunk(m, parent, children):
+    return m.tobytes() + struct.pack(f'< iII {len(children)}i', parent, len(children), parent+1, *children)
+
+def nodeobj(i, m):
+    metadata = struct.pack('< 4xii4x', -1, i) + b'node\0'.ljust(0x10, b'\0')
+    chunk = struct.pack('< iIi4x', i, 1, i) + m.tobytes() + struct.pack('< i', i)
+    return serialize_container(b'NodeObj', [chunk], metadata)
+
+def test_glblmtx_view():
+    M = matrices(3)
+    x = GlblMtxParser(serialize_container(b'GlblMtx', matrix_chunks(M)))
+    v = x.matrices()
+    assert v.shape == (3, 4, 4)
+    assert np.array_equal(np.asarray(v), M)
+    # Packed back to back, so the view is of the container.
+    assert v.obj is x._data.obj
+
+def test_hielay_matrices():
+    M = matrices(3)
+    C = [ hielay_chunk(M[0], -1, [1, 2]), hielay_chunk(M[1], 0, []), hielay_chunk(M[2], 0, []) ]
+    x = HieLayParser(serialize_container(b'HieLay', C, b'', bytes(0x10)))
+    assert np.array_equal(np.asarray(x.matrices()), M)
+    assert [ c.matrix for c in x.chunks ] == [ list(m.ravel()) for m in M ]
+
+def test_nodeobj_matrix():
+    M = matrices(2)
+    data = bytearray(serialize_container(b'NodeLay', [ nodeobj(i, m) for i, m in enumerate(M) ]))
+    x = NodeLayParser(data)
+    assert np.array_equal(np.asarray(x.matrices()), M)
+    m = x.chunks[1].matrix()
+    assert m.shape == (4, 4)
+    # A view of the container, not a copy
+    assert m.obj is data
+    k = data.rfind(M[1].tobytes())
+    data[k:k+4] = struct.pack('< f', 100)
+    assert m[0, 0] == 100
+
+def test_empty():
+    x = GlblMtxParser(serialize_container(b'GlblMtx', []))
+    v = x.matrices()
+    assert isinstance(v, memoryview) and v.shape == (0, 4, 4)
+    assert np.asarray(v).shape == (0, 4, 4)
+    assert matrix_chunks(v) == ()
+
+def test_pack_matrices():
+    C = [ bytearray(0x50) for _ in range(2) ]
+    pack_matrices(C, np.eye(4)[None].repeat(2, 0), 0x10)
+    for c in C:
+        assert np.array_equal(np.frombuffer(c, '<f4', 16, 0x10).reshape(4, 4), np.eye(4))
+    # Not contiguous
+    M = matrices(4)[::2]
+    pack_matrices(C, M)
+    assert np.array_equal(np.frombuffer(C[1], '<f4', 16).reshape(4, 4), M[1])
+
+def test_pack_matrices_mismatch():
+    with pytest.raises(ValueError):
+        pack_matrices([ bytearray(0x40) ], matrices(2))
+    with pytest.raises(ValueError):
+        matrix_chunks(np.zeros((2, 3, 3), '<f4'))
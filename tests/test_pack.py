@@ -0,0 +1,64 @@
+# Packed buffers must draw the same triangles through the moved index and
+# vertex ranges as the buffers of each GeoDecl chunk did.
+
+from gibinjector.tcmlib.ngs2 import ObjGeoParser
+
+from geometry import objgeo, geodecl, grid, vertex_buffer, index_buffer
+import pytest
+
+np = pytest.importorskip('numpy')
+from gibinjector.pack import pack_buffers
+
+def mesh(n, z, vertex_size = 12):
+    # An ObjGeo of one GeoDecl chunk drawn by two primitives, and its buffers
+    P, T = grid(n, z)
+    I = [ i for t in T for i in t ]
+    h = len(I) // 2
+    V = vertex_buffer(P)
+    if vertex_size != 12:
+        V = b''.join( V[12*i:12*i+12].ljust(vertex_size, b'\0') for i in range(len(P)) )
+    x = objgeo([ geodecl(0, 0, len(P), len(I), vertex_size) ], [ (0, 4, 0, h, 0, len(P)), (0, 4, h, len(I)-h, 0, len(P)) ])
+    return x, V, index_buffer(I, len(P))
+
+def drawn(objgeo_chunks, vertex_buffers, index_buffers, B):
+    # The vertices of every primitive as drawn, in order
+    R = []
+    B = iter(B)
+    for x in objgeo_chunks:
+        with ObjGeoParser(x) as y:
+            for j, g in enumerate(y.sub_container.chunks):
+                n = next(B)
+                V, I = vertex_buffers[n], index_buffers[n]
+                I = np.frombuffer(I, g.vertex_count < 1<<16 and '<u2' or '<u4', g.index_count).astype(np.int64)
+                assert len(V) == g.vertex_count * g.vertex_size
+                for c in y.chunks:
+                    if c.geodecl_chunk_index == j:
+                        J = I[c.first_index_index:c.first_index_index+c.index_count]
+                        assert (J >= c.first_vertex_index).all() and (J < c.first_vertex_index + c.vertex_count).all()
+                        R.append([ bytes(V[k*g.vertex_size:(k+1)*g.vertex_size]) for k in J ])
+    return R
+
+def test_pack():
+    M = [ mesh(3, 0), mesh(4, 1), mesh(2, 2, 16), mesh(2, 3) ]
+    X, V, I = map(list, zip(*M))
+    before = drawn([ bytearray(x) for x in X ], V, I, range(4))
+    V2, I2, B = pack_buffers(X, V, I)
+    # The third one has another vertex size.
+    assert B == [0, 0, 1, 0]
+    assert len(V2) == len(I2) == 2
+    assert drawn(X, V2, I2, B) == before
+    # Every GeoDecl chunk sharing a buffer has its counts.
+    for x, n in zip(X, B):
+        g = ObjGeoParser(x).sub_container.chunks[0]
+        assert g.vertex_count * g.vertex_size == len(V2[n])
+        assert g.index_count * 2 == len(I2[n])
+
+def test_pack_16bit():
+    # A buffer isn't let grow past 16-bit indices.
+    M = [ mesh(200, 0), mesh(200, 1), mesh(2, 2) ]
+    X, V, I = map(list, zip(*M))
+    before = drawn([ bytearray(x) for x in X ], V, I, range(3))
+    V2, I2, B = pack_buffers(X, V, I)
+    assert B == [0, 1, 1]
+    assert drawn(X, V2, I2, B) == before
+    assert all( len(v) // 12 < 1<<16 for v in V2 )
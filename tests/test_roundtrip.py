@@ -0,0 +1,92 @@
+# Containers built by serialize_container must be parsed back with a layout
+# that serializes them to the same bytes, and reserialize must pass them
+# through untouched. The real databin case runs only if there is one, at
+# $GIBINJECTOR_DATABIN or ./databin.
+
+from gibinjector.tcmlib import ContainerParser, Gather, reproduces, reserialize, same_chunks, serialize_container
+
+import warnings
+import os
+import pytest
+
+CHUNKS = [ bytes(range(n)) for n in (0x10, 0x25, 0, 0x3, 0xff) ]
+
+# Plain containers of NGS2 are aligned to 0x10, or have a size table.
+@pytest.mark.parametrize('aligned', [0x10, 0x8, 0x4])
+def test_plain(aligned):
+    data = serialize_container(b'Plain', CHUNKS, b'meta', aligned = aligned)
+    x = ContainerParser(b'Plain', data)
+    assert x.layout.header_nbytes == 0x30
+    assert x.layout.size_table == bool(aligned % 0x10)
+    if x.layout.size_table:
+        assert same_chunks(x._chunks, CHUNKS)
+    assert reproduces(x)
+    assert reserialize(x) is x._data
+
+def test_plain_size_table():
+    # A size table the default wouldn't write is kept by the layout.
+    data = serialize_container(b'Sized', CHUNKS, size_table = True)
+    x = ContainerParser(b'Sized', data)
+    assert x.layout.size_table
+    assert same_chunks(x._chunks, CHUNKS)
+    assert reproduces(x)
+    y = reserialize(x, [ *CHUNKS[:-1], b'changed' ])
+    assert ContainerParser(b'Sized', y).layout == x.layout
+
+@pytest.mark.parametrize('aligned', [0x10, 0x40, 0x80])
+def test_separated(aligned):
+    data, ldata = serialize_container(b'Sep', CHUNKS, b'meta', separating_body = True, aligned = aligned)
+    x = ContainerParser(b'Sep', data, ldata)
+    assert x.layout.header_nbytes == 0x50
+    assert same_chunks(x._chunks, CHUNKS)
+    assert reproduces(x)
+    assert reserialize(x) == (x._data, x._ldata)
+
+    L = Gather()
+    y, n = reserialize(x, ldata_file = L)
+    assert y is x._data and bytes(L) == ldata and n == len(ldata)
+
+    y, ldata2 = reserialize(x, [ *CHUNKS[:-1], b'changed' ])
+    z = ContainerParser(b'Sep', y, ldata2)
+    assert not same_chunks(z._chunks, CHUNKS)
+    assert same_chunks(z._chunks[:-1], CHUNKS[:-1])
+    assert reproduces(z)
+
+def test_nested():
+    inner = serialize_container(b'Inner', CHUNKS[:2], b'in')
+    sub = serialize_container(b'Sub', CHUNKS[2:], b'sub')
+    data = serialize_container(b'Outer', [inner, b'x' * 0x30], b'out', sub)
+    x = ContainerParser(b'Outer', data)
+    assert reproduces(x)
+    assert reproduces(ContainerParser(b'Sub', x._sub_container))
+    y = ContainerParser(b'Inner', x._chunks[0])
+    # Without a size table, chunks run to the next one, padding included.
+    assert [ bytes(c[:len(d)]) for c, d in zip(y._chunks, CHUNKS) ] == CHUNKS[:2]
+    assert reproduces(y)
+    assert reserialize(x, [ reserialize(y), x._chunks[1] ]) is x._data
+
+def test_gather_chunks():
+    # A chunk given as a Gather serializes as its buffers back to back.
+    a = serialize_container(b'G', [ Gather([CHUNKS[1][:5], CHUNKS[1][5:]]), CHUNKS[0] ])
+    b = serialize_container(b'G', [ CHUNKS[1], CHUNKS[0] ])
+    assert a == b
+
+def test_databin():
+    path = os.environ.get('GIBINJECTOR_DATABIN', 'databin')
+    if not os.path.isfile(path):
+        pytest.skip('No databin')
+    from gibinjector.databin import DatabinParser, decompress, decompress_head, mmap_open
+    from gibinjector.tcmlib.ngs2 import TMCParser
+    from gibinjector.roundtrip import check_tmc
+    checked = 0
+    warnings.simplefilter('ignore')
+    with mmap_open(path) as db, DatabinParser(db) as db:
+        for n in range(len(db.chunks) - 1):
+            if decompress_head(db.chunks[n], 8) != b'TMC\0\0\0\0\0':
+                continue
+            with TMCParser(decompress(db.chunks[n]), decompress(db.chunks[n+1])) as tmc:
+                assert [ x.path for x in check_tmc(tmc) if not x.ok ] == []
+            checked += 1
+            if checked == 8:
+                break
+    assert checked
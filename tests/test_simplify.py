@@ -0,0 +1,81 @@
+# Simplified GeoDecl chunks must have buffers and index and vertex ranges
+# that agree with each other, and keep the outline of every primitive.
+
+from gibinjector.__main__ import main
+from gibinjector.tcmlib.ngs2 import ObjGeoParser
+
+from geometry import objgeo, geodecl, grid, vertex_buffer, index_buffer
+import pytest
+
+np = pytest.importorskip('numpy')
+from gibinjector.simplify import simplify_geodecl
+
+def two_primitives(n = 10):
+    # The lower and the upper half of a grid
+    P, T = grid(n)
+    I = [ i for t in T for i in t ]
+    h = len(I) // 2
+    x = objgeo([ geodecl(0, 0, len(P), len(I)) ], [ (0, 4, 0, h, 0, len(P)), (0, 4, h, h, 0, len(P)) ])
+    return x, vertex_buffer(P), index_buffer(I, len(P)), np.array(P, np.float32)
+
+def simplified(ratio = None, max_error = None):
+    x, V, I, P = two_primitives()
+    with ObjGeoParser(x) as y:
+        r = simplify_geodecl(x, y, 0, V, I, ratio, max_error)
+    return x, r, P
+
+def check(x, r, P):
+    # Returns the triangles of each primitive, as positions.
+    y = ObjGeoParser(x)
+    g = y.sub_container.chunks[0]
+    V = np.frombuffer(r.vertex_buffer, '<f4').reshape(-1, 3)
+    I = np.frombuffer(r.index_buffer, '<u2')
+    assert (g.vertex_count, g.index_count) == (len(V), len(I)) == (len(V), 3*r.triangles_after)
+    # Vertices are taken from the original.
+    assert { tuple(v) for v in V } <= { tuple(p) for p in P }
+    first = 0
+    T = []
+    for c in y.chunks:
+        assert c.primitive_type == 4 and c.first_index_index == first
+        first += c.index_count
+        J = I[c.first_index_index:c.first_index_index+c.index_count]
+        assert J.min() == c.first_vertex_index and J.max() == c.first_vertex_index + c.vertex_count - 1
+        T.append(V[J].reshape(-1, 3, 3))
+    assert first == len(I)
+    return T
+
+def area(T):
+    # The signed areas in the xy plane
+    a, b, c = T[:, 0], T[:, 1], T[:, 2]
+    return ((b[:, 0]-a[:, 0])*(c[:, 1]-a[:, 1]) - (b[:, 1]-a[:, 1])*(c[:, 0]-a[:, 0])) / 2
+
+@pytest.mark.parametrize('ratio, max_error', [(0.5, None), (0.1, None), (None, 0.01)])
+def test_simplify(ratio, max_error):
+    x, r, P = simplified(ratio, max_error)
+    assert r.triangles_before == 200
+    assert r.triangles_after < 200
+    if ratio is not None:
+        assert r.triangles_after >= int(200 * ratio)
+    # Each half still covers its area without flipped triangles, so the
+    # border between them is kept.
+    for T in check(x, r, P):
+        A = area(T)
+        assert (A > 0).all()
+        assert A.sum() == pytest.approx(50)
+        assert (T[:, :, 1] <= 5).all() or (T[:, :, 1] >= 5).all()
+
+def test_unchanged():
+    x, r, P = simplified(1.0)
+    assert r.triangles_after == r.triangles_before
+    T = check(x, r, P)
+    assert sum( len(t) for t in T ) == 200
+
+@pytest.mark.parametrize('argv', [
+    ['--simplify', '0'], ['--simplify', '1.5'], ['--simplify', 'nan'], ['--simplify-error', '-1'],
+    ['--simplify-error', 'nan'],
+])
+def test_arguments(argv, capsys):
+    with pytest.raises(SystemExit) as e:
+        main(argv)
+    assert e.value.code == 2
+    assert 'argument --simplify' in capsys.readouterr().err
@@ -0,0 +1,63 @@
+# The validator must pass sound models and the outputs of inject_gibs, and
+# name every broken reference of a model.
+
+from gibinjector.__main__ import inject_gibs
+from gibinjector.tcmlib.ngs2 import TMCParser
+from gibinjector.validate import find_tmc_files, validate_file, validate_tmc
+
+from model import model, SRC_NAMES, DST_NAMES
+import pytest
+
+def src():
+    return model(SRC_NAMES, 10)
+
+def dst(**kwargs):
+    return model(DST_NAMES, 20, 4, **kwargs)
+
+def test_valid():
+    assert validate_tmc(*src()) == []
+    assert validate_tmc(*dst()) == []
+
+def injected():
+    with TMCParser(*src()) as s, TMCParser(*dst()) as d:
+        T = s.ttdm.textures
+        tmc, tmcl = inject_gibs(s, d, src_gib_first_index = 3, src_gib_tex = T[1], src_gib_normal_tex = T[0],
+                                src_metal_tex = T[2], dst_gib_insert_index = 3, dst_mtrcol_index = 1,
+                                dst_metal_tex_index = 2)
+        return bytes(tmc), bytes(tmcl)
+
+def test_injected():
+    tmc, tmcl = injected()
+    assert validate_tmc(tmc, tmcl) == []
+    with TMCParser(tmc, tmcl) as x:
+        assert len(x.mdlgeo.chunks) == len(DST_NAMES) + 0x11
+        assert x.mtrcol.chunks[1].xrefs == tuple( (i, 1) for i in range(3, 3+0x11) )
+
+@pytest.mark.parametrize('kwargs, problems', [
+    (dict(mtrcol_index = 5), [ 'ObjGeo[0][0]: mtrcol 5 out of range',
+                               'MtrCol[0]: xrefs [(0, 1), (1, 1), (2, 1), (3, 1), (4, 1)] != uses [(1, 1), (2, 1), (3, 1), (4, 1)]' ]),
+    (dict(xrefs = [ (0, 1), (1, 2) ]), [ 'MtrCol[0]: xrefs [(0, 1), (1, 2)] != uses [(0, 1), (1, 1), (2, 1), (3, 1), (4, 1)]' ]),
+    (dict(children = [ 1, 2, 3, 4, 7 ]), [ 'HieLay[0]: child 7 out of range' ]),
+    (dict(children = [ 1, 2, 3 ]), [ 'HieLay[4]: not a child of its parent 0' ]),
+    (dict(node_index = [ 0, 1, 3, 3, 4 ]), [ 'NodeObj[2]: node_index is 3' ]),
+])
+def test_broken(kwargs, problems):
+    assert validate_tmc(*dst(**kwargs)) == problems
+
+@pytest.mark.filterwarnings('ignore:No ldata')
+def test_truncated():
+    tmc, tmcl = dst()
+    assert validate_tmc(tmc, tmcl[:len(tmcl)//2])[0].startswith('LHeader: ldata size')
+    # Parsing errors end the checks as problems of their own.
+    assert validate_tmc(tmc[:0x100], tmcl)[-1].startswith('TMC: ')
+
+def test_files(tmp_path):
+    for n, data in enumerate(dst()):
+        (tmp_path / f'{n+4:05}.dat').write_bytes(data)
+    (tmp_path / '00006.dat').write_bytes(dst()[0])
+    (tmp_path / 'other.dat').write_bytes(dst()[0])
+    assert list(find_tmc_files(tmp_path)) == [ str(tmp_path / '00004.dat'), str(tmp_path / '00006.dat') ]
+    assert validate_file(str(tmp_path / '00004.dat')) == []
+    # Without its TMCL
+    assert validate_file(str(tmp_path / '00006.dat'))[0].startswith('FileNotFoundError')
+    assert validate_file(str(tmp_path / 'other.dat'))[0].startswith('ValueError')